@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Batched scautopick playback
+
+The waveforms of several times file records are written to one mseed file,
+in time order and separated by gaps long enough to reset the detector, so a
+single scautopick process picks all of them. Picks are mapped back to their
+source windows with the start times and npts of the times file.
+"""
+import io
+import obspy
+
+# Seconds between two windows of a batch. Longer than any gap scautopick
+# interpolates, so the detector restarts (with its init time) on each window
+BATCH_GAP = 600.0
+
+# Seconds after the end of a window in which a pick still belongs to it
+PICK_MARGIN = 1.0
+
+
+class PlaybackBatch:
+    """
+    mseed file with the windows of some records and the time shift applied
+    to each of them
+    """
+    def __init__(self, path: str, records: list, indexes=None):
+        self.path = path
+        self.records = records
+        # dataset indexes of the records
+        self.indexes = list(indexes) if indexes is not None else list(range(len(records)))
+        self.order = sorted(range(len(records)),
+                            key=lambda i: float(records[i].wf_start_time))
+        self.shifts = [0.0] * len(records)
+        previous_end = None
+        for i in self.order:
+            record = records[i]
+            start = record.wf_start_time
+            if previous_end is not None and start < previous_end + BATCH_GAP:
+                self.shifts[i] = (previous_end + BATCH_GAP) - start
+            previous_end = start + self.shifts[i] + record.npts / record.sample_rate
+
+    def window(self, i):
+        """
+        Start and end of the window of record i in batch time
+        """
+        record = self.records[i]
+        start = record.wf_start_time + self.shifts[i]
+        return start, start + record.npts / record.sample_rate
+
+    def write(self):
+        """
+        Write the shifted windows, one after the other, to self.path
+        """
+        with open(self.path, 'wb') as f:
+            for i in self.order:
+                st = obspy.read(self.records[i].wf_path)
+                for tr in st:
+                    tr.stats.starttime += self.shifts[i]
+                buffer = io.BytesIO()
+                st.write(buffer, format='MSEED')
+                f.write(buffer.getvalue())
+        return self
+
+    def demultiplex(self, pick_times: list) -> list:
+        """
+        Split the picks of the batch into the pick times of each record, in
+        the time of its original waveform
+        """
+        picks = [[] for _ in self.records]
+        for t in pick_times:
+            for i in self.order:
+                start, end = self.window(i)
+                if start <= t <= end + PICK_MARGIN:
+                    picks[i].append(t - self.shifts[i])
+                    break
+        return picks
+
+
+def split_in_batches(indexes: list, records: list, n_batches: int) -> list:
+    """
+    Split record indexes in at most n_batches groups of consecutive windows
+    in time, to run one scautopick per group in parallel
+    """
+    ordered = sorted(indexes, key=lambda i: float(records[i].wf_start_time))
+    n_batches = max(1, min(n_batches, len(ordered)))
+    size, extra = divmod(len(ordered), n_batches)
+    groups = []
+    start = 0
+    for k in range(n_batches):
+        end = start + size + (1 if k < extra else 0)
+        groups.append(ordered[start:end])
+        start = end
+    return groups
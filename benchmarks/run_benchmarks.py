@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Offline benchmarks of the tuner
+
+Generates a synthetic station (benchmarks/synthetic_data.py), puts the fake
+scautopick (benchmarks/fake_scautopick) first on PATH and times, for each
+number of workers:
+
+- mega: StaLta.mega_sta_lta on the P times file (one trial evaluation)
+- bayes: bayes_optuna P and S studies
+- tuner: the picker_tuner station pipeline (tune_station) with the
+  waveform download replaced by the synthetic data
+
+Usage (from the repository root):
+
+    python benchmarks/run_benchmarks.py --workers 1,2,4 --latency 0.05
+
+Results are printed as a table and written to --output (CSV, or JSON if
+the name ends with .json).
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from icecream import ic  # noqa: E402
+
+from resource_monitor import monitor_resources, station_scope  # noqa: E402
+
+from execution_context import ExecutionContext  # noqa: E402
+from stalta import EvaluationPool, StaLta  # noqa: E402
+from synthetic_data import generate_station  # noqa: E402
+
+NET, STA, LOC, CH = 'XX', 'SYN', '00', 'HH'
+
+# Parameters of the mega stage, inside the search space
+P_PARAMS = {'p_sta': 1, 'p_lta': 10, 'p_fmin': 2, 'p_fmax': 10, 'p_snr': 2,
+            'trig_on': 3.0, 'p_timecorr': 0.0}
+
+STAGES = ('mega', 'bayes', 'tuner')
+
+
+@contextmanager
+def timer(rows, stage, workers, calls=1, unit='calls'):
+    """Append a result row with the wall time of the block"""
+    start = time.perf_counter()
+    yield
+    rows.append(result_row(stage, workers, calls, time.perf_counter() - start, unit))
+
+
+def result_row(stage, workers, calls, seconds, unit='calls'):
+    rate = round(calls / seconds, 3) if seconds > 0 else None
+    return {'stage': stage, 'workers': workers, 'calls': calls,
+            'seconds': round(seconds, 4), 'rate': rate, 'unit': f'{unit}/s'}
+
+
+def fake_scautopick_env(work_dir, paths, args):
+    """Put the fake scautopick first on PATH and configure it"""
+    bin_dir = os.path.join(work_dir, 'bin')
+    os.makedirs(bin_dir, exist_ok=True)
+    link = os.path.join(bin_dir, 'scautopick')
+    if not os.path.exists(link):
+        os.symlink(os.path.join(BENCH_DIR, 'fake_scautopick'), link)
+    os.environ['PATH'] = f"{bin_dir}{os.pathsep}{os.environ['PATH']}"
+    os.environ['FAKE_SCAUTOPICK_ONSETS'] = paths['manifest']
+    os.environ['FAKE_SCAUTOPICK_LATENCY'] = str(args.latency)
+    os.environ['FAKE_SCAUTOPICK_MODE'] = args.mode
+    os.environ['FAKE_SCAUTOPICK_JITTER'] = str(args.jitter)
+    os.environ['FAKE_SCAUTOPICK_FALSE_PICKS'] = str(args.false_picks)
+
+
+def make_context(paths, phase, work_dir, args):
+    return ExecutionContext(paths[phase], os.path.join(work_dir, 'picks_xml'),
+                            paths['inventory'], False, NET, CH, LOC, STA,
+                            engine=args.engine, batch_playback=args.batch_playback,
+                            profile=args.profile)
+
+
+def bench_mega(rows, paths, work_dir, workers, args):
+    context = make_context(paths, 'P', work_dir, args)
+    n_waveforms = len(StaLta(context=context).dataset)
+    with EvaluationPool(workers) as pool:
+        # the first evaluation also starts the workers
+        with timer(rows, 'mega (first call)', workers, n_waveforms, 'waveforms'):
+            StaLta(pool=pool, context=context).mega_sta_lta(**P_PARAMS)
+        with timer(rows, 'mega', workers, n_waveforms * args.repeat, 'waveforms'):
+            for _ in range(args.repeat):
+                StaLta(pool=pool, context=context).mega_sta_lta(**P_PARAMS)
+
+
+def bench_bayes(rows, paths, work_dir, workers, args):
+    import optuna
+    from optimizer import bayes_optuna
+
+    optuna.logging.set_verbosity(optuna.logging.WARNING)
+    with EvaluationPool(workers) as pool:
+        for phase in ('P', 'S'):
+            with timer(rows, f'bayes {phase}', workers, args.trials, 'trials'):
+                bayes_optuna(NET, STA, LOC, CH, phase, args.trials, pool=pool,
+                             context=make_context(paths, phase, work_dir, args))
+
+
+def bench_tuner(rows, paths, work_dir, workers, args):
+    import picker_tuner
+    from optimizer import PruningSettings
+    from study_storage import StudyStorage
+    from warm_start import WarmStart
+
+    stage_rows = []
+
+    def timed(stage, func):
+        def wrapper(*a, **kw):
+            with timer(stage_rows, stage, workers):
+                return func(*a, **kw)
+        return wrapper
+
+    settings = picker_tuner.TuningSettings(
+        CWD=work_dir, main_data_dir=os.path.dirname(paths['P']),
+        inv_xml=paths['inventory'], debug=False, download_noise_p=True,
+        engine=args.engine, engine_validation=False, metric='f1',
+        trial_cache='', trial_cache_size=0, pruning=PruningSettings(),
+        study_storage=StudyStorage(), warm_start=WarmStart(),
+        search_mode='bayes', grid_stride=2, grid_top=3,
+        batch_playback=args.batch_playback, profile=args.profile, resource_scopes='',
+        n_trials=args.trials,
+        max_picks=len(StaLta(context=make_context(paths, 'P', work_dir, args)).dataset),
+        DT=100, fdsn_ips=[], download_workers=1, fdsn_max_connections=1,
+        fdsn_bulk_size=0, fdsn_slots_dir='', radius=0, ti='', tf='', comparison=False,
+        reference_xml_dir=None, best_xml_dir=None, workers=workers,
+        worker_autotune=None)
+    job = picker_tuner.StationJob(NET, STA, LOC, CH, 0.0, 0.0, [])
+    times = {'P': paths['P'], 'S': paths['S']}
+    originals = (picker_tuner.waveform_downloader, picker_tuner.bayes_optuna)
+    picker_tuner.waveform_downloader = timed('tuner download', lambda *a, **kw: times)
+    picker_tuner.bayes_optuna = timed('tuner study', picker_tuner.bayes_optuna)
+    try:
+        with timer(rows, 'tuner station', workers):
+            picker_tuner.tune_station(job, settings)
+    finally:
+        picker_tuner.waveform_downloader, picker_tuner.bayes_optuna = originals
+    if not any(row['stage'] == 'tuner study' for row in stage_rows):
+        raise RuntimeError(f'The tuner stage ran no study with {workers} workers')
+    # one row per stage with the summed time of its calls
+    for stage in dict.fromkeys(row['stage'] for row in stage_rows):
+        seconds = sum(row['seconds'] for row in stage_rows if row['stage'] == stage)
+        calls = sum(row['calls'] for row in stage_rows if row['stage'] == stage)
+        rows.append(result_row(stage, workers, calls, seconds))
+
+
+BENCHMARKS = {'mega': bench_mega, 'bayes': bench_bayes, 'tuner': bench_tuner}
+
+
+def format_table(rows):
+    header = f"{'stage':<20} {'workers':>7} {'calls':>7} {'seconds':>10} {'rate':>12}  unit"
+    lines = [header, '-' * len(header)]
+    for row in rows:
+        rate = '-' if row['rate'] is None else f"{row['rate']:.3f}"
+        lines.append(f"{row['stage']:<20} {row['workers']:>7} {row['calls']:>7} "
+                     f"{row['seconds']:>10.3f} {rate:>12}  {row['unit']}")
+    return '\n'.join(lines)
+
+
+def write_rows(rows, path):
+    if path.endswith('.json'):
+        with open(path, 'w') as f:
+            json.dump(rows, f, indent=1)
+        return
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def run(args):
+    work_dir = os.path.abspath(args.work_dir or tempfile.mkdtemp(prefix='sc3-autotuner-bench-'))
+    paths = generate_station(os.path.join(work_dir, 'mseed_data', STA), args.events,
+                             args.noise, args.sampling_rate, seed=args.seed,
+                             net=NET, sta=STA, loc=LOC, ch=CH)
+    fake_scautopick_env(work_dir, paths, args)
+    os.makedirs(os.path.join(work_dir, 'images'), exist_ok=True)
+    os.chdir(work_dir)
+    rows = []
+    with monitor_resources(os.path.join(work_dir, 'resources'), args.monitor_interval,
+                           args.monitor) as monitor:
+        scopes_dir = monitor.scopes_dir if monitor is not None else ''
+        for workers in args.workers:
+            # one resource monitor scope per worker count
+            with station_scope(scopes_dir, f'workers={workers}'):
+                for stage in args.stages:
+                    BENCHMARKS[stage](rows, paths, work_dir, workers, args)
+    return rows
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--workers', default=f'1,{os.cpu_count()}',
+                        type=lambda s: [int(w) for w in s.split(',')],
+                        help='comma separated worker counts')
+    parser.add_argument('--stages', default=','.join(STAGES),
+                        type=lambda s: [st.strip() for st in s.split(',')],
+                        help=f'comma separated stages among {", ".join(STAGES)}')
+    parser.add_argument('--events', type=int, default=20, help='event windows')
+    parser.add_argument('--noise', type=int, default=10, help='noise windows')
+    parser.add_argument('--sampling-rate', type=float, default=100.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--trials', type=int, default=10, help='trials per study')
+    parser.add_argument('--repeat', type=int, default=3, help='mega_sta_lta calls')
+    parser.add_argument('--engine', default='scautopick', choices=['scautopick', 'numpy'])
+    parser.add_argument('--batch-playback', action='store_true')
+    parser.add_argument('--profile', action='store_true',
+                        help='write the stage profile of the trials in profiles/')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds slept by each fake scautopick run')
+    parser.add_argument('--mode', default='truth', choices=['truth', 'empty', 'random'])
+    parser.add_argument('--jitter', type=float, default=0.1)
+    parser.add_argument('--false-picks', type=float, default=0.0)
+    parser.add_argument('--monitor', action='store_true',
+                        help='sample CPU, memory, I/O and scautopick processes '
+                        'per worker count in resources/')
+    parser.add_argument('--monitor-interval', type=float, default=0.5)
+    parser.add_argument('--work-dir', help='directory for the data and outputs '
+                        '(a temporary one by default)')
+    parser.add_argument('--output', help='CSV (or .json) file for the results')
+    parser.add_argument('--debug-prints', action='store_true',
+                        help='keep the ic() debug output')
+    args = parser.parse_args(argv)
+    unknown = set(args.stages) - set(STAGES)
+    if unknown:
+        parser.error(f'unknown stages: {", ".join(sorted(unknown))}')
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if not args.debug_prints:
+        ic.disable()
+    output = os.path.abspath(args.output) if args.output else None
+    rows = run(args)
+    print('\n' + format_table(rows))
+    if output:
+        write_rows(rows, output)
+        print(f'\n\tResults written to {output}\n')
+    return rows
+
+
+if __name__ == '__main__':
+    main()
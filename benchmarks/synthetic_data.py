@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic station data for the benchmarks
+
+Writes three component mseed windows with known P and S onsets (and noise
+windows without them), the P and S times files in the format written by
+download_data.write_picks, a dummy inventory and a manifest with the onsets
+of every waveform for the fake scautopick.
+"""
+import json
+import os
+
+import numpy as np
+import obspy
+
+START = obspy.UTCDateTime(2020, 1, 1)
+
+# Seconds before the pick in each window, like download_data (DT)
+DT = 100
+
+
+def _burst(npts, sampling_rate, onset, amplitude, freq, rng):
+    data = rng.normal(0, 1, npts)
+    if onset is not None:
+        t = np.arange(npts) / sampling_rate
+        i = int(onset * sampling_rate)
+        data[i:] += (amplitude * np.sin(2 * np.pi * freq * t[i:])
+                     * np.exp(-(t[i:] - onset) / 5))
+    return data
+
+
+def write_waveform(path, start, sampling_rate, npts, p_onset, s_onset, rng,
+                   net='XX', sta='SYN', loc='00', ch='HH'):
+    """
+    Write a Z/N/E window with a P burst on Z and an S burst on N and E at
+    the given onsets (seconds after start, None for noise)
+    """
+    traces = []
+    for comp, onset, amplitude, freq in [('Z', p_onset, 40, 5),
+                                         ('N', s_onset, 60, 3),
+                                         ('E', s_onset, 60, 3)]:
+        data = _burst(npts, sampling_rate, onset, amplitude, freq, rng)
+        traces.append(obspy.Trace(data.astype(np.float32), header={
+            'network': net, 'station': sta, 'location': loc,
+            'channel': f'{ch}{comp}', 'sampling_rate': sampling_rate,
+            'starttime': start}))
+    obspy.Stream(traces).write(path, format='MSEED')
+
+
+def generate_station(out_dir, n_events=20, n_noise=10, sampling_rate=100.0,
+                     duration=2 * DT, seed=0, net='XX', sta='SYN', loc='00',
+                     ch='HH'):
+    """
+    Write the data of a synthetic station in out_dir and return the paths of
+    the P and S times files, the manifest and the inventory
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    npts = int(duration * sampling_rate)
+    p_lines, s_lines = [], []
+    manifest = {}
+    for k in range(n_events + n_noise):
+        event = k < n_events
+        # one event per hour, the noise windows between them
+        start = START + 3600 * k
+        event_id = f'syn{k:04d}' if event else f'syn{k:04d}_NOISE'
+        p_onset = DT if event else None
+        s_onset = DT + float(rng.uniform(3, 10)) if event else None
+        wf_path = os.path.join(
+            out_dir, f'{event_id}.{sta}.{loc}.{ch}_{(start + DT).strftime("%Y%m%dT%H%M%S")}.mseed')
+        write_waveform(wf_path, start, sampling_rate, npts, p_onset, s_onset, rng,
+                       net, sta, loc, ch)
+        start_str = start.strftime("%Y-%m-%dT%H:%M:%S.%f")
+        if event:
+            p_time = start + p_onset
+            s_time = start + s_onset
+            p_lines.append(f'{wf_path},{p_time.strftime("%Y-%m-%dT%H:%M:%S.%f")},'
+                           f'{start_str},{sampling_rate},{npts}\n')
+            s_lines.append(f'{wf_path},{s_time.strftime("%Y-%m-%dT%H:%M:%S.%f")},'
+                           f'{start_str},{sampling_rate},{npts}\n')
+        else:
+            p_lines.append(f'{wf_path},NO_PICK,{start_str},{sampling_rate},{npts}\n')
+        manifest[os.path.basename(wf_path)] = {
+            'start': str(start), 'duration': duration,
+            'onsets': {'P': str(p_time), 'S': str(s_time)} if event else {}}
+
+    paths = {'P': os.path.join(out_dir, f'{sta}_P_{ch}.txt'),
+             'S': os.path.join(out_dir, f'{sta}_S_{ch}.txt'),
+             'manifest': os.path.join(out_dir, 'onsets.json'),
+             'inventory': os.path.join(out_dir, 'inventory.xml')}
+    for phase, lines in [('P', p_lines), ('S', s_lines)]:
+        with open(paths[phase], 'w') as f:
+            f.writelines(lines)
+    with open(paths['manifest'], 'w') as f:
+        json.dump(manifest, f, indent=1)
+    with open(paths['inventory'], 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<seiscomp/>\n')
+    return paths
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Scheduler of the station pipelines of a tuning campaign
+
+Stations run in separate processes, each one with its own share of the
+global worker budget and its own log file. The main process prints one
+progress line per finished station.
+"""
+import fcntl
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+
+
+@contextmanager
+def file_lock(path: str):
+    """
+    Exclusive lock on path (through path.lock) shared by the processes of a
+    campaign, for the files every station appends to
+    """
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def split_workers(max_workers: int, station_workers: int) -> int:
+    """
+    Evaluation workers of each station when station_workers stations share
+    max_workers
+    """
+    return max(1, int(max_workers) // max(1, int(station_workers)))
+
+
+def _run_logged(run_job, job, log_path):
+    """
+    Run a station job in a campaign process with its output in log_path.
+    Returns (result, error)
+    """
+    stdout, stderr = sys.stdout, sys.stderr
+    with open(log_path, 'a', buffering=1) as log:
+        sys.stdout = sys.stderr = log
+        try:
+            return run_job(job), None
+        except Exception:
+            traceback.print_exc()
+            return None, traceback.format_exc().strip().splitlines()[-1]
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+
+
+def run_campaign(jobs: list, run_job, station_workers=1, log_dir='logs'):
+    """
+    Run run_job(job) for every job and return the results in the jobs order.
+    With one station worker the jobs run in this process one after the
+    other, otherwise station_workers jobs run at a time in separate
+    processes, each one logging to log_dir/<job.name>.log. Failed jobs give
+    a None result
+    """
+    if station_workers <= 1 or len(jobs) <= 1:
+        return [run_job(job) for job in jobs]
+
+    os.makedirs(log_dir, exist_ok=True)
+    results = [None] * len(jobs)
+    start = time.time()
+    print(f'\n\tTuning {len(jobs)} stations, {station_workers} at a time. '
+          f'Station logs in {log_dir}\n')
+    with ProcessPoolExecutor(max_workers=station_workers) as executor:
+        futures = {}
+        for i, job in enumerate(jobs):
+            log_path = os.path.join(log_dir, f'{job.name}.log')
+            futures[executor.submit(_run_logged, run_job, job, log_path)] = (i, log_path)
+        for done, future in enumerate(as_completed(futures), 1):
+            i, log_path = futures[future]
+            elapsed = time.time() - start
+            try:
+                result, error = future.result()
+            except Exception as exc:
+                result, error = None, repr(exc)
+            results[i] = result
+            if error is None:
+                print(f'\033[92m[{done}/{len(jobs)}] {jobs[i].name} finished\033[0m '
+                      f'({elapsed:.0f} s elapsed, log: {log_path})')
+            else:
+                print(f'\033[91m[{done}/{len(jobs)}] {jobs[i].name} failed: {error}\033[0m '
+                      f'(log: {log_path})')
+    return results
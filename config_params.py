@@ -9,19 +9,22 @@ trig_on_name = 'trig_on'
 s_snr_name = 's_snr'
 s_fmin_name = 's_fmin'
 s_fmax_name = 's_fmax'
+# 'above': conditional lower bound, the parameter is sampled above the value
+# of the given parameter of the same phase (listed before it), so every
+# trial has p_lta > p_sta and fmax > fmin
 OPTIMIZATION_PARAMS = {
     'P': {
         p_sta_name: {'min': 1, 'max': 5, 'step': 1, 'type': 'int'},
-        p_lta_name: {'min': 2, 'max': 15, 'step': 1, 'type': 'int'},
+        p_lta_name: {'min': 2, 'max': 15, 'step': 1, 'type': 'int', 'above': p_sta_name},
         p_fmin_name: {'min': 1, 'max': 20, 'step': 1, 'type': 'int'},
-        p_fmax_name: {'min': 4, 'max': 40, 'step': 1, 'type': 'int'},
+        p_fmax_name: {'min': 4, 'max': 40, 'step': 1, 'type': 'int', 'above': p_fmin_name},
         p_snr_name: {'min': 1, 'max': 4, 'step': 1, 'type': 'int'},
         trig_on_name: {'min': 2, 'max': 6, 'step': 0.5, 'type': 'float'}
     },
     'S': {
         s_snr_name: {'min': 1, 'max': 4, 'step': 1, 'type': 'int'},
         s_fmin_name: {'min': 1, 'max': 20, 'step': 1, 'type': 'int'},
-        s_fmax_name: {'min': 4, 'max': 40, 'step': 1, 'type': 'int'}
+        s_fmax_name: {'min': 4, 'max': 40, 'step': 1, 'type': 'int', 'above': s_fmin_name}
     }
 }
 
@@ -65,6 +68,52 @@ PLOT_PARAMS = {
 }
 
 
+class CompiledTemplate:
+    """
+    str.format template parsed once and rendered in a single pass. Templates
+    with fields other than plain names fall back to str.format
+    """
+    def __init__(self, template: str):
+        self.template = template
+        self.parts = list(string.Formatter().parse(template))
+        self.fields = {field for _, field, _, _ in self.parts if field}
+        self.simple = all(
+            field is None or (field.isidentifier() and '{' not in (spec or ''))
+            for _, field, spec, _ in self.parts
+        )
+
+    def render(self, values: dict) -> str:
+        if not self.simple:
+            return self.template.format(**values)
+        out = []
+        for literal, field, spec, conversion in self.parts:
+            out.append(literal)
+            if field is None:
+                continue
+            value = values[field]
+            if conversion == 'r':
+                value = repr(value)
+            elif conversion == 's':
+                value = str(value)
+            elif conversion == 'a':
+                value = ascii(value)
+            out.append(format(value, spec))
+        return ''.join(out)
+
+
+# Templates compiled in this process, keyed by template text
+_COMPILED_TEMPLATES = {}
+
+
+def compile_template(template: str) -> CompiledTemplate:
+    """
+    Return the CompiledTemplate of template, parsed once per process
+    """
+    if template not in _COMPILED_TEMPLATES:
+        _COMPILED_TEMPLATES[template] = CompiledTemplate(template)
+    return _COMPILED_TEMPLATES[template]
+
+
 def render_config_param_templates(params: dict) -> dict:
     """
     Build a dictionary with resolved template values for each SeisComP
@@ -77,23 +126,20 @@ def render_config_param_templates(params: dict) -> dict:
     """
     rendered = {}
     resolved_params = params.copy()
-    formatter = string.Formatter()
 
     for key, value in params.items():
         if isinstance(value, str) and '{' in value and '}' in value:
             try:
-                resolved_params[key] = value.format(**params)
+                resolved_params[key] = compile_template(value).render(params)
             except KeyError:
                 pass
 
     for param_name, template in CONFIG_PARAM_TEMPLATES.items():
-        required_fields = {
-            field for _, field, _, _ in formatter.parse(template) if field
-        }
-        if not required_fields.issubset(resolved_params.keys()):
+        compiled = compile_template(template)
+        if not compiled.fields.issubset(resolved_params.keys()):
             continue
 
-        value = template.format(**resolved_params)
+        value = compiled.render(resolved_params)
         rendered[param_name] = value
 
         safe_key = param_name.replace('.', '_').replace('-', '_')
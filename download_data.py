@@ -1,5 +1,11 @@
 import numpy as np
 import datetime
+import fcntl
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from dataclasses import dataclass
 import obspy
 import os
@@ -7,6 +13,7 @@ from obspy.clients.fdsn.header import FDSNException,FDSNNoDataException,FDSNBadG
 import scipy as sc
 import csv
 from icecream import ic
+import profiling
 
 ic.configureOutput(prefix='debug| ')
 
@@ -33,21 +40,82 @@ class Waveform:
 class DirectoryCreator:
     def make_dir(self, dir_root, new_dir_name):
         data_dir = os.path.join(dir_root, new_dir_name)
-        if not os.path.exists(data_dir):
-            os.makedirs(data_dir)
+        # exist_ok: stations tuned in parallel create the same directories
+        os.makedirs(data_dir, exist_ok=True)
         return data_dir
 
 
+# Prefix of the temporary directory with the lock files limiting the
+# requests to each FDSN endpoint across the station processes of a campaign
+FDSN_SLOTS_PREFIX = 'sc3-autotuner-fdsn-slots-'
+
+
+class EndpointLimits:
+    """Maximum number of requests in flight to each FDSN endpoint. With
+    lock_dir the limit is shared by every process using the same lock_dir
+    (the station processes of a campaign), otherwise by the threads of this
+    process only"""
+    def __init__(self, max_connections=4, lock_dir=None):
+        self.max_connections = max(1, int(max_connections))
+        self.lock_dir = lock_dir
+        self._semaphores = {}
+        self._lock = threading.Lock()
+        if lock_dir is not None:
+            os.makedirs(lock_dir, exist_ok=True)
+
+    def slot(self, client):
+        key = getattr(client, 'base_url', id(client))
+        if self.lock_dir is not None:
+            name = hashlib.sha256(str(key).encode()).hexdigest()[:16]
+            return EndpointSlot(os.path.join(self.lock_dir, name), self.max_connections)
+        with self._lock:
+            if key not in self._semaphores:
+                self._semaphores[key] = threading.BoundedSemaphore(self.max_connections)
+            return self._semaphores[key]
+
+
+class EndpointSlot:
+    """One of the max_connections lock files of an endpoint, held while a
+    request is in flight. The locks are released if the process dies"""
+    poll_seconds = 0.05
+
+    def __init__(self, path_prefix, max_connections):
+        self.path_prefix = path_prefix
+        self.max_connections = max_connections
+        self._file = None
+
+    def __enter__(self):
+        while True:
+            for k in range(self.max_connections):
+                f = open(f'{self.path_prefix}.{k}.lock', 'a')
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    f.close()
+                    continue
+                self._file = f
+                return self
+            time.sleep(self.poll_seconds)
+
+    def __exit__(self, *exc):
+        fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._file.close()
+        self._file = None
+
+
 class DownloadWaveform:
     pick: Waveform
     station: Station
     clients: list # [obspy.clients.fdsn.client.Client]
     ch: str
     
-    def __init__(self, pick, station, clients):
+    def __init__(self, pick, station, clients, limits=None):
         self.pick = pick
         self.station = station
         self.clients = clients
+        self.limits = limits
+        # set before get_wf_stream when the window came in a bulk request
+        self.st = None
     
     @property
     def data_dir(self):
@@ -67,27 +135,42 @@ class DownloadWaveform:
         return os.path.split(self.data_dir)[0]
 
     def get_wf_stream(self):
+        if self.st is not None:
+            return True
         ic(self.clients)
         ic(self.station.net, self.station.name, self.station.loc, self.station.ch, self.pick.ti, self.pick.tf)
         for client in self.clients:
+            slot = self.limits.slot(client) if self.limits is not None else nullcontext()
             try:
-                self.st = client.get_waveforms(network=self.station.net,
-                                               station=self.station.name,
-                                               location=self.station.loc,
-                                               channel=self.station.ch+'*',
-                                               starttime=self.pick.ti,
-                                               endtime=self.pick.tf)
+                with slot, profiling.stage('fdsn_request'):
+                    self.st = client.get_waveforms(network=self.station.net,
+                                                   station=self.station.name,
+                                                   location=self.station.loc,
+                                                   channel=self.station.ch+'*',
+                                                   starttime=self.pick.ti,
+                                                   endtime=self.pick.tf)
+                profiling.count('downloaded')
                 return True
             except (FDSNException, FDSNNoDataException, FDSNBadGatewayException):
+                profiling.count('fdsn_errors')
                 continue
         print('\n\n\tNo se encontraron datos')
         print(f'\t{self.station.net}.{self.station.name}.{self.station.loc}.{self.station.ch}')
         print(f'\t{self.pick.ti} - {self.pick.tf}')
         return False
     
+    def take_from_bulk(self, st):
+        """Keep the traces of a bulk request stream inside the window"""
+        window = st.select(network=self.station.net, station=self.station.name,
+                           location=self.station.loc, channel=self.station.ch+'*')
+        window = window.slice(self.pick.ti, self.pick.tf)
+        if len(window):
+            self.st = window.copy()
+
     def trim_and_merge(self):
-        self.st.trim(self.pick.ti, self.pick.tf)
-        self.st.merge(fill_value="interpolate")
+        with profiling.stage('trim_merge'):
+            self.st.trim(self.pick.ti, self.pick.tf)
+            self.st.merge(fill_value="interpolate")
     
     def mseed_exists(self):
         # If the mseed file exists do nothing
@@ -98,10 +181,13 @@ class DownloadWaveform:
             return False
 
     def write(self):
-        self.st.write(self.wf_path)
+        with profiling.stage('mseed_write'):
+            self.st.write(self.wf_path)
 
     def load_stream(self):
-        self.st = obspy.read(self.wf_path)
+        profiling.count('reused')
+        with profiling.stage('mseed_read'):
+            self.st = obspy.read(self.wf_path)
 
 
 class PurgeSNR:
@@ -308,7 +394,13 @@ NOISE_GAP_SECONDS = 5
 
 
 def waveform_downloader(clients, station, manual_picks: list, dt: int,
-                        download_noise_p: bool):
+                        download_noise_p: bool, workers=1, limits=None, bulk_size=0):
+    """Download the event windows of the manual picks (and their noise
+    windows if download_noise_p), workers windows at a time with at most
+    limits.max_connections requests in flight per FDSN endpoint, and write
+    the times files. With bulk_size, the windows are first requested
+    bulk_size at a time in bulk requests. Returns the times files paths,
+    None if no waveform was kept"""
 
     ic(len(manual_picks))
     # keeping with event id and p times in manual_picks
@@ -324,54 +416,110 @@ def waveform_downloader(clients, station, manual_picks: list, dt: int,
     purged_wf = PurgeTimes(wf_list).purge()
     ic(len(purged_wf))
 
-    waveforms = {}
-    noise_waveforms = {} if download_noise_p else None
-
-    # Download waveforms for each pick
-    for waveform in purged_wf:
-        download = DownloadWaveform(waveform, station, clients)
-        # checking if the mseed exist
-        mseed_exists = download.mseed_exists()
-        # if the mseed already exists continue to the next waveform
-        if ic(mseed_exists):
-            download.load_stream()
-            waveforms[waveform.event_id] = download
-            continue
+    downloads = [DownloadWaveform(waveform, station, clients, limits)
+                 for waveform in purged_wf]
+    # windows downloaded by a previous run are read from disk
+    new_downloads = [download for download in downloads if not download.mseed_exists()]
 
-        success = download.get_wf_stream()
-        # checking if there was no FDSNExeption
-        if ic(not success):
-            continue
-        download.trim_and_merge()
-        
-        # if the snr is too low and have a lot of peaks continue
-        # with the next waveform
-        noisy_waveform = PurgeSNR(download).purge_waveform()
-        if ic(noisy_waveform):
-            continue
-        
-        ic(download.wf_path)
-        waveforms[waveform.event_id] = download
-        # Attempt to download an equivalent-length noise window for P-phase usage
+    with ThreadPoolExecutor(max_workers=workers) if workers > 1 else nullcontext() as executor:
+        run = executor.map if executor is not None else map
+
+        bulk_download(new_downloads, clients, bulk_size, run, limits)
+        # same order as the picks, as when they were downloaded one by one
+        kept = list(run(download_event_window, downloads))
+        waveforms = {download.pick.event_id: download for download in kept
+                     if download is not None}
+
+        noise_waveforms = None
         if download_noise_p:
-            noise_download = download_noise_window(download, station, clients)
-            if noise_download:
-                noise_waveforms[noise_download.pick.event_id] = noise_download
-        # writing the mseed file
-        download.write()
+            # equivalent-length noise windows of the new event windows, for
+            # P-phase usage
+            noise_downloads = [noise_window(download, station, clients, limits)
+                               for download in kept
+                               if download is not None and download in new_downloads]
+            noise_downloads = [download for download in noise_downloads if download]
+            bulk_download([download for download in noise_downloads if not download.mseed_exists()],
+                          clients, bulk_size, run, limits)
+            noise_waveforms = {download.pick.event_id: download
+                               for download in run(download_noise_window, noise_downloads)
+                               if download is not None}
 
     if not waveforms:
         return None
 
     # write phase times on file and return the paths to times file
-    return write_picks(p_times, s_times, waveforms, station,
-                       noise_waveforms if download_noise_p else None)
+    with profiling.stage('times_files'):
+        return write_picks(p_times, s_times, waveforms, station, noise_waveforms)
 
 
-def download_noise_window(event_download, station, clients):
+def bulk_download(downloads, clients, bulk_size, run=map, limits=None):
     """
-    Download a noise-only waveform with the same duration as the event window,
-    ending a few seconds before the pick time.
+    Request the windows of downloads bulk_size at a time with
+    get_waveforms_bulk (each chunk from the first endpoint that answers) and
+    give each download its part of the returned stream. Windows left without
+    data are requested one by one by get_wf_stream
+    """
+    if bulk_size < 1 or not downloads:
+        return
+    chunks = [downloads[i:i+bulk_size] for i in range(0, len(downloads), bulk_size)]
+    list(run(lambda chunk: bulk_request(chunk, clients, limits), chunks))
+
+
+def bulk_request(chunk, clients, limits=None):
+    bulk = [(download.station.net, download.station.name, download.station.loc,
+             download.station.ch+'*', download.pick.ti, download.pick.tf)
+            for download in chunk]
+    for client in clients:
+        slot = limits.slot(client) if limits is not None else nullcontext()
+        try:
+            with slot, profiling.stage('fdsn_bulk_request'):
+                st = client.get_waveforms_bulk(bulk)
+        except (FDSNException, FDSNNoDataException, FDSNBadGatewayException):
+            profiling.count('fdsn_errors')
+            continue
+        profiling.count('bulk_requests')
+        for download in chunk:
+            download.take_from_bulk(st)
+        return
+    print(f'\n\tBulk request of {len(chunk)} windows failed, requesting them one by one')
+
+
+def download_event_window(download):
+    """
+    Download (or load if already downloaded) an event window. Returns the
+    download, None if it could not be downloaded or failed the SNR check
+    """
+    # checking if the mseed exist
+    mseed_exists = download.mseed_exists()
+    # if the mseed already exists continue to the next waveform
+    if ic(mseed_exists):
+        download.load_stream()
+        return download
+
+    success = download.get_wf_stream()
+    # checking if there was no FDSNExeption
+    if ic(not success):
+        return None
+    download.trim_and_merge()
+
+    # if the snr is too low and have a lot of peaks continue
+    # with the next waveform
+    with profiling.stage('snr_check'):
+        noisy_waveform = PurgeSNR(download).purge_waveform()
+    if ic(noisy_waveform):
+        profiling.count('rejected_snr')
+        return None
+
+    ic(download.wf_path)
+    # writing the mseed file
+    download.write()
+    return download
+
+
+def noise_window(event_download, station, clients, limits=None):
+    """
+    Noise-only window with the same duration as the event window, ending a
+    few seconds before the pick time (None for an empty event window)
     """
     duration = event_download.pick.tf - event_download.pick.ti
     if duration <= 0:
@@ -386,8 +534,13 @@ def download_noise_window(event_download, station, clients):
     wf_id = f'{noise_event_id}.{station.name}.{station.loc}.{station.ch}'
     wf_id += f'_{noise_tf.strftime("%Y%m%dT%H%M%S")}'
     noise_waveform = Waveform(noise_tf, wf_id, noise_event_id, noise_ti, noise_tf)
-    noise_download = DownloadWaveform(noise_waveform, station, clients)
+    return DownloadWaveform(noise_waveform, station, clients, limits)
 
+
+def download_noise_window(noise_download):
+    """
+    Download (or load if already downloaded) a noise window
+    """
     if noise_download.mseed_exists():
         noise_download.load_stream()
         return noise_download
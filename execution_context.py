@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+Execution context of a station phase study
+
+The context travels explicitly from picker_tuner through bayes_optuna and the
+objectives into StaLta and the pool workers. current_exc.txt is only kept as
+a compatibility shim for StaLta objects built without a context.
+"""
+from dataclasses import asdict, dataclass, fields
+from trial_cache import DEFAULT_MAX_ENTRIES
+
+CURRENT_EXC_PATH = 'current_exc.txt'
+
+
+@dataclass(frozen=True)
+class ExecutionContext:
+    times_file: str
+    picks_dir: str
+    inv_xml: str
+    debug: bool
+    net: str
+    ch: str
+    loc: str
+    sta: str
+    engine: str = 'scautopick'
+    trial_cache: str = ''
+    trial_cache_size: int = DEFAULT_MAX_ENTRIES
+    batch_playback: bool = False
+    profile: bool = False
+
+    @property
+    def exc_params(self):
+        """
+        Values as StaLta attributes, with the names and string values of
+        current_exc.txt
+        """
+        params = {key: str(value) for key, value in asdict(self).items()}
+        params['_debug'] = params.pop('debug')
+        return params
+
+    @classmethod
+    def from_exc_params(cls, params: dict):
+        values = dict(params)
+        values['debug'] = str(values.pop('_debug', False)) in ['true', 'True', 'TRUE']
+        for key in ('batch_playback', 'profile'):
+            if key in values:
+                values[key] = str(values[key]) in ['true', 'True', 'TRUE']
+        if 'trial_cache_size' in values:
+            values['trial_cache_size'] = int(values['trial_cache_size'])
+        names = {field.name for field in fields(cls)}
+        return cls(**{key: value for key, value in values.items() if key in names})
+
+    @classmethod
+    def from_file(cls, path=CURRENT_EXC_PATH):
+        """
+        Read a context written by write (current_exc.txt)
+        """
+        return cls.from_exc_params(read_exc_file(path))
+
+    def write(self, path=CURRENT_EXC_PATH):
+        """
+        Write the context in the current_exc.txt format
+        """
+        with open(path, 'w') as f:
+            for key, value in self.exc_params.items():
+                f.write(f"{key} = {value}\n")
+
+
+def read_exc_file(path=CURRENT_EXC_PATH):
+    """function that reads the key = value lines of current_exc.txt
+    """
+    with open(path, 'r') as f:
+        lines = f.readlines()
+    dic = {}
+    for line in lines:
+        line = line.strip('\n').strip(' ')
+        if line == '' or '=' not in line:
+            continue
+        key, value = line.split('=', 1)
+        dic[key.strip()] = value.strip()
+    return dic
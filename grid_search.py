@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+Coarse-to-fine grid search of the picker parameters
+
+The discrete search space of OPTIMIZATION_PARAMS is first evaluated on a
+coarse grid (every grid_stride steps of each parameter), then on the full
+resolution grid around the grid_top best coarse points. Evaluations run
+with the numpy engine: the parameter sets sharing a band (p_fmin, p_fmax or
+s_fmin, s_fmax) go to the same worker task, which filters each waveform once
+for all of them. The results are added to an optuna study so PlotWrite
+writes the same plots, CSVs and station files as the Bayesian search.
+"""
+import itertools
+import math
+from collections import defaultdict
+
+import optuna
+
+import numpy_picker
+from config_params import DEFAULT_VALUES, OPTIMIZATION_PARAMS
+from optimizer import (PlotWrite, invalid_space, is_pick_metric, score_counts,
+                       score_pick_counts)
+from stalta import (BinaryTransform, StaLta, StationDataset, add_counts,
+                    interval_counts)
+
+# Band parameters of each phase: parameter sets sharing them share a task
+BAND_PARAMS = {'P': ('p_fmin', 'p_fmax'), 'S': ('s_fmin', 's_fmax')}
+
+
+def grid_values(config: dict, stride: int = 1) -> list:
+    """
+    Values of a parameter every stride steps, from its min to its max
+    """
+    step = config['step'] * max(1, int(stride))
+    n = int(math.floor((config['max'] - config['min']) / step + 1e-9))
+    values = [config['min'] + k * step for k in range(n + 1)]
+    if config['type'] == 'int':
+        return [int(round(v)) for v in values]
+    return [round(float(v), 6) for v in values]
+
+
+def grid_spaces(phase: str, values: dict) -> list:
+    """
+    Valid parameter sets of the product of the values of each parameter
+    """
+    names = list(OPTIMIZATION_PARAMS[phase])
+    spaces = (dict(zip(names, combo))
+              for combo in itertools.product(*(values[name] for name in names)))
+    return [space for space in spaces if not invalid_space(phase, space)]
+
+
+def coarse_spaces(phase: str, stride: int) -> list:
+    return grid_spaces(phase, {name: grid_values(config, stride)
+                               for name, config in OPTIMIZATION_PARAMS[phase].items()})
+
+
+def fine_spaces(phase: str, center: dict, stride: int) -> list:
+    """
+    Full resolution grid within stride - 1 steps of center
+    """
+    values = {}
+    for name, config in OPTIMIZATION_PARAMS[phase].items():
+        span = (max(1, int(stride)) - 1) * config['step']
+        values[name] = [v for v in grid_values(config)
+                        if abs(v - center[name]) <= span + 1e-9]
+    return grid_spaces(phase, values)
+
+
+def space_key(space: dict) -> tuple:
+    return tuple(sorted(space.items()))
+
+
+def _grid_task(task):
+    """
+    Sample and pick level counts of every parameter set of a band on all
+    the waveforms of a times file. Runs in a pool worker, where the
+    waveforms stay loaded between tasks
+    """
+    state, spaces = task
+    phase = state['phase']
+    fixed = dict(DEFAULT_VALUES)
+    fixed.update(state['fixed'])
+    spaces = [dict(fixed, **space) for space in spaces]
+    band_pick_times = {'P': numpy_picker.band_p_pick_times,
+                       'S': numpy_picker.band_s_pick_times}[phase]
+
+    sample_counts = [{'tp': 0, 'fp': 0, 'fn': 0, 'tn': 0} for _ in spaces]
+    pick_counts = [{'tp': 0, 'fp': 0, 'fn': 0} for _ in spaces]
+    for record in StationDataset.load(state['times_file']).records:
+        wf = numpy_picker.load_waveform(record.wf_path, state['ch'])
+        # parameter sets with the same picks share their counts
+        counted = {}
+        for k, pick_times in enumerate(band_pick_times(wf, spaces)):
+            key = tuple(float(t) for t in pick_times)
+            if key not in counted:
+                pred = BinaryTransform(record.wf_start_time, record.sample_rate,
+                                       record.npts, pick_times)
+                counted[key] = (
+                    interval_counts(record.obs_intervals, pred.intervals(), record.npts),
+                    StaLta._match_pick_times(record.ph_time, pick_times, BinaryTransform.unc),
+                )
+            add_counts(sample_counts[k], counted[key][0])
+            add_counts(pick_counts[k], counted[key][1])
+    return list(zip(sample_counts, pick_counts))
+
+
+class GridSearch:
+    """
+    Coarse-to-fine grid search of a station phase with the numpy engine
+    """
+    def __init__(self, phase, metric='f1', pool=None, context=None, stride=2, top=3):
+        self.phase = phase
+        self.metric = metric
+        self.pool = pool
+        self.stride = max(1, int(stride))
+        self.top = max(1, int(top))
+        self.stalta = StaLta(pool=pool, context=context)
+        self.fixed = self.stalta.best_p_params if phase == 'S' else {}
+        # score of every evaluated parameter set, keyed by space_key
+        self.scores = {}
+
+    @property
+    def state(self):
+        return {'phase': self.phase, 'times_file': self.stalta.times_file,
+                'ch': self.stalta.ch, 'fixed': self.fixed}
+
+    def score(self, counts):
+        sample_counts, pick_counts = counts
+        if is_pick_metric(self.metric):
+            return score_pick_counts(self.metric, pick_counts)
+        return score_counts(self.metric, sample_counts)
+
+    def evaluate(self, spaces: list):
+        """
+        Score the parameter sets not evaluated yet, one task per band
+        """
+        bands = defaultdict(list)
+        for space in spaces:
+            if space_key(space) not in self.scores:
+                bands[tuple(space[name] for name in BAND_PARAMS[self.phase])].append(space)
+        groups = list(bands.values())
+        tasks = [(self.state, group) for group in groups]
+        if self.pool is not None:
+            results = self.pool.start(self.stalta.times_file).map(_grid_task, tasks)
+        else:
+            results = map(_grid_task, tasks)
+        for group, counts in zip(groups, results):
+            for space, space_counts in zip(group, counts):
+                self.scores[space_key(space)] = self.score(space_counts)
+
+    def best(self, n):
+        ranked = sorted(((score, key) for key, score in self.scores.items()
+                         if not math.isnan(score)), reverse=True)
+        return [dict(key) for _, key in ranked[:n]]
+
+    def run(self):
+        coarse = coarse_spaces(self.phase, self.stride)
+        print(f'\n\tGrid search {self.phase}: {len(coarse)} coarse parameter sets\n')
+        self.evaluate(coarse)
+        if self.stride > 1:
+            fine = []
+            for center in self.best(self.top):
+                fine.extend(fine_spaces(self.phase, center, self.stride))
+            n_before = len(self.scores)
+            self.evaluate(fine)
+            print(f'\n\tGrid search {self.phase}: {len(self.scores) - n_before} '
+                  f'fine parameter sets\n')
+        return self.study()
+
+    def study(self):
+        """
+        Optuna study with one finished trial per evaluated parameter set
+        """
+        distributions = {}
+        for name, config in OPTIMIZATION_PARAMS[self.phase].items():
+            if config['type'] == 'int':
+                distributions[name] = optuna.distributions.IntDistribution(
+                    config['min'], config['max'], step=config['step'])
+            else:
+                distributions[name] = optuna.distributions.FloatDistribution(
+                    config['min'], config['max'], step=config['step'])
+        study = optuna.create_study(direction='maximize')
+        study.add_trials([
+            optuna.trial.create_trial(params=dict(key), distributions=distributions,
+                                      value=score)
+            for key, score in self.scores.items() if not math.isnan(score)
+        ])
+        return study
+
+
+def grid_search(net, sta, loc, ch, phase, pool=None, metric='f1', context=None,
+                stride=2, top=3):
+    """Run the grid search of a station phase maximizing metric and write its
+    results like bayes_optuna"""
+    print(f'\n\n\t\t\t\033[92m{net}.{sta} - {phase} (grid search)\033[0m\n')
+    study = GridSearch(phase, metric, pool, context, stride, top).run()
+    plot_and_write = PlotWrite(net, sta, loc, ch, phase, study)
+    plot_and_write.plot_and_write()
+    return study
@@ -0,0 +1,562 @@
+# -*- coding: utf-8 -*-
+"""
+In-process NumPy emulation of the scautopick detector
+
+Reproduces the filter chain rendered from config_params.CONFIG_PARAM_TEMPLATES
+(RMHP >> ITAPER >> BW >> STALTA), the trigOn/trigOff logic, the AIC onset
+refinement (picker.AIC) and the S-AIC secondary picker (spicker.AIC) on
+waveform arrays loaded once per process, so optimization trials do not need
+to spawn scautopick.
+"""
+import re
+from collections import OrderedDict
+import numpy as np
+import obspy
+from scipy.signal import butter, lfilter, sosfilt
+from config_params import render_config_param_templates
+
+# Phases the engine can pick. Other phases fall back to scautopick.
+SUPPORTED_PHASES = ('P', 'S')
+
+# scautopick defaults for thresholds.initTime and thresholds.deadTime (seconds)
+INIT_TIME = 60.0
+DEAD_TIME = 30.0
+
+# Window (seconds, relative to the trigger) searched by the AIC re-picker
+AIC_SIGNAL_BEGIN = -5.0
+AIC_SIGNAL_END = 5.0
+
+# Window (seconds, relative to the P onset) searched by the S-AIC picker
+S_SIGNAL_BEGIN = 0.5
+S_SIGNAL_END = 20.0
+
+# Rendered parameters that define the P picks, used to cache P onsets
+P_PICKER_KEYS = ('detecFilter', 'trigOn', 'trigOff', 'picker.AIC.filter',
+                 'picker.AIC.minSNR')
+
+# Maximum distance (seconds) between an engine pick and a scautopick pick to
+# pair them during validation
+VALIDATION_TOLERANCE = 1.0
+
+_FILTER_RE = re.compile(r'^\s*([A-Z_]+)\s*(?:\(([^)]*)\))?\s*$')
+
+# Memory (bytes) of the waveforms kept loaded in a process. The least
+# recently used ones are dropped beyond it
+MAX_WAVEFORM_BYTES = 1 << 30
+
+# P onsets and AIC re-picks kept per waveform
+MAX_PICK_ENTRIES = 4096
+
+
+class LRUCache(OrderedDict):
+    """
+    Dict dropping its least recently used entries beyond max_entries
+    """
+    def __init__(self, max_entries: int):
+        super().__init__()
+        self.max_entries = max_entries
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        while len(self) > self.max_entries:
+            self.popitem(last=False)
+
+
+# Waveforms already loaded in this process, keyed by path, least recently
+# used first
+_WAVEFORMS = OrderedDict()
+
+
+class WaveformArrays:
+    """
+    Components of a waveform file as float64 arrays sharing a start time
+    """
+    def __init__(self, start: float, sampling_rate: float, components: dict):
+        self.start = start
+        self.sampling_rate = sampling_rate
+        self.components = components
+        # P onsets already computed for this waveform, keyed by P_PICKER_KEYS values
+        self.p_onsets = LRUCache(MAX_PICK_ENTRIES)
+        # AIC onsets and SNRs of the triggers, keyed by AIC filter and trigger
+        self.repicks = LRUCache(MAX_PICK_ENTRIES)
+
+    @property
+    def nbytes(self):
+        return sum(data.nbytes for data in self.components.values())
+
+    @property
+    def vertical(self):
+        """
+        Return the vertical component, or the first one if there is none
+        """
+        if 'Z' in self.components:
+            return self.components['Z']
+        return next(iter(self.components.values()))
+
+    @property
+    def horizontals(self):
+        """
+        Return the horizontal components (N/E or 1/2)
+        """
+        return [data for comp, data in sorted(self.components.items()) if comp != 'Z']
+
+
+def load_waveform(wf_path: str, ch: str) -> WaveformArrays:
+    """
+    Read a waveform file once per process and keep its components in memory,
+    up to MAX_WAVEFORM_BYTES of waveforms
+    """
+    if wf_path in _WAVEFORMS:
+        _WAVEFORMS.move_to_end(wf_path)
+        return _WAVEFORMS[wf_path]
+
+    st = obspy.read(wf_path)
+    st.merge(fill_value='interpolate')
+    selected = st.select(channel=f'{ch}*') or st
+    start = min(tr.stats.starttime for tr in selected)
+    components = {}
+    sampling_rate = selected[0].stats.sampling_rate
+    for tr in selected:
+        # align every component on the common start time
+        offset = int(round((tr.stats.starttime - start) * sampling_rate))
+        data = np.asarray(tr.data, dtype=np.float64)
+        if offset > 0:
+            data = np.concatenate([np.zeros(offset), data])
+        components.setdefault(tr.stats.channel[-1], data)
+
+    wf = WaveformArrays(float(start.timestamp), sampling_rate, components)
+    _WAVEFORMS[wf_path] = wf
+    # keep the waveform just loaded even if it is over the budget alone
+    while len(_WAVEFORMS) > 1 and loaded_bytes() > MAX_WAVEFORM_BYTES:
+        _WAVEFORMS.popitem(last=False)
+    return wf
+
+
+def loaded_bytes() -> int:
+    """
+    Memory of the waveforms loaded in this process
+    """
+    return sum(wf.nbytes for wf in _WAVEFORMS.values())
+
+
+def release_waveforms(wf_paths):
+    """
+    Forget the loaded waveforms (and their onsets) of wf_paths
+    """
+    for wf_path in wf_paths:
+        _WAVEFORMS.pop(wf_path, None)
+
+
+def parse_filter_chain(filter_str: str) -> list:
+    """
+    Parse a SeisComP filter string like 'ITAPER(30)>>BW(4,2,8)' into a list
+    of (name, args) tuples
+    """
+    chain = []
+    for token in filter_str.strip().strip('"').split('>>'):
+        match = _FILTER_RE.match(token)
+        if match is None:
+            raise ValueError(f'Invalid filter expression: {token!r}')
+        name, args = match.groups()
+        if name not in FILTERS:
+            raise ValueError(f'Filter {name} is not supported by the numpy engine')
+        values = [float(a) for a in args.split(',')] if args else []
+        chain.append((name, values))
+    return chain
+
+
+def running_mean(x, n: int):
+    """
+    Causal recursive mean as used by SeisComP's RMHP and STALTA filters:
+    a cumulative mean over the first n samples and an exponential average
+    with weight 1/n afterwards.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    n = max(int(n), 1)
+    out = np.empty_like(x)
+    head = min(n, len(x))
+    out[:head] = np.cumsum(x[:head]) / np.arange(1, head + 1)
+    if head < len(x):
+        alpha = 1.0 / n
+        zi = [(1.0 - alpha) * out[head - 1]]
+        out[head:], _ = lfilter([alpha], [1.0, alpha - 1.0], x[head:], zi=zi)
+    return out
+
+
+def rmhp(x, sampling_rate, length):
+    return x - running_mean(x, round(length * sampling_rate))
+
+
+def itaper(x, sampling_rate, length):
+    n = min(int(round(length * sampling_rate)), len(x))
+    if n <= 0:
+        return x
+    x = x.copy()
+    x[:n] *= 0.5 * (1.0 - np.cos(np.pi * np.arange(n) / n))
+    return x
+
+
+def butterworth(x, sampling_rate, order, fmin=None, fmax=None):
+    """
+    Causal Butterworth filter built, like SeisComP's BW filters, as a cascade
+    of a high-pass and a low-pass section of the given order
+    """
+    nyquist = 0.5 * sampling_rate
+    sections = []
+    if fmin is not None and 0 < fmin < nyquist:
+        sections.append(butter(int(order), fmin, 'highpass', fs=sampling_rate, output='sos'))
+    if fmax is not None and 0 < fmax < nyquist:
+        sections.append(butter(int(order), fmax, 'lowpass', fs=sampling_rate, output='sos'))
+    if not sections:
+        return x
+    return sosfilt(np.vstack(sections), x)
+
+
+def stalta(x, sampling_rate, sta, lta):
+    abs_x = np.abs(x)
+    sta_ = running_mean(abs_x, round(sta * sampling_rate))
+    lta_ = running_mean(abs_x, round(lta * sampling_rate))
+    ratio = np.zeros_like(sta_)
+    np.divide(sta_, lta_, out=ratio, where=lta_ > 0)
+    return ratio
+
+
+FILTERS = {
+    'RMHP': lambda x, sr, args: rmhp(x, sr, *args),
+    'ITAPER': lambda x, sr, args: itaper(x, sr, *args),
+    'BW': lambda x, sr, args: butterworth(x, sr, args[0], args[1], args[2]),
+    'BW_HP': lambda x, sr, args: butterworth(x, sr, args[0], fmin=args[1]),
+    'BW_LP': lambda x, sr, args: butterworth(x, sr, args[0], fmax=args[1]),
+    'STALTA': lambda x, sr, args: stalta(x, sr, *args),
+}
+
+
+def apply_filter_chain(data, sampling_rate: float, chain: list):
+    """
+    Apply a parsed filter chain to a waveform array
+    """
+    x = np.asarray(data, dtype=np.float64)
+    for name, args in chain:
+        x = FILTERS[name](x, sampling_rate, args)
+    return x
+
+
+def trigger_onsets(ratio, trig_on: float, trig_off: float, sampling_rate: float,
+                   init_time: float = INIT_TIME, dead_time: float = DEAD_TIME):
+    """
+    Sample indices where the detector triggers.
+
+    A trigger happens when the ratio rises to trig_on. The detector is armed
+    again only after the ratio falls below trig_off and dead_time has passed.
+    """
+    ratio = np.asarray(ratio)
+    if len(ratio) == 0:
+        return np.array([], dtype=int)
+    above = ratio >= trig_on
+    above[:int(init_time * sampling_rate)] = False
+    rising = np.flatnonzero(above[1:] & ~above[:-1]) + 1
+    if above[0]:
+        rising = np.concatenate([[0], rising])
+
+    below = ratio < trig_off
+    dead = int(dead_time * sampling_rate)
+    onsets = []
+    for idx in rising:
+        if onsets:
+            last = onsets[-1]
+            if idx < last + dead or not below[last:idx].any():
+                continue
+        onsets.append(idx)
+    return np.array(onsets, dtype=int)
+
+
+def aic(x):
+    """
+    Maeda's AIC of a window: k*log(var(x[:k])) + (n-k-1)*log(var(x[k:]))
+    for every split point k, computed with cumulative sums
+    """
+    x = np.asarray(x, dtype=np.float64)
+    n = len(x)
+    if n < 4:
+        return np.full(n, np.inf)
+    k = np.arange(1, n - 1)
+    c1 = np.cumsum(x)
+    c2 = np.cumsum(x * x)
+    var1 = c2[k - 1] / k - (c1[k - 1] / k) ** 2
+    tail = n - k
+    var2 = (c2[-1] - c2[k - 1]) / tail - ((c1[-1] - c1[k - 1]) / tail) ** 2
+    tiny = np.finfo(np.float64).tiny
+    out = np.full(n, np.inf)
+    out[k] = k * np.log(np.maximum(var1, tiny)) + (tail - 1) * np.log(np.maximum(var2, tiny))
+    return out
+
+
+def aic_snr(x, onset):
+    """
+    Peak amplitude after the onset over the RMS before it
+    """
+    noise = x[:onset]
+    signal = x[onset:]
+    if len(noise) == 0 or len(signal) == 0:
+        return 0.0
+    rms = np.sqrt(np.mean(noise * noise))
+    if rms == 0:
+        return np.inf
+    return float(np.max(np.abs(signal)) / rms)
+
+
+def _window(npts, sampling_rate, ref, begin, end):
+    i0 = max(int(ref + begin * sampling_rate), 0)
+    i1 = min(int(ref + end * sampling_rate), npts)
+    return i0, i1
+
+
+class NumpyPicker:
+    """
+    scautopick detector, AIC re-picker and S-AIC picker emulation for one
+    parameter set
+    """
+    def __init__(self, params: dict):
+        rendered = render_config_param_templates(params)
+        self.detec_chain = parse_filter_chain(rendered['detecFilter'])
+        self.trig_on = float(rendered['trigOn'])
+        self.trig_off = float(rendered['trigOff'])
+        self.time_corr = float(rendered['timeCorr'])
+        self.aic_chain = parse_filter_chain(rendered['picker.AIC.filter'])
+        self.aic_min_snr = float(rendered['picker.AIC.minSNR'])
+        self.p_key = tuple(rendered[key] for key in P_PICKER_KEYS)
+        if 'spicker.AIC.filter' in rendered:
+            self.s_chain = parse_filter_chain(rendered['spicker.AIC.filter'])
+            self.s_step = float(rendered['spicker.AIC.step'])
+            self.s_min_cnt = int(float(rendered['spicker.AIC.minCnt']))
+            self.s_min_snr = float(rendered['spicker.AIC.minSNR'])
+
+    def detect(self, wf: WaveformArrays):
+        """
+        Return the trigger sample indices on the vertical component
+        """
+        ratio = apply_filter_chain(wf.vertical, wf.sampling_rate, self.detec_chain)
+        return trigger_onsets(ratio, self.trig_on, self.trig_off, wf.sampling_rate)
+
+    def repick(self, wf: WaveformArrays, trigger: int):
+        """
+        Refine a trigger with the AIC picker. Return the onset sample index,
+        or None if the pick SNR is below picker.AIC.minSNR
+        """
+        found = aic_repick(wf, trigger, self.aic_chain)
+        if found is None or found[1] < self.aic_min_snr:
+            return None
+        return found[0]
+
+    def p_onsets(self, wf: WaveformArrays):
+        """
+        Return the AIC refined P onsets, computed once per waveform and P
+        parameter set
+        """
+        if self.p_key not in wf.p_onsets:
+            onsets = [self.repick(wf, trigger) for trigger in self.detect(wf)]
+            wf.p_onsets[self.p_key] = [onset for onset in onsets if onset is not None]
+        return wf.p_onsets[self.p_key]
+
+    def s_pick(self, wf: WaveformArrays, p_onset: int):
+        """
+        S-AIC picker: the AIC of the L2 norm of the filtered horizontals is
+        computed on windows whose start moves by spicker.AIC.step after the P
+        onset. The pick is kept once the same onset is found
+        spicker.AIC.minCnt times in a row and its SNR reaches
+        spicker.AIC.minSNR.
+        """
+        found = s_aic_pick(wf, p_onset, self.s_chain, self.s_step, self.s_min_cnt)
+        if found is None or found[1] < self.s_min_snr:
+            return None
+        return found[0]
+
+    def pick_times(self, wf: WaveformArrays, phase: str):
+        """
+        Return the pick times of the given phase as UTCDateTime objects
+        """
+        if phase not in SUPPORTED_PHASES:
+            raise ValueError(f'The numpy engine cannot pick {phase} phases')
+        onsets = self.p_onsets(wf)
+        if phase == 'P':
+            return [obspy.UTCDateTime(wf.start + idx / wf.sampling_rate + self.time_corr)
+                    for idx in onsets]
+        s_onsets = [self.s_pick(wf, onset) for onset in onsets]
+        return [obspy.UTCDateTime(wf.start + idx / wf.sampling_rate)
+                for idx in s_onsets if idx is not None]
+
+
+def aic_repick(wf: WaveformArrays, trigger: int, chain: list):
+    """
+    AIC onset of a trigger and its SNR, None if the window is too short.
+    Computed once per waveform, trigger and AIC filter
+    """
+    key = (tuple((name, tuple(args)) for name, args in chain), int(trigger))
+    if key not in wf.repicks:
+        data = wf.vertical
+        i0, i1 = _window(len(data), wf.sampling_rate, trigger, AIC_SIGNAL_BEGIN, AIC_SIGNAL_END)
+        x = apply_filter_chain(data[i0:i1], wf.sampling_rate, chain)
+        found = None
+        if len(x) >= 4:
+            onset = int(np.argmin(aic(x)))
+            found = (i0 + onset, aic_snr(x, onset))
+        wf.repicks[key] = found
+    return wf.repicks[key]
+
+
+def s_aic_pick(wf: WaveformArrays, p_onset: int, chain: list, step_seconds: float,
+               min_cnt: int):
+    """
+    S-AIC onset after a P onset and its SNR, None if no onset is found
+    min_cnt times in a row
+    """
+    horizontals = wf.horizontals
+    if not horizontals:
+        return None
+    npts = min(len(h) for h in horizontals)
+    i0, i1 = _window(npts, wf.sampling_rate, p_onset, S_SIGNAL_BEGIN, S_SIGNAL_END)
+    if i1 - i0 < 4:
+        return None
+    l2 = np.sqrt(sum(
+        apply_filter_chain(h[i0:i1], wf.sampling_rate, chain) ** 2
+        for h in horizontals
+    ))
+
+    step = max(int(step_seconds * wf.sampling_rate), 1)
+    last = None
+    count = 0
+    for start in range(0, len(l2) // 2, step):
+        onset = start + int(np.argmin(aic(l2[start:])))
+        if last is not None and abs(onset - last) <= step:
+            count += 1
+        else:
+            count = 1
+        last = onset
+        if count >= min_cnt:
+            return i0 + onset, aic_snr(l2, onset)
+    return None
+
+
+def band_p_pick_times(wf: WaveformArrays, spaces: list):
+    """
+    P pick times of wf for parameter spaces sharing the detector band
+    (p_fmin, p_fmax). The band is filtered once, each STA and LTA length is
+    averaged once and each trigger is re-picked once for all the spaces
+    """
+    pickers = [NumpyPicker(space) for space in spaces]
+    prefix = pickers[0].detec_chain[:-1]
+    if pickers[0].detec_chain[-1][0] != 'STALTA':
+        raise ValueError('The detector filter must end with STALTA')
+    abs_x = np.abs(apply_filter_chain(wf.vertical, wf.sampling_rate, prefix))
+    means = {}
+    ratios = {}
+    triggers = {}
+    times = []
+    for picker in pickers:
+        sta, lta = picker.detec_chain[-1][1]
+        if (sta, lta) not in ratios:
+            for length in (sta, lta):
+                n = round(length * wf.sampling_rate)
+                if n not in means:
+                    means[n] = running_mean(abs_x, n)
+            sta_ = means[round(sta * wf.sampling_rate)]
+            lta_ = means[round(lta * wf.sampling_rate)]
+            ratio = np.zeros_like(sta_)
+            np.divide(sta_, lta_, out=ratio, where=lta_ > 0)
+            ratios[(sta, lta)] = ratio
+        key = (sta, lta, picker.trig_on, picker.trig_off)
+        if key not in triggers:
+            triggers[key] = trigger_onsets(ratios[(sta, lta)], picker.trig_on,
+                                           picker.trig_off, wf.sampling_rate)
+        onsets = []
+        for trigger in triggers[key]:
+            found = aic_repick(wf, trigger, picker.aic_chain)
+            if found is not None and found[1] >= picker.aic_min_snr:
+                onsets.append(found[0])
+        times.append([obspy.UTCDateTime(wf.start + idx / wf.sampling_rate + picker.time_corr)
+                      for idx in onsets])
+    return times
+
+
+def band_s_pick_times(wf: WaveformArrays, spaces: list):
+    """
+    S pick times of wf for parameter spaces sharing the S-AIC band
+    (s_fmin, s_fmax) and the P parameters. The S onset of every P onset is
+    searched once and only the SNR threshold changes between the spaces
+    """
+    pickers = [NumpyPicker(space) for space in spaces]
+    p_onsets = pickers[0].p_onsets(wf)
+    found = {}
+    times = []
+    for picker in pickers:
+        key = (picker.s_step, picker.s_min_cnt)
+        if key not in found:
+            found[key] = [s_aic_pick(wf, onset, picker.s_chain, *key) for onset in p_onsets]
+        times.append([obspy.UTCDateTime(wf.start + s[0] / wf.sampling_rate)
+                      for s in found[key] if s is not None and s[1] >= picker.s_min_snr])
+    return times
+
+
+def match_pick_times(reference_times, pick_times, tolerance_seconds):
+    """
+    One-to-one greedy matching of pick times against reference pick times.
+    Returns the time residuals (pick - reference) of the matched pairs
+    """
+    ref = sorted(float(t) for t in reference_times)
+    picks = sorted(float(t) for t in pick_times)
+
+    i = 0
+    j = 0
+    residuals = []
+    while i < len(ref) and j < len(picks):
+        dt = picks[j] - ref[i]
+        if abs(dt) <= tolerance_seconds:
+            residuals.append(dt)
+            i += 1
+            j += 1
+        elif picks[j] < ref[i] - tolerance_seconds:
+            j += 1
+        else:
+            i += 1
+    return residuals
+
+
+def compare_pick_times(reference_times, engine_times,
+                       tolerance_seconds=VALIDATION_TOLERANCE):
+    """
+    Pair engine picks with reference (scautopick) picks one to one and return
+    the time residuals (engine - reference) and the unmatched counts.
+    """
+    residuals = match_pick_times(reference_times, engine_times, tolerance_seconds)
+    return {
+        'residuals': residuals,
+        'only_reference': len(reference_times) - len(residuals),
+        'only_engine': len(engine_times) - len(residuals),
+    }
+
+
+def summarize_validation(rows: list) -> dict:
+    """
+    Aggregate per-waveform comparisons built by compare_pick_times
+    """
+    residuals = np.array([r for row in rows for r in row['residuals']])
+    summary = {
+        'waveforms': len(rows),
+        'matched': len(residuals),
+        'only_reference': sum(row['only_reference'] for row in rows),
+        'only_engine': sum(row['only_engine'] for row in rows),
+        'mean': 0.0,
+        'median_abs': 0.0,
+        'max_abs': 0.0,
+    }
+    if len(residuals):
+        summary['mean'] = float(np.mean(residuals))
+        summary['median_abs'] = float(np.median(np.abs(residuals)))
+        summary['max_abs'] = float(np.max(np.abs(residuals)))
+    return summary
@@ -6,11 +6,17 @@ Created on Sep 2, 2021
 Application of bayesian optimization using optuna package
 """
 from dataclasses import dataclass
+from functools import partial
 import optuna
 import plotly
 #from sc3autotuner import read_params
 from sklearn.metrics import precision_score, recall_score, roc_auc_score, fbeta_score
-from stalta import StaLta
+from stalta import StaLta, EvaluationPool
+import profiling
+from campaign import file_lock
+from study_storage import (StudyStorage, max_trials_callback, print_resume,
+                           study_name, trials_target)
+from warm_start import print_warm_start
 import pandas as pd
 import os
 from icecream import ic
@@ -24,13 +30,26 @@ METRICS = {
     'roc': roc_auc_score,
 }
 
+# prefix of the metrics computed from matched picks instead of samples
+PICK_METRIC_PREFIX = 'pick_'
 
-def suggest_value(trial, param_name, config):
+
+def param_bounds(config, space=None):
+    """Range of a parameter given the values already sampled in space. A
+    parameter 'above' another one starts one step over its value"""
+    low = config['min']
+    if 'above' in config and space is not None:
+        low = max(low, space[config['above']] + config['step'])
+    return low, config['max']
+
+
+def suggest_value(trial, param_name, config, space=None):
     """Helper function to suggest values based on parameter type"""
+    low, high = param_bounds(config, space)
     if config['type'] == 'int':
-        return trial.suggest_int(param_name, config['min'], config['max'], step=config['step'])
+        return trial.suggest_int(param_name, low, high, step=config['step'])
     elif config['type'] == 'float':
-        return trial.suggest_float(param_name, config['min'], config['max'], step=config['step'])
+        return trial.suggest_float(param_name, low, high, step=config['step'])
     else:
         raise ValueError(f"Unknown parameter type: {config['type']}")
 
@@ -43,61 +62,270 @@ def score_metric(metric, y_obs, y_pred):
     return METRICS[metric](y_obs, y_pred, average='binary')
 
 
+def _ratio(num, den):
+    # sklearn returns 0 for undefined precision, recall and f-scores
+    return num / den if den else 0.0
+
+
+def score_counts(metric, counts):
+    """Same value as score_metric on the binary series whose sample level
+    tp, fp, fn and tn are given in counts"""
+    tp, fp, fn, tn = counts['tp'], counts['fp'], counts['fn'], counts['tn']
+    if metric == 'roc':
+        # ROC AUC of a binary prediction: the trapezoid through (fpr, tpr)
+        if tp + fn == 0 or fp + tn == 0:
+            return float('nan')
+        return 0.5 * (1 + tp / (tp + fn) - fp / (fp + tn))
+    if metric[0] == 'f':
+        beta2 = float(metric.split('f')[1]) ** 2
+        return _ratio((1 + beta2) * tp, (1 + beta2) * tp + beta2 * fn + fp)
+    if metric == 'pr':
+        return _ratio(tp, tp + fp)
+    if metric == 're':
+        return _ratio(tp, tp + fn)
+    raise ValueError(f'Unknown metric: {metric}')
+
+
+def is_pick_metric(metric):
+    return metric.startswith(PICK_METRIC_PREFIX)
+
+
+def check_metric(metric):
+    """True if metric is one of pr, re, roc, f<beta> or pick_f<beta>"""
+    if is_pick_metric(metric):
+        metric = metric[len(PICK_METRIC_PREFIX):]
+        if metric[:1] != 'f':
+            return False
+    elif metric in ('pr', 're', 'roc'):
+        return True
+    if metric[:1] != 'f':
+        return False
+    try:
+        return float(metric[1:]) > 0
+    except ValueError:
+        return False
+
+
+def score_pick_counts(metric, counts):
+    """F-beta of the one-to-one matched picks (pick_f<beta>). pick_f1 is the
+    F1 of reference_picker.compute_pick_metrics"""
+    beta2 = float(metric[len(PICK_METRIC_PREFIX) + 1:]) ** 2
+    tp, fp, fn = counts['tp'], counts['fp'], counts['fn']
+    return _ratio((1 + beta2) * tp, (1 + beta2) * tp + beta2 * fn + fp)
+
+
+@dataclass
+class PruningSettings:
+    """Pruner of the studies, size of the waveform chunks whose running
+    score is reported to it and number of chunks before a trial can be
+    pruned"""
+    pruner: str = 'none'
+    warmup_chunks: int = 1
+    chunk_size: int = 10
+
+    @property
+    def enabled(self):
+        return self.pruner != 'none'
+
+    def make_pruner(self):
+        """Optuna pruner. Multi-fidelity pruners use the number of evaluated
+        waveforms as resource, starting with one chunk"""
+        if self.pruner == 'median':
+            return optuna.pruners.MedianPruner()
+        if self.pruner == 'hyperband':
+            return optuna.pruners.HyperbandPruner(min_resource=self.chunk_size,
+                                                  max_resource='auto',
+                                                  reduction_factor=3)
+        if self.pruner == 'successive_halving':
+            return optuna.pruners.SuccessiveHalvingPruner(min_resource=self.chunk_size,
+                                                          reduction_factor=3)
+        return optuna.pruners.NopPruner()
+
+    def on_chunk(self, trial, score):
+        """mega_sta_lta callback reporting the running score of trial"""
+        def report(chunk, n_evaluated, sample_counts, pick_counts):
+            value = score(sample_counts, pick_counts)
+            # undefined scores (roc with a single class so far) are not reported
+            if value == value:
+                trial.report(value, step=n_evaluated)
+            if chunk > self.warmup_chunks and trial.should_prune():
+                raise optuna.TrialPruned()
+        return report
+
+
+PRUNERS = ('none', 'median', 'hyperband', 'successive_halving')
+
+
+def score_space(stalta, metric, space, trial=None, pruning=None):
+    """Evaluate a parameter space with the picker and score it. With pruning
+    enabled the running score is reported to the trial after each chunk.
+    With profiling enabled the stages of the evaluation are saved in the
+    'profile' user attribute of the trial (also for pruned trials)"""
+    pick_level = is_pick_metric(metric)
+
+    def score(sample_counts, pick_counts):
+        with profiling.stage('metric'):
+            if pick_level:
+                return score_pick_counts(metric, pick_counts)
+            return score_counts(metric, sample_counts)
+
+    chunks = {}
+    if trial is not None and pruning is not None and pruning.enabled:
+        chunks = {'on_chunk': pruning.on_chunk(trial, score),
+                  'chunk_size': pruning.chunk_size}
+    with profiling.collect(stalta.profiled) as profile:
+        try:
+            if pick_level:
+                # pick level metrics only need the matched pick counts
+                _, pick_counts = stalta.mega_sta_lta(collect_pick_level=True,
+                                                     sample_level=False, **chunks, **space)
+                return score(None, pick_counts)
+            return score(stalta.mega_sta_lta(**chunks, **space), None)
+        finally:
+            if profile is not None and trial is not None:
+                trial.set_user_attr('profile', profile.as_dict())
+
+
 def build_param_space(trial, phase):
-    return {
-        param: suggest_value(trial, param, config)
-        for param, config in OPTIMIZATION_PARAMS[phase].items()
-    }
+    """Sample the parameters of a phase in order, with the conditional
+    ranges of OPTIMIZATION_PARAMS, so every trial is a valid configuration"""
+    space = {}
+    for param, config in OPTIMIZATION_PARAMS[phase].items():
+        space[param] = suggest_value(trial, param, config, space)
+    return space
 
 
 def invalid_space(phase, space):
-    if phase == 'P':
-        return space['p_lta'] <= space['p_sta'] or space['p_fmax'] <= space['p_fmin']
-    return space['s_fmax'] <= space['s_fmin']
+    """True if space breaks the 'above' constraints (only possible for
+    enqueued trials, sampled ones hold them by construction)"""
+    return any(space[param] <= space[config['above']]
+               for param, config in OPTIMIZATION_PARAMS[phase].items()
+               if 'above' in config)
 
 
-def objetive_p(trial, metric='f1'):
+def objetive_p(trial, metric='f1', pool=None, context=None, pruning=None):
     """Función objetivo a minimizar"""
     space = build_param_space(trial, 'P')
     if invalid_space('P', space):
         return 0.0
     space.update({'p_timecorr': DEFAULT_VALUES['p_timecorr']})
 
-    stalta = StaLta()
-    y_obs, y_pred = stalta.mega_sta_lta(**space)
+    stalta = StaLta(pool=pool, context=context)
 
-    return score_metric(metric, y_obs, y_pred)
+    return score_space(stalta, metric, space, trial, pruning)
 
 
-def objective_s(trial, metric='f1'):
-    """Función objetivo a minimizar"""
+def objective_s(trial, metric='f1', pool=None, context=None, pruning=None,
+                best_p=None):
+    """Función objetivo a minimizar. best_p are the best P parameters of
+    the station, loaded once per study (read from results_P.csv if None)"""
     space = build_param_space(trial, 'S')
     if invalid_space('S', space):
         return 0.0
 
-    stalta = StaLta()
-    space.update(stalta.best_p_params)
+    stalta = StaLta(pool=pool, context=context)
+    space.update(best_p if best_p is not None else stalta.best_p_params)
     ic(space)
-    y_obs, y_pred = stalta.mega_sta_lta(**space)
 
-    return score_metric(metric, y_obs, y_pred)
+    return score_space(stalta, metric, space, trial, pruning)
 
 
-def bayes_optuna(net, sta, loc, ch, phase, n_trials=1000):
+def bayes_optuna(net, sta, loc, ch, phase, n_trials=1000, pool=None, metric='f1',
+                 context=None, pruning=None, storage=None, warm_start=None):
+    """Run the study of a station phase maximizing metric. Trials share the
+    given EvaluationPool, or a pool owned by this study if none is given.
+    context is the ExecutionContext of the phase (current_exc.txt if None),
+    pruning the PruningSettings (no pruning if None), storage the
+    StudyStorage where the study is resumed from and saved (in memory if
+    None), warm_start the WarmStart that seeds new studies (None: random
+    start)"""
 
     objective_func = {'P': objetive_p, 'S': objective_s}
     
     ## Print in green color the station and the phase to be analyzed
     print(f'\n\n\t\t\t\033[92m{net}.{sta} - {phase}\033[0m\n')    
     
-    study = optuna.create_study(direction='maximize') #, pruner=optuna.pruners.MedianPruner()
-    study.optimize(objective_func[phase], n_trials=n_trials)
+    own_pool = pool is None
+    if own_pool:
+        pool = EvaluationPool(StaLta(context=context).max_workers)
+    cache = StaLta(context=context).cache
+    cache_start = cache.stats() if cache is not None else None
+    try:
+        pruning = pruning or PruningSettings()
+        storage = storage or StudyStorage()
+        objective = partial(objective_func[phase], metric=metric, pool=pool,
+                            context=context, pruning=pruning)
+        if phase == 'S':
+            # the P half of every S trial is the same: load it once. The numpy
+            # engine also keeps the P onsets of each waveform for these
+            # parameters, so only the S picker runs on each trial
+            objective = partial(objective, best_p=StaLta(context=context).best_p_params)
+        if storage.enabled:
+            sta_lta = StaLta(context=context)
+            name = study_name(net, sta, loc, ch, phase, sta_lta.times_file, metric,
+                              sta_lta.engine, sta_lta.batched)
+            study = optuna.create_study(study_name=name, storage=storage.make(),
+                                        load_if_exists=True, direction='maximize',
+                                        pruner=pruning.make_pruner())
+            target = trials_target(study, n_trials)
+            print_resume(study, target)
+            enqueue_warm_start(study, net, sta, phase, warm_start)
+            study.optimize(objective, n_trials=target,
+                           callbacks=[max_trials_callback(target)])
+        else:
+            study = optuna.create_study(direction='maximize', pruner=pruning.make_pruner())
+            enqueue_warm_start(study, net, sta, phase, warm_start)
+            study.optimize(objective, n_trials=n_trials)
+    finally:
+        if own_pool:
+            pool.shutdown()
+
+    if cache is not None:
+        print_cache_stats(net, sta, phase, cache_start, cache.stats())
+    if StaLta(context=context).profiled:
+        write_study_profile(study, net, sta, loc, phase)
     
     # plotting and writing results in csv file and in config file
     plot_and_write = PlotWrite(net, sta, loc, ch, phase, study)
     plot_and_write.plot_and_write()
 
 
+def enqueue_warm_start(study, net, sta, phase, warm_start=None):
+    """Enqueue the warm start candidates of a station phase in a study
+    without trials (resumed studies are not seeded again)"""
+    if warm_start is None or len(study.trials):
+        return
+    candidates = [params for params in warm_start.candidates(net, sta, phase)
+                  if not invalid_space(phase, params)]
+    for params in candidates:
+        study.enqueue_trial(params)
+    print_warm_start(net, sta, phase, len(candidates))
+
+
+def print_cache_stats(net, sta, phase, start, end):
+    """Print the trial cache hit rate of a study"""
+    hits = end['hits'] - start['hits']
+    lookups = hits + end['misses'] - start['misses']
+    rate = hits / lookups if lookups else 0.0
+    print(f'\n\t{net}.{sta} - {phase} trial cache: {hits}/{lookups} '
+          f'waveform evaluations reused ({rate:.1%} hit rate)\n')
+
+
+def write_study_profile(study, net, sta, loc, phase, profiles_dir=profiling.PROFILES_DIR):
+    """Write the stage profile of the trials of a study in
+    profiles_dir/<net>.<sta>.<loc>_<phase>_profile.json/.csv and print its
+    summary table"""
+    trials = [{'number': trial.number, 'state': trial.state.name, 'value': trial.value,
+               'profile': trial.user_attrs['profile']}
+              for trial in study.trials if 'profile' in trial.user_attrs]
+    if not trials:
+        return
+    profiling.write_profile(os.path.join(profiles_dir, f'{net}.{sta}.{loc}_{phase}_profile'),
+                            trials)
+    print('\n' + profiling.format_summary(f'{net}.{sta} - {phase} trial profile',
+                                           [trial['profile'] for trial in trials]) + '\n')
+
+
 @dataclass
 class CSVData:
     phase: str
@@ -198,18 +426,20 @@ class PlotWrite:
         csv_data = CSVData(self.phase, best_params, self.net, self.sta)
         
         results_file = f'results_{self.phase}.csv'
-        if os.path.exists(results_file):
-            with open(results_file, 'r') as f:
-                existing_header = f.readline()
-            if existing_header != csv_data.header:
-                print(f"\n\tWARNING: {results_file} header mismatch, rewriting with current format.\n")
+        # stations tuned in parallel append to the same file
+        with file_lock(results_file):
+            if os.path.exists(results_file):
+                with open(results_file, 'r') as f:
+                    existing_header = f.readline()
+                if existing_header != csv_data.header:
+                    print(f"\n\tWARNING: {results_file} header mismatch, rewriting with current format.\n")
+                    with open(results_file, 'w') as f:
+                        f.write(csv_data.header)
+            else:
                 with open(results_file, 'w') as f:
                     f.write(csv_data.header)
-        else:
-            with open(results_file, 'w') as f:
-                f.write(csv_data.header)
-        with open(results_file, 'a') as f:
-            f.write(csv_data.values)
+            with open(results_file, 'a') as f:
+                f.write(csv_data.values)
 
     @property
     def config_file_template(self):
@@ -228,8 +458,8 @@ class PlotWrite:
         Write the best params to the station_NET_template config file
         """
         
-        if not os.path.exists(self.out_dir):
-            os.mkdir(self.out_dir)
+        # stations tuned at the same time may create it too
+        os.makedirs(self.out_dir, exist_ok=True)
         
         # get optimized pick params from results_P.csv and results_S.csv
         params_ = self.get_params_from_csv()
@@ -262,7 +492,9 @@ class PlotWrite:
         """
         Get best pick params from results_P.csv or results_S.csv
         """
-        df = pd.read_csv(f'results_{phase}.csv')
+        results_file = f'results_{phase}.csv'
+        with file_lock(results_file):
+            df = pd.read_csv(results_file)
         # selecting the row with net.sta equal to CM.BAR2 and with the highest value of best_f1
         return df[df['net.sta'] == f'{self.net}.{self.sta}'].sort_values(by='best_f1', ascending=False).iloc[0].to_dict()
 
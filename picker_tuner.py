@@ -10,18 +10,31 @@ import sys
 import csv
 import re
 import shlex
-from download_data import Query, Station, waveform_downloader, DirectoryCreator
+import tempfile
+from dataclasses import dataclass
+from functools import partial
+from download_data import (FDSN_SLOTS_PREFIX, Query, Station, waveform_downloader,
+                           DirectoryCreator, EndpointLimits)
 import obspy
 import pandas as pd
-from MySQLdb import OperationalError
-from optimizer import bayes_optuna
+from optimizer import PRUNERS, PruningSettings, bayes_optuna, check_metric
+from grid_search import grid_search
 from reference_picker import (
     ComparisonCollector,
     build_reference_scautopick_xml,
     format_comparison_table,
     resolve_reference_station_file,
 )
-from stalta import StaLta
+from stalta import StaLta, EvaluationPool, release_datasets
+from execution_context import ExecutionContext
+from campaign import file_lock, run_campaign, split_workers
+from study_storage import STORAGES, StudyStorage
+from warm_start import STATION_COORDS_PATH, WarmStart, save_station_coords
+from numpy_picker import SUPPORTED_PHASES, summarize_validation
+from trial_cache import DEFAULT_CACHE_PATH, DEFAULT_MAX_ENTRIES
+import profiling
+from resource_monitor import RESOURCES_DIR, monitor_resources, station_scope
+from worker_autotune import AUTOTUNE_PATH, WorkerAutotuner, available_cpus
 from icecream import ic, install
 ic.configureOutput(prefix='debug| ')  # , includeContext=True)
 install()
@@ -48,6 +61,10 @@ def picker_tuner(cursor, wf_cursor, ti, tf, params):
         Final time to search for thet picks that will be used in the
         bayesian optimization. Format: yyyy-MM-dd hh:mm:ss
     """
+    # only the database queries need the driver, the station pipeline
+    # (tune_station) runs without it
+    from MySQLdb import OperationalError
+
     def parse_float_param(param_name, default_value, missing_message, invalid_message):
         try:
             return float(params[param_name])
@@ -110,6 +127,73 @@ def picker_tuner(cursor, wf_cursor, ti, tf, params):
     download_noise_p = params.get('download_noise_p', False)
     if isinstance(download_noise_p, str):
         download_noise_p = download_noise_p.lower() in ['true', '1', 'yes']
+
+    # engine used to evaluate the trials: scautopick or numpy
+    engine = params.get('engine', 'scautopick').strip().lower()
+    if engine not in ['scautopick', 'numpy']:
+        print(f"\033[91m\n\tWARNING: unknown engine {engine}. Using scautopick\n\033[0m")
+        engine = 'scautopick'
+
+    engine_validation = str(params.get('engine_validation', False)).lower() in ['true', '1', 'yes']
+
+    # objective of the trials: sample level (f1, f<beta>, pr, re, roc) or
+    # pick level (pick_f1, pick_f<beta>)
+    metric = str(params.get('metric', 'f1')).strip().lower()
+    if not check_metric(metric):
+        print(f"\033[91m\n\tWARNING: unknown metric {metric}. Using f1\n\033[0m")
+        metric = 'f1'
+
+    # on-disk cache of scautopick picks shared by all trials and runs
+    trial_cache = ''
+    if str(params.get('trial_cache', False)).lower() in ['true', '1', 'yes']:
+        trial_cache = os.path.join(CWD, DEFAULT_CACHE_PATH)
+    trial_cache_size = params.get('trial_cache_size', DEFAULT_MAX_ENTRIES)
+
+    # pruning of the trials from the running score of waveform chunks
+    pruner = str(params.get('pruner', 'none')).strip().lower()
+    if pruner not in PRUNERS:
+        print(f"\033[91m\n\tWARNING: unknown pruner {pruner}. Using none\n\033[0m")
+        pruner = 'none'
+    pruning = PruningSettings(pruner,
+                              int(params.get('pruner_warmup_chunks', 1)),
+                              int(params.get('pruner_chunk_size', 10)))
+
+    # local storage of the studies, so reruns resume them
+    storage_kind = str(params.get('study_storage', 'none')).strip().lower()
+    if storage_kind not in STORAGES:
+        print(f"\033[91m\n\tWARNING: unknown study_storage {storage_kind}. Using none\n\033[0m")
+        storage_kind = 'none'
+    study_storage = StudyStorage(storage_kind,
+                                 os.path.join(CWD, params['study_storage_path'])
+                                 if params.get('study_storage_path') else '')
+
+    # seed new studies with previous results of the station, its nearest
+    # stations and its network
+    warm_start = WarmStart(
+        str(params.get('warm_start', False)).lower() in ['true', '1', 'yes'],
+        int(params.get('warm_start_neighbors', 3)),
+        os.path.join(CWD, STATION_COORDS_PATH))
+
+    # bayes (TPE trials) or grid (coarse-to-fine grid with the numpy engine)
+    search_mode = str(params.get('search_mode', 'bayes')).strip().lower()
+    if search_mode not in ['bayes', 'grid']:
+        print(f"\033[91m\n\tWARNING: unknown search_mode {search_mode}. Using bayes\n\033[0m")
+        search_mode = 'bayes'
+    if search_mode == 'grid' and engine != 'numpy':
+        print("\033[91m\n\tWARNING: the grid search evaluates the parameters with the numpy engine\n\033[0m")
+    grid_stride = int(params.get('grid_stride', 2))
+    grid_top = int(params.get('grid_top', 3))
+
+    # one scautopick playback per trial (and worker) instead of one per waveform
+    batch_playback = str(params.get('batch_playback', False)).lower() in ['true', '1', 'yes']
+
+    # stage timers of the downloads and trials, written in profiles/
+    profile = str(params.get('profile', False)).lower() in ['true', '1', 'yes']
+
+    # sampler of the CPU, memory, I/O and scautopick processes of the
+    # campaign and of each station, written in resources/
+    resource_monitor = str(params.get('resource_monitor', False)).lower() in ['true', '1', 'yes']
+    resource_monitor_interval = float(params.get('resource_monitor_interval', 1.0))
     
     try:
         n_trials = int(params['n_trials'])
@@ -117,6 +201,33 @@ def picker_tuner(cursor, wf_cursor, ti, tf, params):
         # printtig warning message in red color, we are using default value of n_trials = 100
         n_trials = 100
         print(f"\033[91m\n\tWARNING: n_trials is not an integer, got {params['n_trials']}. Using default value of n_trials = 100\n\033[0m")
+
+    # global budget of evaluation workers (by default the CPUs available to
+    # the tuner), split among the stations tuned at the same time. With
+    # max_workers = auto the first trials search the best count up to
+    # max_workers_ceiling
+    max_workers = available_cpus()
+    autotune_workers = str(params.get('max_workers', '')).strip().lower() == 'auto'
+    try:
+        if autotune_workers:
+            max_workers = min(int(params.get('max_workers_ceiling', max_workers)), max_workers)
+        else:
+            max_workers = int(params.get('max_workers', max_workers))
+        station_workers = int(params.get('station_workers', 1))
+    except ValueError:
+        print("\033[91m\n\tWARNING: max_workers and station_workers must be integers. Tuning one station at a time\n\033[0m")
+        station_workers = 1
+    if autotune_workers and (engine != 'scautopick' or batch_playback or search_mode != 'bayes'):
+        print(f"\033[91m\n\tWARNING: max_workers = auto only tunes the per-waveform scautopick "
+              f"trials. Using {max_workers} workers\n\033[0m")
+        autotune_workers = False
+    if str(debug).lower() in ['true', '1', 'yes']:
+        max_workers = station_workers = 1
+        autotune_workers = False
+    worker_autotune = None
+    if autotune_workers:
+        worker_autotune = WorkerAutotuner(split_workers(max_workers, station_workers),
+                                          os.path.join(CWD, AUTOTUNE_PATH))
     
     MAX_PICKS = params['max_picks']
     """try:
@@ -126,14 +237,27 @@ def picker_tuner(cursor, wf_cursor, ti, tf, params):
         MAX_PICKS = 50"""
     
     try:
-        # fdsn client for waveforms download
-        #client = obspy.clients.fdsn.Client(params['fdsn_ip'])
-        clients = [obspy.clients.fdsn.Client(ip.strip()) for ip in params['fdsn_ip'].split(',')]
-        ic(clients)
+        # fdsn endpoints for waveforms download, each station pipeline
+        # creates its own clients
+        fdsn_ips = [ip.strip() for ip in params['fdsn_ip'].split(',')]
+        ic(fdsn_ips)
     except KeyError:
         print('\n\n\t ERROR! fdsn_ip not defined in sc3-autotuner.inp')
         sys.exit()
 
+    # waveform windows of a station downloaded at the same time, with at most
+    # fdsn_max_connections requests in flight per endpoint (shared by the
+    # stations tuned at the same time), and windows per bulk request (0 for
+    # one request per window)
+    try:
+        download_workers = max(1, int(params.get('download_workers', 4)))
+        fdsn_max_connections = max(1, int(params.get('fdsn_max_connections', 4)))
+        fdsn_bulk_size = max(0, int(params.get('fdsn_bulk_size', 20)))
+    except ValueError:
+        print("\033[91m\n\tWARNING: download_workers, fdsn_max_connections and fdsn_bulk_size must be integers. Downloading one waveform at a time\n\033[0m")
+        download_workers = fdsn_max_connections = 1
+        fdsn_bulk_size = 0
+
     # creating data directory
     dir_maker = DirectoryCreator()
     main_data_dir = dir_maker.make_dir(CWD, 'mseed_data')
@@ -164,6 +288,24 @@ def picker_tuner(cursor, wf_cursor, ti, tf, params):
         sys.exit()
 
     ic(station_list)
+    settings = TuningSettings(
+        CWD=CWD, main_data_dir=main_data_dir, inv_xml=inv_xml, debug=debug,
+        download_noise_p=download_noise_p, engine=engine,
+        engine_validation=engine_validation, metric=metric,
+        trial_cache=trial_cache, trial_cache_size=int(trial_cache_size),
+        pruning=pruning, study_storage=study_storage, warm_start=warm_start,
+        search_mode=search_mode, grid_stride=grid_stride, grid_top=grid_top,
+        batch_playback=batch_playback, profile=profile, resource_scopes='',
+        n_trials=n_trials,
+        max_picks=MAX_PICKS, DT=DT, fdsn_ips=fdsn_ips,
+        download_workers=download_workers, fdsn_max_connections=fdsn_max_connections,
+        fdsn_bulk_size=fdsn_bulk_size, fdsn_slots_dir='',
+        radius=radius, ti=ti, tf=tf, comparison=comparison_collector is not None,
+        reference_xml_dir=reference_xml_dir, best_xml_dir=best_xml_dir,
+        workers=split_workers(max_workers, station_workers),
+        worker_autotune=worker_autotune,
+    )
+    jobs = []
     for station_str in station_list:
         # cleaning station_str and getting station codes
         station_str = station_str.strip('\n').strip(' ')
@@ -173,7 +315,6 @@ def picker_tuner(cursor, wf_cursor, ti, tf, params):
             f"\n\tEl canal {ch_} para la estación {sta} no es válido\n|"
 
         reference_station_file = None
-        station_comparison_collector = None
         if comparison_collector is not None:
             reference_station_file = resolve_reference_station_file(reference_picker_config, net, sta)
             if reference_station_file is None:
@@ -181,8 +322,6 @@ def picker_tuner(cursor, wf_cursor, ti, tf, params):
                 print(f'WARNING: No reference station file found for {net}.{sta}.')
                 print('\tSkipping reference-vs-best comparison for this station.')
                 print('\033[0m', end='\n')
-            else:
-                station_comparison_collector = ComparisonCollector()
 
         if not wf_cursor:
             wf_cursor = cursor
@@ -216,12 +355,9 @@ def picker_tuner(cursor, wf_cursor, ti, tf, params):
             continue
 
         ic(channels)
-        # creating a station object
-        station = Station(lat, lon, net, sta, loc, ch_)
-        ic(station)
-        # creating station directory
-        station.data_dir = dir_maker.make_dir(main_data_dir, sta)
-        
+        if warm_start.enabled:
+            # coordinates of the tuned stations, to warm start their neighbours
+            save_station_coords(net, sta, lat, lon, warm_start.coords_path)
         print(f'\n\n\033[95m {net}.{sta}.{ch_} |\033[0m Searching for manual picks between {ti} and {tf}\n')
         # search for manual picks times
         query_picks = Query(cursor=cursor,
@@ -235,106 +371,261 @@ def picker_tuner(cursor, wf_cursor, ti, tf, params):
                                       'max_picks': MAX_PICKS})
         manual_picks = query_picks.execute_query()
         if len(manual_picks) < 5:
-            print(f'Less than 5 manual picks found ({len(manual_picks)}) for {station.name}')
-            not_tuned_station(station.name+' less than 5 picks found')
+            print(f'Less than 5 manual picks found ({len(manual_picks)}) for {net}.{sta}')
+            not_tuned_station(f'{net}.{sta}'+' less than 5 picks found')
             continue           
         print(f'\n\n\033[95m {net}.{sta}.{ch_} |\033[0m Found {len(manual_picks)} manual picks between {ti} and {tf}\n')
-        # store manual picks in csv file
-        picks_file = os.path.join(station.data_dir, f'{station.name}_manual_picks.csv')
-        print(f'\n\n\033[95m {net}.{sta}.{ch_} |\033[0m Downloading waveforms\n')
-        times_paths = waveform_downloader(clients, station, manual_picks, DT,
-                                          download_noise_p)
-
-        # if the program couldn't download any waveform for the current station
-        # continue with the following one
-        if times_paths is None:
-            print(f'No waveforms downloaded for {station.name} due lack of good picks')
-            not_tuned_station(station.name+' lack good picks')
-            continue
-        # Excecutes sta/lta over all wf
-        # creating xml picks directory
-        picks_dir = dir_maker.make_dir(CWD, 'picks_xml')
-        image_dir = dir_maker.make_dir(CWD, 'images')
-        
-        print(f'\n\n\033[95m {net}.{sta}.{ch_} |\033[0m Optimizing pickers\n')
-        phase_event_ids = {'P': [], 'S': []}
-        phase_waveforms = {'P': [], 'S': []}
-        best_xml_paths = {'P': None, 'S': None}
-        reference_xml_paths = {'P': None, 'S': None}
-        if station_comparison_collector is not None:
-            phase_event_ids = {
-                phase: event_ids_from_times_file(times_paths[phase], sta, loc, ch_)
-                for phase in ['P', 'S']
-            }
-            phase_waveforms = {
-                phase: waveform_paths_from_times_file(times_paths[phase])
-                for phase in ['P', 'S']
-            }
-        for phase in ['P', 'S']:
-            write_current_exc(times_paths[phase], picks_dir, inv_xml, debug,
-                              net, ch_, loc, sta)
-            ic(phase)
-            bayes_optuna(net, sta, loc, ch_, phase, n_trials)
-
-            if comparison_collector is None or reference_station_file is None:
+        jobs.append(StationJob(net, sta, loc, ch_, lat, lon, manual_picks,
+                               reference_station_file))
+
+    # stations run one at a time in this process sharing one worker pool, or
+    # station_workers at a time in their own processes
+    pool = None
+    if station_workers <= 1:
+        pool = EvaluationPool(max_workers, worker_autotune)
+    # the lock files of the FDSN connection slots, shared by the station
+    # processes, are removed with the campaign
+    with tempfile.TemporaryDirectory(prefix=FDSN_SLOTS_PREFIX) as slots_dir, \
+            monitor_resources(os.path.join(CWD, RESOURCES_DIR), resource_monitor_interval,
+                              resource_monitor) as monitor:
+        settings.fdsn_slots_dir = slots_dir
+        if monitor is not None:
+            settings.resource_scopes = monitor.scopes_dir
+        results = run_campaign(jobs, partial(tune_station, settings=settings, pool=pool),
+                               station_workers, os.path.join(CWD, 'logs'))
+    if pool is not None:
+        pool.shutdown()
+
+    if comparison_collector is not None:
+        for result in results:
+            if result is None or result['comparison'] is None:
                 continue
+            for phase, labels in result['comparison'].items():
+                for label, pick_counts in labels.items():
+                    comparison_collector.add(phase, label, pick_counts)
+        print('\n\033[96mOverall reference vs best picker comparison\033[0m')
+        print(format_comparison_table(comparison_collector))
+
+
+@dataclass
+class TuningSettings:
+    """Options of the campaign shared by every station pipeline"""
+    CWD: str
+    main_data_dir: str
+    inv_xml: str
+    debug: bool
+    download_noise_p: bool
+    engine: str
+    engine_validation: bool
+    metric: str
+    trial_cache: str
+    trial_cache_size: int
+    pruning: PruningSettings
+    study_storage: StudyStorage
+    warm_start: WarmStart
+    search_mode: str
+    grid_stride: int
+    grid_top: int
+    batch_playback: bool
+    profile: bool
+    resource_scopes: str
+    n_trials: int
+    max_picks: int
+    DT: int
+    fdsn_ips: list
+    download_workers: int
+    fdsn_max_connections: int
+    fdsn_bulk_size: int
+    fdsn_slots_dir: str
+    radius: float
+    ti: str
+    tf: str
+    comparison: bool
+    reference_xml_dir: str
+    best_xml_dir: str
+    workers: int
+    worker_autotune: WorkerAutotuner
+
+
+@dataclass
+class StationJob:
+    """Station codes, coordinates and manual picks queried by the main
+    process, so the pipeline can run in another process"""
+    net: str
+    sta: str
+    loc: str
+    ch: str
+    lat: float
+    lon: float
+    manual_picks: list
+    reference_station_file: str = None
+
+    @property
+    def name(self):
+        return f'{self.net}.{self.sta}'
+
+
+def tune_station(job: StationJob, settings: TuningSettings, pool=None):
+    """Download the waveforms of a station, run the P and S studies and the
+    optional engine validation and reference comparison. The working files
+    of the station are kept apart from the other stations. Returns the
+    comparison pick counts of the station (None without comparison)"""
+    own_pool = pool is None
+    if own_pool:
+        pool = EvaluationPool(settings.workers, settings.worker_autotune)
+    try:
+        # the resource monitor attributes this process tree to the station
+        with station_scope(settings.resource_scopes, job.name):
+            return _tune_station(job, settings, pool)
+    finally:
+        # the parsed times files and loaded waveforms of the station
+        release_datasets(os.path.join(settings.main_data_dir, job.sta))
+        if own_pool:
+            pool.shutdown()
+
+
+def _tune_station(job, settings, pool):
+    net, sta, loc, ch_ = job.net, job.sta, job.loc, job.ch
+    CWD = settings.CWD
+    debug = settings.debug
+    inv_xml = settings.inv_xml
+    dir_maker = DirectoryCreator()
+    # fdsn clients for waveforms download
+    clients = [obspy.clients.fdsn.Client(ip) for ip in settings.fdsn_ips]
+    reference_station_file = job.reference_station_file
+    station_comparison_collector = None
+    if settings.comparison and reference_station_file is not None:
+        station_comparison_collector = ComparisonCollector()
+
+    # creating a station object
+    station = Station(job.lat, job.lon, net, sta, loc, ch_)
+    ic(station)
+    # creating station directory
+    station.data_dir = dir_maker.make_dir(settings.main_data_dir, sta)
+
+    print(f'\n\n\033[95m {net}.{sta}.{ch_} |\033[0m Downloading waveforms\n')
+    with profiling.collect(settings.profile) as download_profile:
+        times_paths = waveform_downloader(clients, station, job.manual_picks, settings.DT,
+                                          settings.download_noise_p, settings.download_workers,
+                                          EndpointLimits(settings.fdsn_max_connections,
+                                                         settings.fdsn_slots_dir or None),
+                                          settings.fdsn_bulk_size)
+    if download_profile is not None:
+        write_download_profile(download_profile, net, sta, loc,
+                               os.path.join(CWD, profiling.PROFILES_DIR))
+
+    # if the program couldn't download any waveform for the current station
+    # continue with the following one
+    if times_paths is None:
+        print(f'No waveforms downloaded for {station.name} due lack of good picks')
+        not_tuned_station(station.name+' lack good picks')
+        return None
+    # Excecutes sta/lta over all wf
+    # creating xml picks directory, one per station
+    picks_dir = dir_maker.make_dir(dir_maker.make_dir(CWD, 'picks_xml'), f'{net}.{sta}')
+    image_dir = dir_maker.make_dir(CWD, 'images')
+    
+    print(f'\n\n\033[95m {net}.{sta}.{ch_} |\033[0m Optimizing pickers\n')
+    phase_event_ids = {'P': [], 'S': []}
+    phase_waveforms = {'P': [], 'S': []}
+    best_xml_paths = {'P': None, 'S': None}
+    reference_xml_paths = {'P': None, 'S': None}
+    if station_comparison_collector is not None:
+        phase_event_ids = {
+            phase: event_ids_from_times_file(times_paths[phase], sta, loc, ch_)
+            for phase in ['P', 'S']
+        }
+        phase_waveforms = {
+            phase: waveform_paths_from_times_file(times_paths[phase])
+            for phase in ['P', 'S']
+        }
+    for phase in ['P', 'S']:
+        context = ExecutionContext(times_paths[phase], picks_dir, inv_xml,
+                                   debug, net, ch_, loc, sta, settings.engine,
+                                   settings.trial_cache, settings.trial_cache_size,
+                                   settings.batch_playback, settings.profile)
+        ic(phase)
+        if settings.search_mode == 'grid':
+            grid_search(net, sta, loc, ch_, phase, pool=pool,
+                        metric=settings.metric, context=context,
+                        stride=settings.grid_stride, top=settings.grid_top)
+        else:
+            bayes_optuna(net, sta, loc, ch_, phase, settings.n_trials, pool=pool,
+                         metric=settings.metric, context=context,
+                         pruning=settings.pruning, storage=settings.study_storage,
+                         warm_start=settings.warm_start)
 
-            reference_xml_path = os.path.join(reference_xml_dir,
-                                              f'exc_reference_{net}_{sta}_{phase}.xml')
+        if settings.engine_validation and phase in SUPPORTED_PHASES:
+            validation_dir = dir_maker.make_dir(CWD, 'engine_validation')
             try:
-                build_reference_scautopick_xml(reference_station_file,
-                                               reference_xml_path,
-                                               net,
-                                               sta,
-                                               loc,
-                                               ch_)
-                best_xml_path = os.path.join(best_xml_dir,
-                                             f'exc_best_{net}_{sta}_{phase}.xml')
-                best_pick_counts = evaluate_best_phase(net, sta, phase,
-                                                       best_xml_path=best_xml_path)
-                ref_pick_counts = evaluate_reference_phase(reference_xml_path)
-                best_xml_paths[phase] = best_xml_path
-                reference_xml_paths[phase] = reference_xml_path
+                validate_engine_phase(net, sta, phase, validation_dir,
+                                      context=context)
             except Exception as exc:
                 print('\033[91m\n\t', end='')
-                print(f'WARNING: Comparison failed for {net}.{sta} {phase}: {exc}')
+                print(f'WARNING: Engine validation failed for {net}.{sta} {phase}: {exc}')
                 print('\033[0m', end='\n')
-                continue
 
-            comparison_collector.add(phase, 'best', best_pick_counts)
-            comparison_collector.add(phase, 'reference', ref_pick_counts)
-            station_comparison_collector.add(phase, 'best', best_pick_counts)
-            station_comparison_collector.add(phase, 'reference', ref_pick_counts)
-
-        if station_comparison_collector is not None:
-            report_path = write_station_comparison_report(
-                station_comparison_collector,
-                net=net,
-                sta=sta,
-                loc=loc,
-                ch=ch_,
-                radius=radius,
-                ti=ti,
-                tf=tf,
-                max_picks=MAX_PICKS,
-                n_trials=n_trials,
-                phase_event_ids=phase_event_ids,
-                phase_waveforms=phase_waveforms,
-                best_xml_paths=best_xml_paths,
-                reference_xml_paths=reference_xml_paths,
-                inv_xml=inv_xml,
-                output_dir=dir_maker.make_dir(CWD, 'comparison_reports'),
-            )
-            print(f'\n\tComparison report written: {report_path}\n')
+        if station_comparison_collector is None:
+            continue
 
-    if comparison_collector is not None:
-        print('\n\033[96mOverall reference vs best picker comparison\033[0m')
-        print(format_comparison_table(comparison_collector))
+        reference_xml_path = os.path.join(settings.reference_xml_dir,
+                                          f'exc_reference_{net}_{sta}_{phase}.xml')
+        try:
+            build_reference_scautopick_xml(reference_station_file,
+                                           reference_xml_path,
+                                           net,
+                                           sta,
+                                           loc,
+                                           ch_)
+            best_xml_path = os.path.join(settings.best_xml_dir,
+                                         f'exc_best_{net}_{sta}_{phase}.xml')
+            best_pick_counts = evaluate_best_phase(net, sta, phase,
+                                                   best_xml_path=best_xml_path,
+                                                   pool=pool,
+                                                   context=context)
+            ref_pick_counts = evaluate_reference_phase(reference_xml_path,
+                                                       pool=pool,
+                                                       context=context)
+            best_xml_paths[phase] = best_xml_path
+            reference_xml_paths[phase] = reference_xml_path
+        except Exception as exc:
+            print('\033[91m\n\t', end='')
+            print(f'WARNING: Comparison failed for {net}.{sta} {phase}: {exc}')
+            print('\033[0m', end='\n')
+            continue
+
+        station_comparison_collector.add(phase, 'best', best_pick_counts)
+        station_comparison_collector.add(phase, 'reference', ref_pick_counts)
+
+    if station_comparison_collector is None:
+        return {'comparison': None}
+
+    report_path = write_station_comparison_report(
+        station_comparison_collector,
+        net=net,
+        sta=sta,
+        loc=loc,
+        ch=ch_,
+        radius=settings.radius,
+        ti=settings.ti,
+        tf=settings.tf,
+        max_picks=settings.max_picks,
+        n_trials=settings.n_trials,
+        phase_event_ids=phase_event_ids,
+        phase_waveforms=phase_waveforms,
+        best_xml_paths=best_xml_paths,
+        reference_xml_paths=reference_xml_paths,
+        inv_xml=inv_xml,
+        output_dir=dir_maker.make_dir(CWD, 'comparison_reports'),
+    )
+    print(f'\n\tComparison report written: {report_path}\n')
+    return {'comparison': station_comparison_collector.data}
 
 
 def _best_params_from_csv(net: str, sta: str, phase: str) -> dict:
     csv_path = f'results_{phase}.csv'
-    df = pd.read_csv(csv_path)
+    with file_lock(csv_path):
+        df = pd.read_csv(csv_path)
     best_rows = df[df['net.sta'] == f'{net}.{sta}'].sort_values(by='best_f1',
                                                                 ascending=False)
     if best_rows.empty:
@@ -353,22 +644,58 @@ def best_eval_params(net: str, sta: str, phase: str) -> dict:
     return params
 
 
-def evaluate_best_phase(net: str, sta: str, phase: str, best_xml_path=None):
-    stalta = StaLta()
+def evaluate_best_phase(net: str, sta: str, phase: str, best_xml_path=None,
+                        pool=None, context=None):
+    stalta = StaLta(pool=pool, context=context)
     params = best_eval_params(net, sta, phase)
-    _, _, pick_counts = stalta.mega_sta_lta(collect_pick_level=True,
-                                            xml_output_path=best_xml_path,
-                                            **params)
+    # the picks of the best parameters are kept in picks_xml, scored with
+    # scautopick like the reference picker
+    _, pick_counts = stalta.mega_sta_lta(collect_pick_level=True,
+                                         xml_output_path=best_xml_path,
+                                         write_picks=True,
+                                         engine='scautopick',
+                                         **params)
     return pick_counts
 
 
-def evaluate_reference_phase(reference_xml_path: str):
-    stalta = StaLta()
-    _, _, pick_counts = stalta.mega_sta_lta(config_db_path=reference_xml_path,
-                                            collect_pick_level=True)
+def evaluate_reference_phase(reference_xml_path: str, pool=None, context=None):
+    stalta = StaLta(pool=pool, context=context)
+    _, pick_counts = stalta.mega_sta_lta(config_db_path=reference_xml_path,
+                                         collect_pick_level=True)
     return pick_counts
 
 
+def validate_engine_phase(net: str, sta: str, phase: str, output_dir: str,
+                          context=None):
+    """
+    Compare the numpy engine picks against scautopick picks for the best
+    parameters of a phase, write the per-waveform residuals to a csv file
+    and print a summary
+    """
+    stalta = StaLta(context=context)
+    params = best_eval_params(net, sta, phase)
+    rows = stalta.validate_engine(**params)
+    summary = summarize_validation(rows)
+
+    path = os.path.join(output_dir, f'{net}_{sta}_{phase}.csv')
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['wf_path', 'matched', 'only_scautopick', 'only_numpy',
+                         'residuals_s'])
+        for row in rows:
+            writer.writerow([row['wf_path'], len(row['residuals']),
+                             row['only_reference'], row['only_engine'],
+                             ' '.join(f'{r:.3f}' for r in row['residuals'])])
+
+    print(f'\n\033[96m{net}.{sta} - {phase} numpy engine vs scautopick\033[0m')
+    print(f"\tWaveforms: {summary['waveforms']}  matched picks: {summary['matched']}  "
+          f"only scautopick: {summary['only_reference']}  only numpy: {summary['only_engine']}")
+    print(f"\tResiduals (numpy - scautopick): mean {summary['mean']:.3f} s  "
+          f"median |dt| {summary['median_abs']:.3f} s  max |dt| {summary['max_abs']:.3f} s")
+    print(f'\tDetails written to {path}\n')
+    return summary
+
+
 def _safe_token(value):
     token = str(value).strip().replace(' ', 'T').replace(':', '')
     return re.sub(r'[^A-Za-z0-9._-]+', '-', token)
@@ -541,27 +868,35 @@ def write_station_comparison_report(collector, net, sta, radius, ti, tf,
 
     return path
 
+def write_download_profile(profile, net, sta, loc, profiles_dir):
+    """Write and print the stage profile of the waveform download of a
+    station"""
+    profiling.write_profile(os.path.join(profiles_dir, f'{net}.{sta}.{loc}_download_profile'),
+                            [{'number': 0, 'state': 'DOWNLOAD', 'value': None,
+                              'profile': profile.as_dict()}])
+    print('\n' + profiling.format_summary(f'{net}.{sta} download profile',
+                                           [profile.as_dict()], 'download') + '\n')
+
+
 def not_tuned_station(station):
-    with open('stations_not_tuned.txt', 'a') as f:
+    with file_lock('stations_not_tuned.txt'), open('stations_not_tuned.txt', 'a') as f:
         f.write(f'{station}\n')
     
 
 def write_current_exc(times_paths, picks_dir, inv_xml, debug,
-                      net, ch, loc, sta):
+                      net, ch, loc, sta, engine='scautopick', trial_cache='',
+                      trial_cache_size=DEFAULT_MAX_ENTRIES):
     """function that writes in a file called current_exc.txt
-    the values of times_paths, picks_dir, inv_xml, and debug
+    the values of times_paths, picks_dir, inv_xml, debug, engine and
+    the trial cache settings. Only kept for compatibility: the tuner passes
+    an ExecutionContext to the studies instead
     times_file: str
     picks_dir: str
     inv_xml: str
     debug: bool
+    engine: str
+    trial_cache: str, path of the cache database or '' to disable it
+    trial_cache_size: int
     """
-    f = open('current_exc.txt', 'w')
-    f.write(f"times_file = {times_paths}\n")
-    f.write(f"picks_dir = {picks_dir}\n")
-    f.write(f"inv_xml = {inv_xml}\n")
-    f.write(f"_debug = {debug}\n")
-    f.write(f"net = {net}\n")
-    f.write(f"ch = {ch}\n")
-    f.write(f"loc = {loc}\n")
-    f.write(f"sta = {sta}\n")
-    f.close()
+    ExecutionContext(times_paths, picks_dir, inv_xml, debug, net, ch, loc, sta,
+                     engine, trial_cache, int(trial_cache_size)).write()
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+Stage timers and counters of the trial hot path
+
+Code on the hot path wraps its stages in profiling.stage(name) and counts
+events with profiling.count(name). Nothing is recorded unless a Profile is
+being collected in the process (profiling.collect), so with profiling
+disabled a stage costs one global lookup. Pool workers collect their own
+Profile per task and send it back with the picks, so the Profile of a trial
+has the stages of every worker, also kept apart by worker pid.
+"""
+import csv
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+PROFILES_DIR = 'profiles'
+
+_NO_STAGE = nullcontext()
+
+# Profile collected in this process, None if profiling is disabled
+_ACTIVE = None
+
+
+class Profile:
+    """
+    Seconds and calls of each stage and event counters
+    """
+    def __init__(self):
+        self.stages = {}
+        self.counters = {}
+        self.workers = {}
+        self._start = time.perf_counter()
+        self._end = None
+        # batch playback threads add their stages concurrently
+        self._lock = threading.Lock()
+
+    @property
+    def wall_seconds(self):
+        """
+        Seconds since the Profile was created, until finish if called
+        """
+        end = self._end if self._end is not None else time.perf_counter()
+        return end - self._start
+
+    def finish(self):
+        self._end = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds, calls=1, worker=None):
+        with self._lock:
+            totals = self.stages.setdefault(name, [0.0, 0])
+            totals[0] += seconds
+            totals[1] += calls
+            if worker is not None:
+                worker_stages = self.workers.setdefault(str(worker), {})
+                worker_stages[name] = worker_stages.get(name, 0.0) + seconds
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def merge(self, data: dict):
+        """
+        Add the stages and counters of a Profile.as_dict of a pool worker
+        """
+        for name, stage in data['stages'].items():
+            self.add(name, stage['seconds'], stage['calls'], data.get('pid'))
+        for name, n in data['counters'].items():
+            self.count(name, n)
+
+    def as_dict(self) -> dict:
+        return {
+            'pid': os.getpid(),
+            'wall_seconds': round(self.wall_seconds, 6),
+            'stages': {name: {'seconds': round(seconds, 6), 'calls': calls}
+                       for name, (seconds, calls) in self.stages.items()},
+            'counters': dict(self.counters),
+            'workers': {pid: {name: round(seconds, 6) for name, seconds in stages.items()}
+                        for pid, stages in self.workers.items()},
+        }
+
+
+def active() -> bool:
+    return _ACTIVE is not None
+
+
+def stage(name):
+    """
+    Context manager timing a stage of the collected Profile (no-op if none)
+    """
+    if _ACTIVE is None:
+        return _NO_STAGE
+    return _ACTIVE.stage(name)
+
+
+def count(name, n=1):
+    if _ACTIVE is not None:
+        _ACTIVE.count(name, n)
+
+
+def merge(data):
+    """
+    Merge a worker profile (None when the worker did not collect one)
+    """
+    if _ACTIVE is not None and data is not None:
+        _ACTIVE.merge(data)
+
+
+@contextmanager
+def collect(enabled=True):
+    """
+    Collect the stages of the block in a new Profile, yielded (None if not
+    enabled). The Profile being collected before is restored at the end
+    """
+    if not enabled:
+        yield None
+        return
+    global _ACTIVE
+    previous = _ACTIVE
+    profile = _ACTIVE = Profile()
+    try:
+        yield profile
+    finally:
+        profile.finish()
+        _ACTIVE = previous
+
+
+def summarize(profiles: list) -> list:
+    """
+    Rows (stage, calls, seconds, ms per trial, share of the trial time) of
+    the summed stages of a list of Profile.as_dict, slowest stage first
+    """
+    totals = {}
+    for data in profiles:
+        for name, stage_ in data['stages'].items():
+            seconds, calls = totals.get(name, (0.0, 0))
+            totals[name] = (seconds + stage_['seconds'], calls + stage_['calls'])
+    wall = sum(data['wall_seconds'] for data in profiles)
+    n = max(len(profiles), 1)
+    rows = [{'stage': name, 'calls': calls, 'seconds': round(seconds, 4),
+             'ms_per_trial': round(1000 * seconds / n, 3),
+             'share': round(seconds / wall, 4) if wall else 0.0}
+            for name, (seconds, calls) in totals.items()]
+    rows.sort(key=lambda row: row['seconds'], reverse=True)
+    return rows
+
+
+def format_summary(title, profiles: list, label='trials') -> str:
+    wall = sum(data['wall_seconds'] for data in profiles)
+    counters = {}
+    for data in profiles:
+        for name, n in data['counters'].items():
+            counters[name] = counters.get(name, 0) + n
+    header = f"{'stage':<18} {'calls':>8} {'seconds':>10} {'ms/trial':>10} {'share':>7}"
+    lines = [title, f'{len(profiles)} {label}, {wall:.3f} s', header, '-' * len(header)]
+    for row in summarize(profiles):
+        lines.append(f"{row['stage']:<18} {row['calls']:>8} {row['seconds']:>10.3f} "
+                     f"{row['ms_per_trial']:>10.3f} {row['share']:>7.1%}")
+    if counters:
+        lines.append('counters: ' + ', '.join(f'{name}={n}' for name, n in sorted(counters.items())))
+    return '\n'.join(lines)
+
+
+def write_profile(path_prefix: str, trials: list):
+    """
+    Write path_prefix.json with the summary and the profile of every trial
+    and path_prefix.csv with one row per trial and stage. trials are dicts
+    with number, state, value and profile
+    """
+    os.makedirs(os.path.dirname(path_prefix) or '.', exist_ok=True)
+    profiles = [trial['profile'] for trial in trials]
+    with open(f'{path_prefix}.json', 'w') as f:
+        json.dump({'summary': summarize(profiles), 'trials': trials}, f, indent=1)
+    with open(f'{path_prefix}.csv', 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['trial', 'state', 'value', 'stage', 'calls', 'seconds'])
+        for trial in trials:
+            profile = trial['profile']
+            writer.writerow([trial['number'], trial['state'], trial['value'], 'wall', 1,
+                             profile['wall_seconds']])
+            for name, stage_ in profile['stages'].items():
+                writer.writerow([trial['number'], trial['state'], trial['value'], name,
+                                 stage_['calls'], stage_['seconds']])
@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*-
+"""
+Resource sampler of a tuning campaign
+
+A thread of the main process samples, every interval seconds, the CPU time,
+RSS, disk I/O and number of scautopick processes of the campaign process
+tree and of each station being tuned, plus the host CPU, iowait and
+available memory. Each station pipeline marks the process running it
+(station_scope), so stations tuned at the same time in separate processes
+get their own figures. Values are read from /proc: CPU time and I/O bytes
+of exited scautopick runs are still counted through their parents.
+
+Samples go to resources/resources.csv and the peak and average figures of
+each station to resources/summary.csv.
+"""
+import csv
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+RESOURCES_DIR = 'resources'
+CAMPAIGN_SCOPE = 'campaign'
+PROC = '/proc'
+
+CLK_TCK = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+MB = 1024 * 1024
+
+SAMPLE_FIELDS = ['time', 'elapsed_s', 'scope', 'processes', 'scautopick',
+                 'cpu_percent', 'rss_mb', 'read_mb_s', 'write_mb_s',
+                 'host_cpu_percent', 'host_iowait_percent', 'host_mem_available_mb']
+SUMMARY_FIELDS = ['scope', 'samples', 'seconds', 'cpu_percent_avg', 'cpu_percent_peak',
+                  'rss_mb_avg', 'rss_mb_peak', 'scautopick_avg', 'scautopick_peak',
+                  'read_mb', 'write_mb', 'read_mb_s_peak', 'write_mb_s_peak',
+                  'host_iowait_percent_avg', 'host_mem_available_mb_min']
+
+
+def monitor_available() -> bool:
+    return os.path.isfile(os.path.join(PROC, 'stat'))
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def read_processes() -> dict:
+    """
+    ppid, command, CPU seconds (own and of its reaped children) and RSS of
+    every process, keyed by pid
+    """
+    processes = {}
+    for name in os.listdir(PROC):
+        if not name.isdigit():
+            continue
+        stat = _read(os.path.join(PROC, name, 'stat'))
+        if stat is None:
+            continue
+        # the command may contain spaces and parentheses
+        comm = stat[stat.index('(') + 1:stat.rindex(')')]
+        fields = stat[stat.rindex(')') + 2:].split()
+        processes[int(name)] = {
+            'ppid': int(fields[1]),
+            'comm': comm,
+            'cpu': sum(int(value) for value in fields[11:15]) / CLK_TCK,
+            'rss': int(fields[21]) * PAGE_SIZE,
+        }
+    return processes
+
+
+def read_io(pid: int):
+    """
+    Disk (read_bytes, write_bytes) of a process and its reaped children,
+    None if not readable
+    """
+    text = _read(os.path.join(PROC, str(pid), 'io'))
+    if text is None:
+        return None
+    values = dict(line.split(': ') for line in text.splitlines() if ': ' in line)
+    return int(values.get('read_bytes', 0)), int(values.get('write_bytes', 0))
+
+
+def read_host() -> dict:
+    """
+    Cumulative host CPU jiffies (busy, iowait, total) and available memory
+    """
+    cpu = [int(value) for value in _read(os.path.join(PROC, 'stat')).split('\n', 1)[0].split()[1:]]
+    idle, iowait = cpu[3], cpu[4] if len(cpu) > 4 else 0
+    total = sum(cpu[:8])
+    mem_available = 0
+    for line in (_read(os.path.join(PROC, 'meminfo')) or '').splitlines():
+        if line.startswith('MemAvailable:'):
+            mem_available = int(line.split()[1]) * 1024
+    return {'busy': total - idle - iowait, 'iowait': iowait, 'total': total,
+            'mem_available': mem_available}
+
+
+def is_scautopick(pid: int, comm: str) -> bool:
+    """
+    True for scautopick processes, also when run through an interpreter
+    (the command of a script is the interpreter name)
+    """
+    if comm == 'scautopick':
+        return True
+    cmdline = _read(os.path.join(PROC, str(pid), 'cmdline')) or ''
+    return any(os.path.basename(arg) == 'scautopick' for arg in cmdline.split('\0')[:2])
+
+
+def subtree(processes: dict, root: int) -> list:
+    """
+    pid of root and of all its live descendants
+    """
+    children = {}
+    for pid, proc in processes.items():
+        children.setdefault(proc['ppid'], []).append(pid)
+    pids, todo = [], [root]
+    while todo:
+        pid = todo.pop()
+        if pid in processes:
+            pids.append(pid)
+            todo.extend(children.get(pid, []))
+    return pids
+
+
+def tree_usage(processes: dict, root: int) -> dict:
+    """
+    Summed usage of the process tree of root
+    """
+    pids = subtree(processes, root)
+    read_bytes = write_bytes = 0
+    for pid in pids:
+        io = read_io(pid)
+        if io is not None:
+            read_bytes += io[0]
+            write_bytes += io[1]
+    return {
+        'processes': len(pids),
+        'scautopick': sum(1 for pid in pids if is_scautopick(pid, processes[pid]['comm'])),
+        'cpu': sum(processes[pid]['cpu'] for pid in pids),
+        'rss': sum(processes[pid]['rss'] for pid in pids),
+        'read': read_bytes,
+        'write': write_bytes,
+    }
+
+
+def _rate(current, previous, seconds):
+    # cumulative counters drop when a process exits before being reaped
+    return max(current - previous, 0) / seconds if seconds > 0 else 0.0
+
+
+@contextmanager
+def station_scope(scopes_dir: str, name: str):
+    """
+    Mark the current process as running station name while the block runs,
+    so the monitor attributes its process tree to the station. No-op if
+    scopes_dir is empty (monitor disabled)
+    """
+    if not scopes_dir:
+        yield
+        return
+    os.makedirs(scopes_dir, exist_ok=True)
+    path = os.path.join(scopes_dir, str(os.getpid()))
+    with open(path, 'w') as f:
+        f.write(name)
+    try:
+        yield
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class ResourceMonitor:
+    """
+    Sampler thread of the campaign process tree and of each station scope
+    """
+    def __init__(self, out_dir=RESOURCES_DIR, interval=1.0, root=None):
+        self.out_dir = out_dir
+        self.interval = max(0.05, float(interval))
+        self.root = root or os.getpid()
+        self.samples = []
+        self._previous = {}
+        self._stop = threading.Event()
+        self._thread = None
+        self._start = None
+        self._writer = None
+        self._file = None
+
+    @property
+    def scopes_dir(self):
+        """
+        Directory of the station marks written by station_scope
+        """
+        return os.path.join(self.out_dir, 'scopes')
+
+    @property
+    def samples_path(self):
+        return os.path.join(self.out_dir, 'resources.csv')
+
+    @property
+    def summary_path(self):
+        return os.path.join(self.out_dir, 'summary.csv')
+
+    def scopes(self) -> dict:
+        """
+        Root pid of the campaign and of every station being tuned, by name
+        """
+        scopes = {CAMPAIGN_SCOPE: self.root}
+        try:
+            names = os.listdir(self.scopes_dir)
+        except OSError:
+            names = []
+        for name in names:
+            station = _read(os.path.join(self.scopes_dir, name))
+            if name.isdigit() and station:
+                scopes[station] = int(name)
+        return scopes
+
+    def sample(self):
+        """
+        Take one sample of every scope and append it to the samples file
+        """
+        now = time.time()
+        processes = read_processes()
+        host = read_host()
+        previous_host = self._previous.get('host')
+        host_row = {'host_cpu_percent': 0.0, 'host_iowait_percent': 0.0,
+                    'host_mem_available_mb': round(host['mem_available'] / MB, 1)}
+        if previous_host is not None:
+            total = host['total'] - previous_host['total']
+            if total > 0:
+                host_row['host_cpu_percent'] = round(100 * (host['busy'] - previous_host['busy']) / total, 1)
+                host_row['host_iowait_percent'] = round(100 * (host['iowait'] - previous_host['iowait']) / total, 1)
+        self._previous['host'] = host
+
+        rows = []
+        for scope, root in self.scopes().items():
+            # marks left by station processes that died
+            if root not in processes:
+                continue
+            usage = tree_usage(processes, root)
+            previous = self._previous.get((scope, root))
+            self._previous[(scope, root)] = (now, usage)
+            row = {'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(now)),
+                   'elapsed_s': round(now - self._start, 2), 'scope': scope,
+                   'processes': usage['processes'], 'scautopick': usage['scautopick'],
+                   'cpu_percent': 0.0, 'rss_mb': round(usage['rss'] / MB, 1),
+                   'read_mb_s': 0.0, 'write_mb_s': 0.0}
+            if previous is not None:
+                seconds = now - previous[0]
+                row['cpu_percent'] = round(100 * _rate(usage['cpu'], previous[1]['cpu'], seconds), 1)
+                row['read_mb_s'] = round(_rate(usage['read'], previous[1]['read'], seconds) / MB, 3)
+                row['write_mb_s'] = round(_rate(usage['write'], previous[1]['write'], seconds) / MB, 3)
+            row.update(host_row)
+            rows.append(row)
+        self.samples.extend(rows)
+        if self._writer is not None:
+            self._writer.writerows(rows)
+            self._file.flush()
+        return rows
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.sample()
+            except Exception as exc:
+                print(f"\033[91m\n\tWARNING: resource sample failed: {exc}\n\033[0m")
+
+    def start(self):
+        os.makedirs(self.scopes_dir, exist_ok=True)
+        for name in os.listdir(self.scopes_dir):
+            os.remove(os.path.join(self.scopes_dir, name))
+        self._file = open(self.samples_path, 'w', newline='')
+        self._writer = csv.DictWriter(self._file, fieldnames=SAMPLE_FIELDS)
+        self._writer.writeheader()
+        self._start = time.time()
+        self.sample()
+        self._thread = threading.Thread(target=self._run, name='resource-monitor', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop sampling and write the summary of every scope
+        """
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        self.sample()
+        self._file.close()
+        self._writer = None
+        summary = summarize(self.samples)
+        with open(self.summary_path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=SUMMARY_FIELDS)
+            writer.writeheader()
+            writer.writerows(summary)
+        return summary
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        print('\n' + format_summary(self.stop()))
+        print(f'\n\tResource samples written to {self.samples_path}\n')
+
+
+def summarize(samples: list) -> list:
+    """
+    Peak and average figures of the samples of each scope, in order of
+    appearance
+    """
+    by_scope = {}
+    for row in samples:
+        by_scope.setdefault(row['scope'], []).append(row)
+    summary = []
+    for scope, rows in by_scope.items():
+        # the first sample of a scope has no rates
+        rated = rows[1:] or rows
+        n = len(rated)
+        summary.append({
+            'scope': scope,
+            'samples': len(rows),
+            'seconds': round(rows[-1]['elapsed_s'] - rows[0]['elapsed_s'], 1),
+            'cpu_percent_avg': round(sum(r['cpu_percent'] for r in rated) / n, 1),
+            'cpu_percent_peak': max(r['cpu_percent'] for r in rated),
+            'rss_mb_avg': round(sum(r['rss_mb'] for r in rows) / len(rows), 1),
+            'rss_mb_peak': max(r['rss_mb'] for r in rows),
+            'scautopick_avg': round(sum(r['scautopick'] for r in rows) / len(rows), 2),
+            'scautopick_peak': max(r['scautopick'] for r in rows),
+            'read_mb': round(sum(r['read_mb_s'] * _step(rows, k) for k, r in enumerate(rows)), 1),
+            'write_mb': round(sum(r['write_mb_s'] * _step(rows, k) for k, r in enumerate(rows)), 1),
+            'read_mb_s_peak': max(r['read_mb_s'] for r in rated),
+            'write_mb_s_peak': max(r['write_mb_s'] for r in rated),
+            'host_iowait_percent_avg': round(sum(r['host_iowait_percent'] for r in rated) / n, 1),
+            'host_mem_available_mb_min': min(r['host_mem_available_mb'] for r in rows),
+        })
+    return summary
+
+
+def _step(rows, k):
+    # seconds covered by the rates of sample k
+    return rows[k]['elapsed_s'] - rows[k - 1]['elapsed_s'] if k else 0.0
+
+
+def format_summary(summary: list) -> str:
+    header = (f"{'scope':<16} {'seconds':>8} {'cpu% avg':>9} {'cpu% max':>9} "
+              f"{'RSS MB max':>11} {'scautopick max':>15} {'read MB':>8} {'write MB':>9} "
+              f"{'iowait%':>8}")
+    lines = ['Resource usage', header, '-' * len(header)]
+    for row in summary:
+        lines.append(f"{row['scope']:<16} {row['seconds']:>8.1f} {row['cpu_percent_avg']:>9.1f} "
+                     f"{row['cpu_percent_peak']:>9.1f} {row['rss_mb_peak']:>11.1f} "
+                     f"{row['scautopick_peak']:>15} {row['read_mb']:>8.1f} {row['write_mb']:>9.1f} "
+                     f"{row['host_iowait_percent_avg']:>8.1f}")
+    return '\n'.join(lines)
+
+
+@contextmanager
+def monitor_resources(out_dir=RESOURCES_DIR, interval=1.0, enabled=True):
+    """
+    Run a ResourceMonitor while the block runs, yielded (None if not enabled
+    or /proc is not available)
+    """
+    if enabled and not monitor_available():
+        print("\033[91m\n\tWARNING: the resource monitor needs /proc. Disabled\n\033[0m")
+        enabled = False
+    if not enabled:
+        yield None
+        return
+    with ResourceMonitor(out_dir, interval) as monitor:
+        yield monitor
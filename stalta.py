@@ -6,18 +6,30 @@ Created on Jul 20 2021
 @author: Daniel Siervo, emetdan@gmail.com
 """
 #from obspy import read, UTCDateTime
+import atexit
 import obspy
 import os
 import shutil
 import subprocess
+import time
+from collections import OrderedDict
 import xml.etree.ElementTree as ET
 from xml.dom import minidom
 import pandas as pd
 from obspy.core import UTCDateTime
 import numpy as np
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
 from icecream import ic
-from config_params import DEFAULT_VALUES, render_config_param_templates
+from config_params import DEFAULT_VALUES, compile_template, render_config_param_templates
+import numpy_picker
+import profiling
+from trial_cache import DEFAULT_MAX_ENTRIES, entry_key, file_digest, get_cache
+from execution_context import ExecutionContext
+from batch_playback import PlaybackBatch, split_in_batches
+from campaign import file_lock
+from worker_autotune import available_cpus
 
 ic.configureOutput(prefix='debug| ')  # , includeContext=True)
 
@@ -27,38 +39,42 @@ class StaLta:
     picks_dir: str
     inv_xml: str
     _debug: bool
+    engine: str = 'scautopick'
+    active_engine: str = 'scautopick'
+    trial_cache: str = ''
+    trial_cache_size: str = str(DEFAULT_MAX_ENTRIES)
+    batch_playback: str = 'False'
+    profile: str = 'False'
     best_p_csv = 'results_P.csv'
     
     main_dir: str = os.path.dirname(os.path.realpath(__file__))
     
-    def __init__(self):
+    pool = None
+    sample_level = True
+    write_picks = False
+    scautopick_picks: list = []
+
+    def __init__(self, pool=None, context=None):
+        # without an explicit context, fall back to current_exc.txt
+        self.context = context if context is not None else ExecutionContext.from_file()
         self.__dict__.update(self._current_exc_params)
+        self.pool = pool
+        # picks of the batch playbacks of the current evaluation, by record
+        self.batch_picks = {}
     
     @property
     def best_p_params(self):
         """
         Get the best p parameters
         """
-        df = pd.read_csv(self.best_p_csv)
-        # selecting the row with net.sta equal to CM.BAR2 and with the highest value of best_f1
-        p_best = df[df['net.sta'] == f'{self.net}.{self.sta}'].sort_values(by='best_f1', ascending=False).iloc[0].to_dict()
-        return p_best
+        return load_best_p_params(self.best_p_csv, self.net, self.sta)
     
     @property
     def _current_exc_params(self):
-        """function that reads from a file called current_exc.txt
-        the values of times_paths['P'] or times_paths['S'], picks_dir, inv_xml, and debug
-        """
-        with open('current_exc.txt', 'r') as f:
-            lines = f.readlines()
-        dic = {}
-        for line in lines:
-            line = line.strip('\n').strip(' ')
-            if line == '' or '=' not in line:
-                continue
-            key, value = line.split('=', 1)
-            dic[key.strip()] = value.strip()
-        return dic
+        """values of the execution context: times_file, picks_dir, inv_xml,
+        debug, the station codes, the engine and the trial cache settings
+        """
+        return self.context.exc_params
 
     @property
     def debug(self):
@@ -76,44 +92,88 @@ class StaLta:
     def phase(self):
         return ic(self.times_file_name.split('_')[-2])
     
+    @property
+    def dataset(self):
+        """
+        StationDataset of the times file, parsed once per process
+        """
+        return StationDataset.load(self.times_file)
+
     @property
     def lines(self):
-        with open(self.times_file, 'r') as f:
-            return f.readlines()
+        return self.dataset.lines
     
     @property
     def N(self):
-        return len(self.lines)
+        return len(self.dataset)
     
     @property
     def max_workers(self):
         """
-        Get the maximum number of workers if debug is false
+        Get the maximum number of workers if debug is false: the CPUs
+        available to the process (affinity and cgroup quota)
         """
         if self.debug:
             return 1
         else:
-            return int(os.cpu_count() * 1)
+            return available_cpus()
+
+    def select_engine(self, engine=None, config_db_path=None):
+        """
+        Return the engine used to pick: the numpy engine only handles the
+        phases it can emulate and the parameter sets rendered by the tuner,
+        everything else runs through scautopick
+        """
+        engine = engine or self.engine
+        if engine != 'numpy':
+            return 'scautopick'
+        if config_db_path is not None or self.phase not in numpy_picker.SUPPORTED_PHASES:
+            return 'scautopick'
+        return 'numpy'
 
     def mega_sta_lta(self, config_db_path=None, collect_pick_level=False,
-                     pick_match_unc=None, xml_output_path=None, **kwargs):
+                     pick_match_unc=None, xml_output_path=None, engine=None,
+                     sample_level=True, write_picks=None, on_chunk=None,
+                     chunk_size=None, **kwargs):
         """
-        Compute sta/lta for all lines in the file
+        Compute sta/lta for all lines in the file. Returns the sample level
+        counts (None if sample_level is False), and the pick level counts too
+        when collect_pick_level is True. scautopick picks are only written to
+        picks_dir if write_picks is True (default: in debug mode). Writing
+        the config xml or the picks always runs scautopick.
+
+        If on_chunk is given, the waveforms are evaluated in chunks of
+        chunk_size and on_chunk(chunk, n_evaluated, sample_counts, pick_counts)
+        is called with the running counts after each chunk. It may raise (e.g.
+        optuna.TrialPruned) to stop the evaluation
         """
         kwargs.update(self._current_exc_params)
-        self.remove_picks_dir()
+        # the numpy engine writes neither the config xml nor the picks
+        if xml_output_path is not None or write_picks:
+            engine = 'scautopick'
+        self.active_engine = self.select_engine(engine, config_db_path)
         self.collect_pick_level = collect_pick_level
+        self.sample_level = sample_level
+        self.write_picks = self.debug if write_picks is None else write_picks
         self.pick_match_unc = BinaryTransform.unc if pick_match_unc is None else float(pick_match_unc)
-        if config_db_path is None:
-            self.edit_xml_config(output_xml_path=xml_output_path, **kwargs)
+        if self.active_engine == 'numpy':
+            for key, value in DEFAULT_VALUES.items():
+                kwargs.setdefault(key, value)
+            self.numpy_picker = numpy_picker.NumpyPicker(kwargs)
         else:
-            self.xml_exc_path = config_db_path
+            if self.write_picks:
+                self.remove_picks_dir()
+            if config_db_path is None:
+                with profiling.stage('config'):
+                    self.edit_xml_config(output_xml_path=xml_output_path, **kwargs)
+            else:
+                self.xml_exc_path = config_db_path
+            self.batch_picks = {}
         
+        sample_counts = {'tp': 0, 'fp': 0, 'fn': 0, 'tn': 0}
+        pick_counts = {'tp': 0, 'fp': 0, 'fn': 0}
         Y_obs_ = []
         Y_pred_ = []
-        tp_total = 0
-        fp_total = 0
-        fn_total = 0
         """for line in self.lines:
             self.exc_read_transform(line)
             Y_obs_.append(self.y_obs)
@@ -122,105 +182,228 @@ class StaLta:
         Y_obs = np.concatenate(Y_obs_)
         Y_pred = np.concatenate(Y_pred_)"""
         
-        # self.max_workers
-        # execute scautopick in parallel and saving the results in Y_obs and Y_pred
-        with ProcessPoolExecutor(max_workers=self.max_workers) as excecutor:
-            for result in excecutor.map(self.exc_read_transform, self.lines):
+        records = self.dataset.records
+        chunks = [list(range(len(records)))]
+        if on_chunk is not None:
+            chunks = self.evaluation_chunks(chunk_size)
+        n_evaluated = 0
+        for chunk, indexes in enumerate(chunks, 1):
+            for i, pick_times in zip(indexes, self.map_lines(indexes)):
+                counts, line_pick_counts = self.exc_read_transform(records[i], pick_times)
+                if self.sample_level:
+                    add_counts(sample_counts, counts)
                 if self.collect_pick_level:
-                    y_obs, y_pred, tp_i, fp_i, fn_i = result
-                    tp_total += tp_i
-                    fp_total += fp_i
-                    fn_total += fn_i
-                else:
-                    y_obs, y_pred = result
-                Y_obs_.append(y_obs)
-                Y_pred_.append(y_pred)
-
-        if len(Y_obs_) == 0:
-            Y_obs = np.array([])
-            Y_pred = np.array([])
-        else:
-            Y_obs = np.concatenate(Y_obs_)
-            Y_pred = np.concatenate(Y_pred_)
-                                
-        ic(Y_obs)
-        ic(Y_pred)
-        ic(np.unique(Y_obs))
-        ic(np.unique(Y_pred))
+                    add_counts(pick_counts, line_pick_counts)
+                # the dense binary series are only built for the debug plots
+                if self.debug:
+                    Y_obs_.append(self.y_obs)
+                    Y_pred_.append(self.y_pred)
+            n_evaluated += len(indexes)
+            if on_chunk is not None:
+                on_chunk(chunk, n_evaluated, sample_counts, pick_counts)
+
+        ic(sample_counts)
         # plot if debug is true
-        if self.debug:
+        if self.debug and len(Y_obs_) > 0:
             print('\n\nFinishing mega_sta_lta')
             print('Running test_binary_times...\n')
-            self.test_binary_times(Y_obs, Y_pred)
+            self.test_binary_times(np.concatenate(Y_obs_), np.concatenate(Y_pred_))
+        if not self.sample_level:
+            sample_counts = None
         if self.collect_pick_level:
-            pick_counts = {'tp': tp_total, 'fp': fp_total, 'fn': fn_total}
-            return Y_obs, Y_pred, pick_counts
-        return Y_obs, Y_pred
+            return sample_counts, pick_counts
+        return sample_counts
+
+    @property
+    def trial_state(self):
+        """
+        Small picklable dict with what a pool worker needs to pick a line
+        """
+        state = dict(self._current_exc_params)
+        state.update({
+            'active_engine': self.active_engine,
+            'xml_exc_path': self.xml_exc_path,
+            'write_picks': self.write_picks,
+            'context': self.context,
+            # workers collect their stages while this process does
+            'profiling': profiling.active(),
+        })
+        return state
+
+    @property
+    def cache(self):
+        """
+        TrialCache of scautopick pick times, None if the cache is disabled
+        """
+        if not self.trial_cache:
+            return None
+        return get_cache(self.trial_cache, self.trial_cache_size)
 
-    def exc_read_transform(self, line):
-        self.sta_lta_compute(line)
+    def cache_keys(self, records):
+        """
+        Cache key of every record for the current scautopick configuration,
+        None if some file cannot be hashed
+        """
         try:
-            # get pick times
-            self.pick_times = XMLPicks(self.pick_path, self.phase).get_pick_times()
-            # print(f'self.pick_path: {self.pick_path}')
-            # print(f'self.pick_times: {self.pick_times}')
-            # print(f'self.phase: {self.phase}')
-        except TypeError:
-            ic()
-            # if no pick is found, set pick times to empty list
-            self.pick_times = []
-        except KeyError:
-            ic()
-            self.pick_times = []
-        except (ValueError, ET.ParseError, FileNotFoundError):
-            ic()
-            self.pick_times = []
-            
-        # transform predicted times into a binary time series
-        y_pred = BinaryTransform(self.wf_start_time,
-                                      self.sample_rate,
-                                      self.npts,
-                                      self.pick_times).transform()
-        y_obs = BinaryTransform(self.wf_start_time,
-                                     self.sample_rate,
-                                     self.npts,
-                                     self.ph_time).transform()
+            with open(self.xml_exc_path, 'rb') as f:
+                config = f.read()
+            inventory = file_digest(self.inv_xml)
+            return [entry_key(config, inventory, file_digest(record.wf_path),
+                              self.phase, self.batched)
+                    for record in records]
+        except OSError:
+            return None
+
+    def evaluation_order(self):
+        """
+        Deterministic order in which the records are evaluated by chunks:
+        events and noise windows interleaved, so every chunk prefix is a
+        stratified subset of the station waveforms
+        """
+        return self.dataset.stratified_order
+
+    def evaluation_chunks(self, chunk_size=None):
+        """
+        Record indexes of evaluation_order split in chunks of chunk_size
+        """
+        order = self.evaluation_order()
+        chunk_size = max(1, int(chunk_size or len(order) or 1))
+        return [order[i:i + chunk_size] for i in range(0, len(order), chunk_size)]
+
+    def map_lines(self, indexes=None):
+        """
+        Return the pick times of the given lines (all by default) of the times
+        file. scautopick runs are spread over the shared EvaluationPool (or a
+        pool created for this call) and skipped for lines found in the trial
+        cache, the numpy engine runs in this process so its waveforms stay
+        loaded between trials
+        """
+        all_records = self.dataset.records
+        if indexes is None:
+            indexes = list(range(len(all_records)))
+        records = [all_records[i] for i in indexes]
+        if self.active_engine == 'numpy':
+            return [self.pick_line(record) for record in records]
+
+        cache = self.cache
+        with profiling.stage('cache'):
+            keys = self.cache_keys(records) if cache is not None else None
+            # the pick files asked for are only written by scautopick runs
+            cached = cache.get_many(keys) if keys and not self.write_picks else {}
+        profiling.count('cache_hits', len(cached))
+        results = [cached.get(key) for key in keys] if keys else [None] * len(records)
+        todo = [i for i, times in enumerate(results) if times is None]
+        if not todo:
+            return results
+
+        # wall time of the picks, the workers report their own stages
+        with profiling.stage('pick'):
+            if self.batched:
+                picked = self.pick_batches([indexes[i] for i in todo])
+            elif self.pool is not None:
+                picked = self.pool.map_lines(self.trial_state, [indexes[i] for i in todo])
+            else:
+                with ProcessPoolExecutor(max_workers=self.max_workers) as excecutor:
+                    picked = list(excecutor.map(self.pick_line, [records[i] for i in todo]))
+        for i, times in zip(todo, picked):
+            results[i] = times
+        if keys:
+            with profiling.stage('cache'):
+                cache.put_many({keys[i]: results[i] for i in todo})
+        return results
+
+    def pick_line(self, record):
+        """
+        Run the picker on the waveform of a record and return its pick times
+        """
+        self.sta_lta_compute(record)
+        self.read_pick_times()
+        return self.pick_times
+
+    def exc_read_transform(self, record, pick_times=None):
+        if pick_times is None:
+            self.pick_line(record)
+        else:
+            self.use_record(record)
+            self.pick_times = pick_times
+
+        profiling.count('waveforms')
+        profiling.count('picks', len(self.pick_times))
+        # sample level confusion counts from the pick intervals
+        pred = BinaryTransform(self.wf_start_time,
+                               self.sample_rate,
+                               self.npts,
+                               self.pick_times)
+        counts = None
+        if self.sample_level:
+            with profiling.stage('binary_transform'):
+                counts = interval_counts(record.obs_intervals, pred.intervals(), self.npts)
         if self.debug:
+            self.y_pred = pred.transform()
+            self.y_obs = BinaryTransform(self.wf_start_time,
+                                         self.sample_rate,
+                                         self.npts,
+                                         self.ph_time).transform()
             print('\n\nFinishing exc_read_transform')
             print('Running test_binary_time...\n')
-            self.test_binary_time(y_pred)
+            self.test_binary_time(self.y_pred)
+        pick_counts = None
         if self.collect_pick_level:
-            pick_counts = self._match_pick_times(self.ph_time, self.pick_times,
-                                                 self.pick_match_unc)
-            return y_obs, y_pred, pick_counts['tp'], pick_counts['fp'], pick_counts['fn']
-        return y_obs, y_pred
+            with profiling.stage('pick_match'):
+                pick_counts = self._match_pick_times(self.ph_time, self.pick_times,
+                                                     self.pick_match_unc)
+        return counts, pick_counts
+
+    def read_pick_times(self):
+        """
+        Set self.pick_times from the numpy engine or from the scautopick output
+        """
+        if self.active_engine == 'numpy':
+            with profiling.stage('numpy_pick'):
+                wf = numpy_picker.load_waveform(self.wf_path, self.ch)
+                self.pick_times = self.numpy_picker.pick_times(wf, self.phase)
+            return
+        # parsed by run_scautopick from the scautopick output
+        self.pick_times = self.scautopick_picks
+
+    def validate_engine(self, tolerance_seconds=None, **kwargs):
+        """
+        Run scautopick and the numpy engine with the same parameters on every
+        waveform and compare their pick times
+        """
+        if tolerance_seconds is None:
+            tolerance_seconds = numpy_picker.VALIDATION_TOLERANCE
+        kwargs.update(self._current_exc_params)
+        for key, value in DEFAULT_VALUES.items():
+            kwargs.setdefault(key, value)
+        self.active_engine = 'scautopick'
+        self.write_picks = self.debug
+        if self.write_picks:
+            self.remove_picks_dir()
+        self.edit_xml_config(**kwargs)
+        self.numpy_picker = numpy_picker.NumpyPicker(kwargs)
+
+        rows = []
+        for record in self.dataset.records:
+            self.active_engine = 'scautopick'
+            self.sta_lta_compute(record)
+            self.read_pick_times()
+            reference_times = self.pick_times
+            self.active_engine = 'numpy'
+            self.read_pick_times()
+            row = numpy_picker.compare_pick_times(reference_times, self.pick_times,
+                                                  tolerance_seconds)
+            row['wf_path'] = self.wf_path
+            rows.append(row)
+        return rows
 
     @staticmethod
     def _match_pick_times(obs_times, pred_times, tolerance_seconds):
         """
         One-to-one greedy matching of observed and predicted pick times.
         """
-        obs = sorted(float(t) for t in obs_times)
-        pred = sorted(float(t) for t in pred_times)
-
-        i = 0
-        j = 0
-        tp = 0
-
-        while i < len(obs) and j < len(pred):
-            dt = pred[j] - obs[i]
-            if abs(dt) <= tolerance_seconds:
-                tp += 1
-                i += 1
-                j += 1
-            elif pred[j] < obs[i] - tolerance_seconds:
-                j += 1
-            else:
-                i += 1
-
-        fp = len(pred) - tp
-        fn = len(obs) - tp
-        return {'tp': tp, 'fp': fp, 'fn': fn}
+        tp = len(numpy_picker.match_pick_times(obs_times, pred_times, tolerance_seconds))
+        return {'tp': tp, 'fp': len(pred_times) - tp, 'fn': len(obs_times) - tp}
 
     def time2sample(self, time: UTCDateTime):
         """
@@ -279,29 +462,48 @@ class StaLta:
                 except FileNotFoundError:
                     pass
         
-    def sta_lta_compute(self, line: str):
+    def sta_lta_compute(self, record):
         """
-        Compute sta/lta for a single line
+        Compute sta/lta for a single record
         """
-        fields = line.split(',')
-        pick_value = fields[1].strip("\n\r")
-        if pick_value in ['', 'NO_PICK']:
-            self.ph_time = []
-        else:
-            self.ph_time = [obspy.UTCDateTime(pick_value)]
-        # get the initial waveform time
-        self.wf_start_time = obspy.UTCDateTime(fields[2].strip("\n\r"))
-        # get the sample rate
-        self.sample_rate = float(fields[3].strip("\n\r"))
-        # get the number of samples
-        self.npts = int(fields[4].strip("\n\r"))
-        self.wf_path = fields[0]
-        
-        self.run_scautopick()
+        self.use_record(record)
+        if self.active_engine == 'scautopick':
+            self.run_scautopick()
+
+    def parse_line(self, line: str):
+        """
+        Set the manual pick and the waveform metadata of a times file line
+        """
+        self.use_record(WaveformRecord.from_line(line))
+
+    def use_record(self, record):
+        """
+        Set the manual pick and the waveform metadata of a dataset record
+        """
+        self.ph_time = record.ph_time
+        self.wf_start_time = record.wf_start_time
+        self.sample_rate = record.sample_rate
+        self.npts = record.npts
+        self.wf_path = record.wf_path
     
     @property
     def xml_exc_name(self):
         return f'exc_{self.station_name}_{self.phase}.xml'
+
+    @property
+    def trial_xml_path(self):
+        """
+        Path of the trial config: on tmpfs when available (removed at exit),
+        in the working directory in debug mode so it can be inspected
+        """
+        config_dir = None if self.debug else trial_config_dir()
+        if config_dir is None:
+            return os.path.join(os.getcwd(), self.xml_exc_name)
+        path = os.path.join(config_dir, f'{os.getpid()}_{self.xml_exc_name}')
+        if path not in _TRIAL_XML_PATHS:
+            _TRIAL_XML_PATHS.add(path)
+            atexit.register(_remove_file, path)
+        return path
     
     @staticmethod
     def _pretty_xml_text(xml_text):
@@ -352,28 +554,38 @@ class StaLta:
         kwargs.update(render_config_param_templates(kwargs))
     
         ic(xml_filename)
-        # xml path for the template
-        xml_path = os.path.join(self.main_dir, 'bindings', xml_filename)
-        with open(xml_path, 'r') as f:
-            xml_str = f.read()
-        
+        xml_rendered = xml_config_template(xml_filename).render(kwargs)
+
         # xml path for the excecution of scautopick
-        self.xml_exc_path = output_xml_path or os.path.join(os.getcwd(), self.xml_exc_name)
+        if output_xml_path:
+            self.xml_exc_path = output_xml_path
+            # only the configs kept as results are pretty printed
+            xml_rendered = self._pretty_xml_text(xml_rendered)
+        else:
+            self.xml_exc_path = self.trial_xml_path
         xml_out_dir = os.path.dirname(self.xml_exc_path)
         if xml_out_dir:
             os.makedirs(xml_out_dir, exist_ok=True)
-        # Edit the config.xml file
-        xml_rendered = self._pretty_xml_text(xml_str.format(**kwargs))
-        with open(self.xml_exc_path, 'w') as f:
-            f.write(ic(xml_rendered))
+        with open(self.xml_exc_path, 'wb') as f:
+            f.write(xml_rendered.encode('utf-8'))
+        if self.debug:
+            ic(xml_rendered)
     
     def run_scautopick(self):
         """
         Run scautopick
         """
+        self.scautopick_picks = self.scautopick_pick_times(
+            self.wf_path, self.pick_path if self.write_picks else None)
+
+    def scautopick_pick_times(self, wf_path, pick_path=None):
+        """
+        Run scautopick on wf_path and return the pick times of the phase
+        parsed from its output, which is also copied to pick_path if given
+        """
         cmd = [
             'scautopick',
-            '-I', self.wf_path,
+            '-I', wf_path,
             '--config-db', self.xml_exc_path,
             '--amplitudes', '0',
             '--inventory-db', self.inv_xml,
@@ -381,11 +593,86 @@ class StaLta:
             '--ep',
         ]
         ic(' '.join(cmd))
-        os.makedirs(self.picks_dir, exist_ok=True)
-        with open(self.pick_path, 'w') as out:
-            result = subprocess.run(cmd, stdout=out, check=False)
-        if result.returncode != 0:
-            ic(f'scautopick returned non-zero code {result.returncode} for {self.wf_path}')
+        out = None
+        if pick_path is not None:
+            os.makedirs(self.picks_dir, exist_ok=True)
+            out = open(pick_path, 'wb')
+        profiling.count('scautopick_runs')
+        try:
+            with profiling.stage('scautopick'), \
+                    subprocess.Popen(cmd, stdout=subprocess.PIPE) as process:
+                try:
+                    pick_times = read_pick_stream(process.stdout, self.phase,
+                                                  copy_to=out)
+                except ValueError:
+                    ic()
+                    # no pick is taken from an invalid output
+                    pick_times = []
+                returncode = process.wait()
+        finally:
+            if out is not None:
+                out.close()
+        if returncode != 0:
+            ic(f'scautopick returned non-zero code {returncode} for {wf_path}')
+        return pick_times
+
+    @property
+    def batched(self):
+        return str(self.batch_playback) in ['true', 'True', 'TRUE']
+
+    @property
+    def profiled(self):
+        return str(self.profile) in ['true', 'True', 'TRUE']
+
+    def pick_batches(self, indexes):
+        """
+        Pick the records of indexes with one scautopick playback per batch of
+        consecutive windows (one batch per worker, run in parallel) and return
+        their pick times. Only the batches holding requested records not
+        picked yet are played back. The picks of all their records are kept
+        for the rest of the evaluation, so later chunks of the same trial
+        reuse them
+        """
+        needed = {i for i in indexes if i not in self.batch_picks}
+        todo = [batch for batch in self.playback_batches() if needed & set(batch.indexes)]
+        if todo:
+            with ThreadPoolExecutor(max_workers=len(todo)) as executor:
+                outputs = list(executor.map(self.run_batch, todo))
+            for batch, pick_times in zip(todo, outputs):
+                self.batch_picks.update(zip(batch.indexes, batch.demultiplex(pick_times)))
+        return [self.batch_picks[i] for i in indexes]
+
+    def playback_batches(self):
+        """
+        PlaybackBatches of all the records of the dataset, written once per
+        process and dataset on tmpfs (or next to the times file) and removed
+        when the dataset is released
+        """
+        dataset = self.dataset
+        n_batches = self.pool.max_workers if self.pool is not None else self.max_workers
+        key = os.path.abspath(self.times_file)
+        cached = _BATCHES.get(key)
+        if cached is None or cached[0] is not dataset or len(cached[1]) != min(n_batches, len(dataset)):
+            release_batches(key)
+            batch_dir = trial_config_dir() or os.path.dirname(key)
+            name = os.path.splitext(self.times_file_name)[0]
+            groups = split_in_batches(list(range(len(dataset))), dataset.records, n_batches)
+            batches = []
+            for k, group in enumerate(groups):
+                path = os.path.join(batch_dir, f'{os.getpid()}_{name}_batch{k}.mseed')
+                # removed at exit too if the process stops before the release
+                atexit.register(_remove_file, path)
+                batches.append(PlaybackBatch(path, [dataset.records[i] for i in group],
+                                             group).write())
+            _BATCHES[key] = (dataset, batches)
+        return _BATCHES[key][1]
+
+    def run_batch(self, batch):
+        pick_path = None
+        if self.write_picks:
+            pick_path = os.path.join(self.picks_dir,
+                                     os.path.basename(batch.path).split('.')[0] + '_picks.xml')
+        return self.scautopick_pick_times(batch.path, pick_path)
 
     @property
     def picks_name(self):
@@ -398,43 +685,292 @@ class StaLta:
     def pick_path(self):
         return os.path.join(self.picks_dir, self.picks_name)
 
-class XMLPicks:
-    xml_path: str
-    ns: dict = {'seiscomp': 'http://geofon.gfz-potsdam.de/ns/seiscomp3-schema/0.13'}
-    
-    def __init__(self, xml_path: str, phase: str):
-        self.xml_path = xml_path
+# StaLta objects built by pool workers, keyed by times file
+_WORKER_STALTAS = {}
+
+# StationDatasets parsed in this process, keyed by times file, least
+# recently used first
+_DATASETS = OrderedDict()
+
+# Datasets kept per process (the P and S times files of two stations)
+MAX_DATASETS = 4
+
+# Best P parameters read in this process, keyed by results file and station
+_BEST_P_PARAMS = {}
+
+# PlaybackBatches of the datasets of this process, keyed by times file
+_BATCHES = {}
+
+# Compiled bindings XML templates of this process, keyed by file name
+_XML_TEMPLATES = {}
+
+# tmpfs directory for the per-trial scautopick configs
+TMPFS_DIR = '/dev/shm'
+_TRIAL_XML_PATHS = set()
+
+
+def xml_config_template(xml_filename: str):
+    """
+    CompiledTemplate of a bindings XML template, read once per process
+    """
+    if xml_filename not in _XML_TEMPLATES:
+        xml_path = os.path.join(StaLta.main_dir, 'bindings', xml_filename)
+        with open(xml_path, 'r') as f:
+            _XML_TEMPLATES[xml_filename] = compile_template(f.read())
+    return _XML_TEMPLATES[xml_filename]
+
+
+def load_best_p_params(csv_path: str, net: str, sta: str) -> dict:
+    """
+    Best P parameters of a station in csv_path, read again only if the file
+    changed. Read under the lock of the stations appending to it
+    """
+    key = (os.path.abspath(csv_path), net, sta)
+    with file_lock(csv_path):
+        stat = os.stat(csv_path)
+        version = (stat.st_size, stat.st_mtime_ns)
+        cached = _BEST_P_PARAMS.get(key)
+        if cached is None or cached[0] != version:
+            df = pd.read_csv(csv_path)
+            # selecting the row of the station with the highest value of best_f1
+            p_best = df[df['net.sta'] == f'{net}.{sta}'].sort_values(by='best_f1', ascending=False).iloc[0].to_dict()
+            cached = (version, p_best)
+            _BEST_P_PARAMS[key] = cached
+    return dict(cached[1])
+
+
+def trial_config_dir():
+    """
+    Writable tmpfs directory for trial configs, None if there is none
+    """
+    if not os.path.isdir(TMPFS_DIR) or not os.access(TMPFS_DIR, os.W_OK):
+        return None
+    config_dir = os.path.join(TMPFS_DIR, f'sc3-autotuner-{os.getuid()}')
+    try:
+        os.makedirs(config_dir, exist_ok=True)
+    except OSError:
+        return None
+    return config_dir
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _init_worker(times_file):
+    """
+    Pool worker initializer: parse the dataset of the evaluation starting the
+    pool and keep its StaLta in the worker state, so the first tasks do not
+    pay for it
+    """
+    if times_file is None:
+        return
+    sta_lta = StaLta.__new__(StaLta)
+    sta_lta.times_file = times_file
+    try:
+        sta_lta.dataset
+    except OSError:
+        # the first task reports the error
+        return
+    _WORKER_STALTAS[times_file] = sta_lta
+
+
+def _warm_up_worker(_):
+    """
+    Force a pool worker to start so the first trial does not pay for it
+    """
+    return os.getpid()
+
+
+def _worker_pick_line(task):
+    """
+    Pick one record of a times file in a pool worker. The worker keeps a
+    StaLta per times file and the dataset stays parsed between tasks, only
+    the trial state travels with each task
+    """
+    state, index = task
+    sta_lta = _WORKER_STALTAS.get(state['times_file'])
+    if sta_lta is None:
+        sta_lta = StaLta.__new__(StaLta)
+        _WORKER_STALTAS[state['times_file']] = sta_lta
+    sta_lta.__dict__.update(state)
+    if not state.get('profiling'):
+        return sta_lta.pick_line(sta_lta.dataset.records[index])
+    with profiling.collect() as profile:
+        pick_times = sta_lta.pick_line(sta_lta.dataset.records[index])
+    return pick_times, profile.as_dict()
+
+
+class EvaluationPool:
+    """
+    Process pool shared by all the trials of a campaign, so trials do not pay
+    for the pool spin-up, the module imports and the dataset parsing in the
+    workers or the pickling of a whole StaLta object per task. With a WorkerAutotuner the number of
+    workers is adapted to the throughput of the first evaluations.
+    """
+    def __init__(self, max_workers=None, autotuner=None):
+        self.autotuner = autotuner
+        if autotuner is not None:
+            max_workers = autotuner.initial_workers()
+        self.max_workers = max_workers or available_cpus()
+        self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+    def start(self, times_file=None):
+        """
+        Start the workers if they are not running yet, with the dataset of
+        times_file already loaded in each of them
+        """
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                initializer=_init_worker,
+                                                initargs=(times_file,))
+            list(self.executor.map(_warm_up_worker, range(self.max_workers)))
+        return self.executor
+
+    def map_lines(self, state, indexes):
+        """
+        Return the pick times of the given lines of state['times_file'] with
+        the trial state
+        """
+        executor = self.start(state['times_file'])
+        tasks = [(state, index) for index in indexes]
+        start = time.perf_counter()
+        try:
+            results = list(executor.map(_worker_pick_line, tasks))
+        except BrokenProcessPool:
+            # start a fresh pool on the next trial
+            self.shutdown()
+            raise
+        if self.autotuner is not None:
+            self.resize(self.autotuner.record(self.max_workers, len(tasks),
+                                              time.perf_counter() - start))
+        if not state.get('profiling'):
+            return results
+        for _, profile in results:
+            profiling.merge(profile)
+        return [pick_times for pick_times, _ in results]
+
+    def resize(self, max_workers):
+        """
+        Use max_workers workers from the next evaluation on
+        """
+        if max_workers != self.max_workers:
+            self.shutdown()
+            self.max_workers = max_workers
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+
+class PickStreamParser:
+    """
+    Incremental parser of scautopick --ep output that only keeps the time of
+    the EventParameters picks of a phase. Namespace agnostic, so any
+    seiscomp schema version is accepted
+    """
+    def __init__(self, phase: str):
         self.phase = phase
-        self.check_ns_url_match()  # Ensure ns URL matches before proceeding
+        self.times = []
+        self.path = []
+        self.parser = ET.XMLPullParser(events=('start', 'end'))
+
+    @staticmethod
+    def local_name(tag):
+        return tag.rsplit('}', 1)[-1]
 
-    def check_ns_url_match(self):
+    def feed(self, data: bytes):
+        self.parser.feed(data)
+        self.read_events()
+
+    def close(self):
         """
-        Update parser namespace from the XML root if present.
+        Return the pick times, raise ValueError if the output is not valid XML
         """
         try:
-            tree = ET.parse(self.xml_path)
-            root = tree.getroot()
-            if root.tag.startswith('{') and '}' in root.tag:
-                file_ns_url = root.tag[1:root.tag.find("}")]
-                self.ns = {'seiscomp': file_ns_url}
+            self.parser.close()
+        except ET.ParseError as e:
+            raise ValueError(f'Failed to parse scautopick output: {e}')
+        return self.times
+
+    def read_events(self):
+        try:
+            events = list(self.parser.read_events())
         except ET.ParseError as e:
-            raise ValueError(f"Failed to parse XML file '{self.xml_path}': {str(e)}")
+            raise ValueError(f'Failed to parse scautopick output: {e}')
+        for event, elem in events:
+            if event == 'start':
+                self.path.append(self.local_name(elem.tag))
+                continue
+            if self.path[-2:] == ['EventParameters', 'pick']:
+                self.add_pick(elem)
+                elem.clear()
+            self.path.pop()
+
+    def add_pick(self, pick):
+        phase_hint = None
+        time = None
+        for child in pick:
+            name = self.local_name(child.tag)
+            if name == 'phaseHint':
+                phase_hint = child.text
+            elif name == 'time':
+                for value in child:
+                    if self.local_name(value.tag) == 'value':
+                        time = value.text
+        if phase_hint == self.phase and time:
+            ic(time)
+            self.times.append(obspy.UTCDateTime(time))
+
+
+def read_pick_stream(stream, phase: str, copy_to=None):
+    """
+    Parse the pick times of phase from a binary stream with scautopick
+    output, copying the raw output to copy_to if given. The stream is always
+    read to the end so the writing process never blocks on a full pipe
+    """
+    parser = PickStreamParser(phase)
+    error = None
+    for chunk in iter(lambda: stream.read(1 << 16), b''):
+        if copy_to is not None:
+            copy_to.write(chunk)
+        if error is None:
+            try:
+                with profiling.stage('parse'):
+                    parser.feed(chunk)
+            except ValueError as e:
+                error = e
+    if error is not None:
+        raise error
+    return parser.close()
+
+
+class XMLPicks:
+    xml_path: str
+    
+    def __init__(self, xml_path: str, phase: str):
+        self.xml_path = xml_path
+        self.phase = phase
 
     def open_dict_time(self, x):
         return x['value']
 
     def get_pick_times(self):
         """
-        Return automatic pick times from an XML file.
+        Return automatic pick times from an XML file, parsed in one pass.
         """
-        times = []
-        root = ET.parse(self.xml_path).getroot()
-        for pick in root.findall('seiscomp:EventParameters/seiscomp:pick', self.ns):
-            if self.phase == pick.find('seiscomp:phaseHint', self.ns).text:
-                time = pick.find('seiscomp:time/seiscomp:value', self.ns).text
-                ic(time)
-                times.append(obspy.UTCDateTime(time))
-        return times
+        with open(self.xml_path, 'rb') as f:
+            return read_pick_stream(f, self.phase)
 
 
     """def get_pick_times(self):
@@ -491,3 +1027,178 @@ class BinaryTransform:
         n_p_i = int(t_r_p_i*df)
         n_p_f = int(t_r_p_f*df)
         return n_p_i, n_p_f
+
+    def intervals(self):
+        """
+        Merged [start, end) sample intervals set to 1 by transform, without
+        allocating the time series
+        """
+        spans = []
+        for ph_time in self.ph_times:
+            n_ph_i, n_ph_f = self.phase_point(ph_time,
+                                              self.wf_start_time,
+                                              self.sample_rate,
+                                              self.unc)
+            # same bounds as z[n_ph_i:n_ph_f] (negative indexes included)
+            start, end, _ = slice(n_ph_i, n_ph_f).indices(self.npts)
+            if end > start:
+                spans.append((start, end))
+        spans.sort()
+        merged = []
+        for start, end in spans:
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        return [tuple(span) for span in merged]
+
+
+def interval_counts(obs_intervals: list, pred_intervals: list, npts: int) -> dict:
+    """
+    Sample level tp, fp, fn and tn of two lists of merged intervals, equal to
+    the confusion matrix of the binary time series they represent
+    """
+    obs_total = sum(end - start for start, end in obs_intervals)
+    pred_total = sum(end - start for start, end in pred_intervals)
+    tp = 0
+    i = j = 0
+    while i < len(obs_intervals) and j < len(pred_intervals):
+        start = max(obs_intervals[i][0], pred_intervals[j][0])
+        end = min(obs_intervals[i][1], pred_intervals[j][1])
+        if end > start:
+            tp += end - start
+        if obs_intervals[i][1] < pred_intervals[j][1]:
+            i += 1
+        else:
+            j += 1
+    fp = pred_total - tp
+    fn = obs_total - tp
+    return {'tp': tp, 'fp': fp, 'fn': fn, 'tn': npts - tp - fp - fn}
+
+
+def add_counts(total: dict, counts: dict):
+    """
+    Add counts to total in place
+    """
+    for key, value in counts.items():
+        total[key] = total.get(key, 0) + value
+    return total
+
+
+@dataclass
+class WaveformRecord:
+    """
+    Waveform metadata and ground truth of one times file line
+    """
+    wf_path: str
+    ph_time: list
+    wf_start_time: UTCDateTime
+    sample_rate: float
+    npts: int
+    obs_intervals: list
+
+    @classmethod
+    def from_line(cls, line: str):
+        fields = [field.strip("\n\r") for field in line.split(',')]
+        pick_value = fields[1]
+        if pick_value in ['', 'NO_PICK']:
+            ph_time = []
+        else:
+            ph_time = [obspy.UTCDateTime(pick_value)]
+        wf_start_time = obspy.UTCDateTime(fields[2])
+        sample_rate = float(fields[3])
+        npts = int(fields[4])
+        obs_intervals = BinaryTransform(wf_start_time, sample_rate, npts,
+                                        ph_time).intervals()
+        return cls(fields[0], ph_time, wf_start_time, sample_rate, npts,
+                   obs_intervals)
+
+
+class StationDataset:
+    """
+    Times file of a station phase parsed once, with the manual picks already
+    turned into sample intervals. The labels never change during a study so
+    every trial and evaluation reuses the same records
+    """
+    def __init__(self, times_file: str):
+        self.times_file = times_file
+        with open(times_file, 'r') as f:
+            self.lines = [line for line in f.readlines() if line.strip()]
+        self.records = [WaveformRecord.from_line(line) for line in self.lines]
+        self._stratified_order = None
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def stratified_order(self):
+        """
+        Record indexes with the windows with and without manual pick
+        interleaved in proportion to their counts, each group in file order
+        """
+        if self._stratified_order is None:
+            groups = [[i for i, record in enumerate(self.records) if record.ph_time],
+                      [i for i, record in enumerate(self.records) if not record.ph_time]]
+            groups = [group for group in groups if group]
+            taken = [0] * len(groups)
+            order = []
+            for _ in range(len(self.records)):
+                # group furthest behind its share of the records taken so far
+                k = min(range(len(groups)),
+                        key=lambda g: (taken[g] + 1) / len(groups[g]))
+                order.append(groups[k][taken[k]])
+                taken[k] += 1
+            self._stratified_order = order
+        return list(self._stratified_order)
+
+    @classmethod
+    def load(cls, times_file: str):
+        """
+        Return the dataset of times_file, parsed again only if the file changed
+        """
+        stat = os.stat(times_file)
+        key = os.path.abspath(times_file)
+        version = (stat.st_size, stat.st_mtime_ns)
+        cached = _DATASETS.get(key)
+        if cached is None or cached[0] != version:
+            cached = (version, cls(times_file))
+            _DATASETS[key] = cached
+        _DATASETS.move_to_end(key)
+        while len(_DATASETS) > MAX_DATASETS:
+            release_dataset(next(iter(_DATASETS)))
+        return cached[1]
+
+
+def release_dataset(times_file: str):
+    """
+    Forget the dataset of times_file in this process, with its worker StaLta
+    and the loaded waveforms no other dataset uses
+    """
+    cached = _DATASETS.pop(os.path.abspath(times_file), None)
+    if cached is None:
+        return
+    dataset = cached[1]
+    _WORKER_STALTAS.pop(dataset.times_file, None)
+    release_batches(os.path.abspath(times_file))
+    in_use = {record.wf_path for _, other in _DATASETS.values() for record in other.records}
+    numpy_picker.release_waveforms(record.wf_path for record in dataset.records
+                                   if record.wf_path not in in_use)
+
+
+def release_batches(times_file: str):
+    """
+    Remove the batch playback files of times_file written by this process
+    """
+    cached = _BATCHES.pop(os.path.abspath(times_file), None)
+    if cached is not None:
+        for batch in cached[1]:
+            _remove_file(batch.path)
+
+
+def release_datasets(data_dir: str):
+    """
+    Release the datasets of the times files in data_dir (a station finished)
+    """
+    data_dir = os.path.abspath(data_dir)
+    for key in [key for key in _DATASETS if os.path.dirname(key) == data_dir]:
+        release_dataset(key)
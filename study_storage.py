@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent storage of the Optuna studies
+
+Studies are stored in a local SQLite database or journal file under a name
+made of the station codes, the phase and a fingerprint of the data they are
+scored on, so a rerun of the tuner resumes the unfinished studies (or adds
+trials to the finished ones) and several local processes can attach to the
+same study and run its trials in parallel.
+"""
+import hashlib
+import json
+import os
+from dataclasses import dataclass
+
+import optuna
+from optuna.storages import JournalStorage, RDBStorage
+from optuna.trial import TrialState
+
+from config_params import DEFAULT_VALUES, OPTIMIZATION_PARAMS
+from trial_cache import file_digest
+
+STORAGES = ('none', 'sqlite', 'journal')
+
+DEFAULT_STORAGE_PATHS = {'sqlite': 'optuna_studies.sqlite',
+                         'journal': 'optuna_studies.log'}
+
+# Seconds between heartbeats of the running trials (sqlite storage). Trials
+# without a heartbeat for HEARTBEAT_GRACE seconds (their process died) are
+# failed and enqueued again
+HEARTBEAT_INTERVAL = 60
+HEARTBEAT_GRACE = 180
+
+# Trial states counted as done when resuming a study
+DONE_STATES = (TrialState.COMPLETE, TrialState.PRUNED)
+
+# Storages opened in this process, keyed by (kind, path)
+_STORAGES = {}
+
+
+def space_digest(phase: str) -> str:
+    """
+    Digest of the search space and the fixed parameters of a phase
+    """
+    space = {'space': OPTIMIZATION_PARAMS[phase], 'fixed': DEFAULT_VALUES}
+    return hashlib.sha256(json.dumps(space, sort_keys=True).encode()).hexdigest()
+
+
+def data_fingerprint(times_file: str, metric: str, engine='scautopick',
+                     batched=False, phase='P') -> str:
+    """
+    Short digest of what the trials of a study are scored on and sampled
+    from: the times file (waveforms and pick times), the metric, the engine,
+    the playback mode and the search space of the phase
+    """
+    digest = hashlib.sha256(file_digest(times_file).encode())
+    for part in (metric, engine, 'batch' if batched else 'window', space_digest(phase)):
+        digest.update(b'\0' + part.encode())
+    return digest.hexdigest()[:12]
+
+
+def study_name(net, sta, loc, ch, phase, times_file, metric, engine='scautopick',
+               batched=False) -> str:
+    """
+    Deterministic name of the study of a station phase
+    """
+    fingerprint = data_fingerprint(times_file, metric, engine, batched, phase)
+    return f'{net}.{sta}.{loc}.{ch}.{phase}-{fingerprint}'
+
+
+@dataclass
+class StudyStorage:
+    kind: str = 'none'
+    path: str = ''
+
+    @property
+    def enabled(self):
+        return self.kind != 'none'
+
+    def make(self):
+        """
+        Optuna storage of kind at path, opened once per process. None (in
+        memory study) if the storage is not enabled
+        """
+        if not self.enabled:
+            return None
+        path = os.path.abspath(self.path or DEFAULT_STORAGE_PATHS[self.kind])
+        key = (self.kind, path)
+        if key not in _STORAGES:
+            if self.kind == 'sqlite':
+                _STORAGES[key] = RDBStorage(
+                    f'sqlite:///{path}',
+                    # processes attached to the same study wait for the lock
+                    engine_kwargs={'connect_args': {'timeout': 60}},
+                    heartbeat_interval=HEARTBEAT_INTERVAL,
+                    grace_period=HEARTBEAT_GRACE,
+                    **_retry_stale_trials())
+            else:
+                try:
+                    from optuna.storages.journal import JournalFileBackend
+                except ImportError:  # optuna < 4
+                    from optuna.storages import JournalFileStorage as JournalFileBackend
+                _STORAGES[key] = JournalStorage(JournalFileBackend(path))
+        return _STORAGES[key]
+
+
+def _retry_stale_trials():
+    """
+    RDBStorage argument that enqueues again the trials of dead processes,
+    named as in the installed optuna version
+    """
+    storages = optuna.storages
+    if hasattr(storages, 'RetryHeartbeatStaleTrialCallback'):
+        return {'heartbeat_stale_trial_callback':
+                storages.RetryHeartbeatStaleTrialCallback(max_retry=1)}
+    return {'failed_trial_callback': storages.RetryFailedTrialCallback(max_retry=1)}
+
+
+def trials_target(study, n_trials: int) -> int:
+    """
+    Number of done trials the study must reach in this run: n_trials for a
+    new or unfinished study, n_trials more for a finished one
+    """
+    done = len(study.get_trials(deepcopy=False, states=DONE_STATES))
+    if done >= n_trials:
+        return done + n_trials
+    return n_trials
+
+
+def print_resume(study, target: int):
+    """Print how many trials a persistent study already has"""
+    done = len(study.get_trials(deepcopy=False, states=DONE_STATES))
+    if done:
+        print(f'\n\tResuming study {study.study_name}: {done} trials done, '
+              f'running up to {target}\n')
+
+
+def max_trials_callback(target: int):
+    """
+    Stop the study when target trials are done, counting the trials of
+    every process attached to it
+    """
+    return optuna.study.MaxTrialsCallback(target, states=DONE_STATES)
@@ -0,0 +1,153 @@
+import os
+import sys
+import types
+
+import numpy as np
+import obspy
+
+if 'colorama' not in sys.modules:
+    colorama = types.ModuleType('colorama')
+    colorama.Style = types.SimpleNamespace(BRIGHT='', RESET_ALL='')
+    colorama.Fore = types.SimpleNamespace(LIGHTCYAN_EX='')
+    colorama.init = lambda *args, **kwargs: None
+    colorama.deinit = lambda *args, **kwargs: None
+    sys.modules['colorama'] = colorama
+
+from batch_playback import BATCH_GAP, PlaybackBatch, split_in_batches
+from execution_context import ExecutionContext
+from stalta import EvaluationPool, StaLta, WaveformRecord
+
+START = obspy.UTCDateTime(2020, 1, 1)
+
+
+def _write_station(tmp_path, starts):
+    """Times file with one 200 s window at 10 Hz per start offset."""
+    lines = []
+    for k, offset in enumerate(starts):
+        start = START + offset
+        wf_path = tmp_path / f'evt{k}.BAR2.00.HH_{k}.mseed'
+        trace = obspy.Trace(np.arange(2000, dtype=np.int32),
+                            header={'network': 'CM', 'station': 'BAR2',
+                                    'location': '00', 'channel': 'HHZ',
+                                    'sampling_rate': 10.0, 'starttime': start})
+        obspy.Stream([trace]).write(str(wf_path), format='MSEED')
+        lines.append(f'{wf_path},{start + 100},{start},10.0,2000\n')
+    times_file = tmp_path / 'BAR2_P_HH.txt'
+    times_file.write_text(''.join(lines))
+    return times_file, lines
+
+
+def test_batch_windows_are_ordered_and_separated(tmp_path):
+    # the second and third windows overlap the first one
+    _, lines = _write_station(tmp_path, [300, 0, 100])
+    records = [WaveformRecord.from_line(line) for line in lines]
+    batch = PlaybackBatch(str(tmp_path / 'batch.mseed'), records).write()
+
+    traces = sorted(obspy.read(batch.path), key=lambda tr: tr.stats.starttime)
+    assert len(traces) == 3
+    for previous, trace in zip(traces, traces[1:]):
+        assert trace.stats.starttime - previous.stats.endtime >= BATCH_GAP - 0.1
+    # the earliest window is not shifted
+    assert batch.shifts[1] == 0.0
+
+    pick_times = [batch.window(i)[0] + 100 for i in range(3)] + [START - 3600]
+    picks = batch.demultiplex(pick_times)
+    assert [[str(t) for t in p] for p in picks] == [
+        [str(record.ph_time[0])] for record in records]
+
+
+def test_split_in_batches_keeps_time_order():
+    records = [types.SimpleNamespace(wf_start_time=t) for t in [5, 1, 4, 2, 3]]
+    assert split_in_batches([0, 1, 2, 3, 4], records, 2) == [[1, 3, 4], [2, 0]]
+    assert split_in_batches([0, 1], records, 8) == [[1], [0]]
+
+
+def _fake_scautopick(tmp_path, monkeypatch):
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    script = bin_dir / 'scautopick'
+    script.write_text(
+        "#!/bin/sh\n"
+        f"echo run >> {bin_dir / 'calls.log'}\n"
+        "cat <<'XML'\n"
+        '<seiscomp><EventParameters><pick><phaseHint>P</phaseHint>'
+        '<time><value>2020-01-01T00:01:40.000Z</value></time></pick>'
+        '</EventParameters></seiscomp>\n'
+        "XML\n"
+    )
+    script.chmod(0o755)
+    monkeypatch.setenv('PATH', f"{bin_dir}:{os.environ['PATH']}")
+    monkeypatch.chdir(tmp_path)
+    return bin_dir
+
+
+def _batch_context(tmp_path, times_file):
+    inv_xml = tmp_path / 'inv.xml'
+    inv_xml.write_text('<xml/>')
+    return ExecutionContext(str(times_file), str(tmp_path / 'picks'),
+                            str(inv_xml), False, 'CM', 'HH', '00', 'BAR2',
+                            batch_playback=True)
+
+
+def test_batch_playback_runs_one_scautopick_per_batch(tmp_path, monkeypatch):
+    times_file, _ = _write_station(tmp_path, [0, 3600])
+    bin_dir = _fake_scautopick(tmp_path, monkeypatch)
+    context = _batch_context(tmp_path, times_file)
+
+    with EvaluationPool(max_workers=1) as pool:
+        _, counts = StaLta(pool=pool, context=context).mega_sta_lta(
+            collect_pick_level=True, p_sta=1, p_lta=10, p_fmin=2, p_fmax=10,
+            p_snr=2, trig_on=3.0)
+
+    assert len((bin_dir / 'calls.log').read_text().splitlines()) == 1
+    # the fake pick falls in the first window only
+    assert counts == {'tp': 1, 'fp': 0, 'fn': 1}
+
+
+def test_batches_are_written_once_per_dataset_and_released(tmp_path, monkeypatch):
+    import stalta
+
+    times_file, _ = _write_station(tmp_path, [0, 3600, 7200, 10800])
+    bin_dir = _fake_scautopick(tmp_path, monkeypatch)
+    context = _batch_context(tmp_path, times_file)
+    params = dict(p_sta=1, p_lta=10, p_fmin=2, p_fmax=10, p_snr=2)
+
+    with EvaluationPool(max_workers=2) as pool:
+        for trig_on in (3.0, 4.0):
+            # chunks of one waveform, as with pruning
+            StaLta(pool=pool, context=context).mega_sta_lta(
+                on_chunk=lambda *args: None, chunk_size=1, trig_on=trig_on, **params)
+        batches = stalta._BATCHES[str(times_file)][1]
+
+    # each of the 2 batches played back once per trial
+    assert len((bin_dir / 'calls.log').read_text().splitlines()) == 4
+    assert sorted(i for batch in batches for i in batch.indexes) == [0, 1, 2, 3]
+    assert all(os.path.exists(batch.path) for batch in batches)
+
+    stalta.release_datasets(str(tmp_path))
+    assert str(times_file) not in stalta._BATCHES
+    assert not any(os.path.exists(batch.path) for batch in batches)
+
+
+def test_a_pruned_chunk_plays_back_only_the_batch_covering_it(tmp_path, monkeypatch):
+    import pytest
+
+    class Pruned(Exception):
+        pass
+
+    def prune_after_first_chunk(*args):
+        raise Pruned
+
+    times_file, _ = _write_station(tmp_path, [0, 3600, 7200, 10800])
+    bin_dir = _fake_scautopick(tmp_path, monkeypatch)
+    context = _batch_context(tmp_path, times_file)
+
+    with EvaluationPool(max_workers=2) as pool:
+        sta_lta = StaLta(pool=pool, context=context)
+        with pytest.raises(Pruned):
+            sta_lta.mega_sta_lta(on_chunk=prune_after_first_chunk, chunk_size=1, p_sta=1,
+                                 p_lta=10, p_fmin=2, p_fmax=10, p_snr=2, trig_on=3.0)
+
+    # 2 batches of 2 windows, only the one with the first window is played
+    assert len((bin_dir / 'calls.log').read_text().splitlines()) == 1
+    assert sorted(sta_lta.batch_picks) == [0, 1]
@@ -0,0 +1,106 @@
+import json
+import os
+import sys
+import types
+
+if 'colorama' not in sys.modules:
+    colorama = types.ModuleType('colorama')
+    colorama.Style = types.SimpleNamespace(BRIGHT='', RESET_ALL='')
+    colorama.Fore = types.SimpleNamespace(LIGHTCYAN_EX='')
+    colorama.init = lambda *args, **kwargs: None
+    colorama.deinit = lambda *args, **kwargs: None
+    sys.modules['colorama'] = colorama
+
+BENCH_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                         'benchmarks')
+sys.path.insert(0, BENCH_DIR)
+
+from icecream import ic
+
+import run_benchmarks
+from execution_context import ExecutionContext
+from stalta import StaLta
+from synthetic_data import generate_station
+
+ENV_VARS = ['PATH', 'FAKE_SCAUTOPICK_ONSETS', 'FAKE_SCAUTOPICK_LATENCY',
+            'FAKE_SCAUTOPICK_MODE', 'FAKE_SCAUTOPICK_JITTER',
+            'FAKE_SCAUTOPICK_FALSE_PICKS']
+
+
+def _restore_env(monkeypatch):
+    for name in ENV_VARS:
+        monkeypatch.setenv(name, os.environ.get(name, ''))
+
+
+def test_fake_scautopick_picks_the_synthetic_onsets(tmp_path, monkeypatch):
+    _restore_env(monkeypatch)
+    paths = generate_station(str(tmp_path / 'SYN'), n_events=3, n_noise=1)
+    args = run_benchmarks.parse_args(['--jitter', '0.1'])
+    run_benchmarks.fake_scautopick_env(str(tmp_path), paths, args)
+    monkeypatch.chdir(tmp_path)
+    context = ExecutionContext(paths['P'], str(tmp_path / 'picks_xml'),
+                               paths['inventory'], False, 'XX', 'HH', '00', 'SYN')
+
+    stalta = StaLta(context=context)
+    _, pick_counts = stalta.mega_sta_lta(collect_pick_level=True, **run_benchmarks.P_PARAMS)
+
+    assert pick_counts['tp'] == 3
+    assert pick_counts['fn'] == 0
+
+
+def test_fake_scautopick_demultiplexes_batch_playback(tmp_path, monkeypatch):
+    from stalta import EvaluationPool
+
+    _restore_env(monkeypatch)
+    paths = generate_station(str(tmp_path / 'SYN'), n_events=3, n_noise=1)
+    args = run_benchmarks.parse_args(['--jitter', '0.1', '--false-picks', '1'])
+    run_benchmarks.fake_scautopick_env(str(tmp_path), paths, args)
+    monkeypatch.chdir(tmp_path)
+
+    counts = {}
+    for batched in (False, True):
+        context = ExecutionContext(paths['P'], str(tmp_path / 'picks_xml'),
+                                   paths['inventory'], False, 'XX', 'HH', '00', 'SYN',
+                                   batch_playback=batched)
+        with EvaluationPool(max_workers=2) as pool:
+            _, counts[batched] = StaLta(pool=pool, context=context).mega_sta_lta(
+                collect_pick_level=True, **run_benchmarks.P_PARAMS)
+
+    # the same picks, with one scautopick run per batch of two windows
+    assert counts[True] == counts[False]
+    assert counts[True]['tp'] == 3
+
+
+def test_run_benchmarks_writes_a_row_per_stage_and_worker_count(tmp_path, monkeypatch):
+    _restore_env(monkeypatch)
+    monkeypatch.chdir(tmp_path)
+    output = tmp_path / 'bench.json'
+    try:
+        rows = run_benchmarks.main([
+            '--workers', '1,2', '--stages', 'mega', '--events', '2', '--noise', '1',
+            '--repeat', '1', '--work-dir', str(tmp_path / 'work'),
+            '--output', str(output)])
+    finally:
+        ic.enable()
+
+    assert [(row['stage'], row['workers']) for row in rows] == [
+        ('mega (first call)', 1), ('mega', 1), ('mega (first call)', 2), ('mega', 2)]
+    assert all(row['calls'] == 3 and row['unit'] == 'waveforms/s' for row in rows)
+    assert json.loads(output.read_text()) == rows
+
+
+def test_run_benchmarks_runs_the_tuner_stage_offline(tmp_path, monkeypatch):
+    import subprocess
+
+    _restore_env(monkeypatch)
+    output = tmp_path / 'bench.json'
+    # a fresh interpreter, without the optional dependency stubs of the tests
+    subprocess.run([sys.executable, os.path.join(BENCH_DIR, 'run_benchmarks.py'),
+                    '--workers', '1', '--stages', 'tuner', '--events', '2',
+                    '--noise', '1', '--trials', '1', '--work-dir', str(tmp_path / 'work'),
+                    '--output', str(output)], check=True, capture_output=True)
+
+    rows = json.loads(output.read_text())
+    assert [row['stage'] for row in rows] == ['tuner station', 'tuner download',
+                                              'tuner study']
+    assert rows[-1]['calls'] == 2
@@ -0,0 +1,50 @@
+import os
+import types
+from concurrent.futures import ProcessPoolExecutor
+
+from campaign import file_lock, run_campaign, split_workers
+
+
+def _append_lines(args):
+    path, tag = args
+    for k in range(50):
+        with file_lock(path), open(path, 'a') as f:
+            f.write(f'{tag}-{k}\n')
+
+
+def _tune(job):
+    print(f'tuning {job.name}')
+    if job.name == 'CM.BAD':
+        raise ValueError('no waveforms')
+    return {'name': job.name, 'pid': os.getpid()}
+
+
+def test_file_lock_serializes_appends(tmp_path):
+    path = str(tmp_path / 'results_P.csv')
+    with ProcessPoolExecutor(max_workers=4) as executor:
+        list(executor.map(_append_lines, [(path, tag) for tag in 'abcd']))
+    with open(path) as f:
+        lines = f.read().splitlines()
+    assert len(lines) == 200
+    assert all(len(line.split('-')) == 2 for line in lines)
+
+
+def test_split_workers():
+    assert split_workers(16, 4) == 4
+    assert split_workers(3, 4) == 1
+    assert split_workers(8, 1) == 8
+
+
+def test_run_campaign_keeps_order_and_logs(tmp_path):
+    jobs = [types.SimpleNamespace(name=name) for name in ['CM.BAR2', 'CM.BAD', 'CM.PAM']]
+    log_dir = str(tmp_path / 'logs')
+    results = run_campaign(jobs, _tune, station_workers=2, log_dir=log_dir)
+
+    assert [r and r['name'] for r in results] == ['CM.BAR2', None, 'CM.PAM']
+    assert results[0]['pid'] != os.getpid()
+    with open(os.path.join(log_dir, 'CM.BAD.log')) as f:
+        log = f.read()
+    assert 'tuning CM.BAD' in log and 'ValueError: no waveforms' in log
+
+    # one station worker runs inline
+    assert run_campaign(jobs[:1], _tune)[0]['pid'] == os.getpid()
@@ -41,7 +41,9 @@ if 'sklearn' not in sys.modules:
     sys.modules['sklearn'] = sklearn
     sys.modules['sklearn.metrics'] = metrics
 
+from execution_context import ExecutionContext
 from picker_tuner import (
+    evaluate_best_phase,
     event_ids_from_times_file,
     waveform_paths_from_times_file,
     write_station_comparison_report,
@@ -125,3 +127,47 @@ def test_write_station_comparison_report_file_name_and_content(tmp_path):
     assert 'Overall reference vs best picker comparison' in content
     assert 'reference' in content
     assert 'best' in content
+
+
+def test_best_phase_of_a_numpy_engine_study_writes_the_xml(tmp_path, monkeypatch):
+    import numpy as np
+    import obspy
+
+    start = obspy.UTCDateTime(2020, 1, 1)
+    wf_path = tmp_path / 'evt0.BAR2.00.HH_0.mseed'
+    trace = obspy.Trace(np.zeros(2000, dtype=np.int32),
+                        header={'network': 'CM', 'station': 'BAR2', 'location': '00',
+                                'channel': 'HHZ', 'sampling_rate': 10.0,
+                                'starttime': start})
+    obspy.Stream([trace]).write(str(wf_path), format='MSEED')
+    times_file = tmp_path / 'BAR2_P_HH.txt'
+    times_file.write_text(f'{wf_path},{start + 100},{start},10.0,2000\n')
+    inv_xml = tmp_path / 'inv.xml'
+    inv_xml.write_text('<xml/>')
+
+    # scautopick stub answering with a pick on the manual one
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    script = bin_dir / 'scautopick'
+    script.write_text(
+        "#!/bin/sh\n"
+        "cat <<'XML'\n"
+        '<seiscomp><EventParameters><pick><phaseHint>P</phaseHint>'
+        '<time><value>2020-01-01T00:01:40.000Z</value></time></pick>'
+        '</EventParameters></seiscomp>\n'
+        "XML\n"
+    )
+    script.chmod(0o755)
+    monkeypatch.setenv('PATH', f"{bin_dir}:{os.environ['PATH']}")
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'results_P.csv').write_text(
+        'net.sta,best_f1,p_sta,p_lta,p_fmin,p_fmax,p_snr,trig_on\n'
+        'CM.BAR2,0.9,1,10,2,10,2,3.0\n')
+
+    context = ExecutionContext(str(times_file), str(tmp_path / 'picks'), str(inv_xml),
+                               False, 'CM', 'HH', '00', 'BAR2', engine='numpy')
+    best_xml = tmp_path / 'exc_best_CM_BAR2_P.xml'
+    pick_counts = evaluate_best_phase('CM', 'BAR2', 'P', str(best_xml), context=context)
+
+    assert best_xml.is_file()
+    assert pick_counts == {'tp': 1, 'fp': 0, 'fn': 0}
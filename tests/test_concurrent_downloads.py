@@ -0,0 +1,195 @@
+import datetime
+import os
+import sys
+import threading
+import time
+import types
+
+# Provide a tiny colorama stub so icecream can import without the optional dependency.
+if 'colorama' not in sys.modules:
+    colorama = types.ModuleType('colorama')
+    colorama.Style = types.SimpleNamespace(BRIGHT='', RESET_ALL='')
+    colorama.Fore = types.SimpleNamespace(LIGHTCYAN_EX='')
+    colorama.init = lambda *args, **kwargs: None
+    colorama.deinit = lambda *args, **kwargs: None
+    sys.modules['colorama'] = colorama
+
+import numpy as np
+import obspy
+from obspy.clients.fdsn.header import FDSNException, FDSNNoDataException
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from download_data import EndpointLimits, Station, waveform_downloader  # noqa: E402
+
+DT = 20
+START = datetime.datetime(2024, 1, 1)
+
+
+class FakeClient:
+    """FDSN client returning an event-like trace per request and recording
+    the requests in flight"""
+    def __init__(self, base_url, missing=(), latency=0.02, bulk=True):
+        self.base_url = base_url
+        self.missing = set(missing)
+        self.latency = latency
+        self.bulk = bulk
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.requests = 0
+        self.bulk_requests = 0
+        self._lock = threading.Lock()
+
+    def _enter(self):
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(self.latency)
+
+    def _exit(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def _window(self, network, station, location, channel, starttime, endtime):
+        if int(starttime.timestamp) in self.missing:
+            return obspy.Stream()
+        rng = np.random.default_rng(int(starttime.timestamp))
+        npts = int((endtime - starttime) * 100) + 1
+        data = rng.normal(0, 1, npts)
+        # onset in the middle of the window
+        data[npts // 2:] += 20 * np.sin(np.arange(npts - npts // 2) / 3)
+        header = {'network': network, 'station': station, 'location': location,
+                  'channel': channel.replace('*', 'Z'), 'sampling_rate': 100.0,
+                  'starttime': starttime}
+        return obspy.Stream([obspy.Trace(data.astype(np.float32), header)])
+
+    def get_waveforms(self, network, station, location, channel, starttime, endtime):
+        self._enter()
+        try:
+            self.requests += 1
+            st = self._window(network, station, location, channel, starttime, endtime)
+            if not len(st):
+                raise FDSNNoDataException('no data')
+            return st
+        finally:
+            self._exit()
+
+    def get_waveforms_bulk(self, bulk):
+        self._enter()
+        try:
+            self.bulk_requests += 1
+            if not self.bulk:
+                raise FDSNException('bulk not supported')
+            st = obspy.Stream()
+            for window in bulk:
+                st += self._window(*window)
+            if not len(st):
+                raise FDSNNoDataException('no data')
+            return st
+        finally:
+            self._exit()
+
+
+def manual_picks(n):
+    picks = []
+    for i in range(n):
+        p_time = START + datetime.timedelta(minutes=10 * i)
+        s_time = p_time + datetime.timedelta(seconds=5)
+        picks.append(['XX', f'ev{i}', 'P', p_time, 0.0, 'S', s_time, 0.0])
+    return picks
+
+
+def make_station(root):
+    station = Station(0.0, 0.0, 'XX', 'STA', '00', 'HH')
+    station.data_dir = os.path.join(root, 'STA')
+    os.makedirs(station.data_dir)
+    return station
+
+
+def read_times(times_paths, root):
+    contents = {}
+    for phase, path in times_paths.items():
+        with open(path) as f:
+            contents[phase] = f.read().replace(root, '')
+    return contents
+
+
+def test_concurrent_download_matches_sequential(tmp_path):
+    picks = manual_picks(8)
+    missing = {int(obspy.UTCDateTime(picks[3][3]).timestamp) - DT}
+
+    results = {}
+    for workers in (1, 6):
+        root = str(tmp_path / f'workers{workers}')
+        clients = [FakeClient('http://a:8091', missing), FakeClient('http://b:8091')]
+        limits = EndpointLimits(2)
+        times_paths = waveform_downloader(clients, make_station(root), picks, DT, True,
+                                          workers, limits)
+        results[workers] = read_times(times_paths, root)
+        assert all(client.max_in_flight <= 2 for client in clients)
+    # the concurrent run used all the slots of the first endpoint
+    assert clients[0].max_in_flight == 2
+
+    assert results[6] == results[1]
+    # the window missing in the first endpoint comes from the second one
+    assert results[6]['P'].count('NO_PICK') == 8
+    assert len(results[6]['S'].splitlines()) == 8
+
+
+def test_endpoint_limits_share_slot_per_base_url():
+    limits = EndpointLimits(3)
+    a, a_again, b = FakeClient('http://a'), FakeClient('http://a'), FakeClient('http://b')
+    assert limits.slot(a) is limits.slot(a_again)
+    assert limits.slot(a) is not limits.slot(b)
+    assert EndpointLimits(0).max_connections == 1
+
+
+def test_bulk_download_matches_per_window_requests(tmp_path):
+    picks = manual_picks(8)
+    missing = {int(obspy.UTCDateTime(picks[3][3]).timestamp) - DT}
+
+    results = {}
+    for bulk_size in (0, 3):
+        root = str(tmp_path / f'bulk{bulk_size}')
+        clients = [FakeClient('http://a:8091', missing), FakeClient('http://b:8091')]
+        times_paths = waveform_downloader(clients, make_station(root), picks, DT, True,
+                                          2, EndpointLimits(2), bulk_size)
+        results[bulk_size] = read_times(times_paths, root)
+
+    assert results[3] == results[0]
+    # 3 event and 3 noise bulk requests, the window missing in the bulk
+    # answer of the first endpoint is requested alone
+    assert clients[0].bulk_requests == 6
+    assert clients[0].requests == 1
+    assert clients[1].requests == 1
+
+
+def test_failed_bulk_request_falls_back(tmp_path):
+    picks = manual_picks(4)
+    root = str(tmp_path / 'fallback')
+    clients = [FakeClient('http://a:8091', bulk=False), FakeClient('http://b:8091', bulk=False)]
+    times_paths = waveform_downloader(clients, make_station(root), picks, DT, False,
+                                      1, None, 10)
+    assert clients[0].bulk_requests == 1 and clients[1].bulk_requests == 1
+    assert clients[0].requests == 4
+    assert len(read_times(times_paths, root)['P'].splitlines()) == 4
+
+
+def test_endpoint_limit_is_shared_through_the_lock_dir(tmp_path):
+    # two EndpointLimits on the same lock_dir, as in two station processes
+    lock_dir = str(tmp_path / 'fdsn_slots')
+    stations = [EndpointLimits(2, lock_dir), EndpointLimits(2, lock_dir)]
+    client = FakeClient('http://a:8091', latency=0.0)
+
+    def request(limits):
+        with limits.slot(client):
+            client._enter()
+            time.sleep(0.02)
+            client._exit()
+
+    threads = [threading.Thread(target=request, args=(stations[k % 2],)) for k in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert client.max_in_flight == 2
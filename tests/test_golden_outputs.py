@@ -62,6 +62,22 @@ def test_render_config_param_templates_golden():
     assert rendered['spicker_aic_filter'] == 'ITAPER(1)>>BW(4,1.0,4.0)'
 
 
+def test_compiled_xml_templates_render_like_str_format():
+    import os
+    from config_params import DEFAULT_VALUES
+    from stalta import StaLta, xml_config_template
+
+    params = dict(DEFAULT_VALUES, net='CM', sta='BAR2', ch='HH', loc='00',
+                  p_sta=1, p_lta=10, p_fmin=2, p_fmax=8, p_snr=2, trig_on=3.5,
+                  s_snr=2, s_fmin=1, s_fmax=4, aic_fmax=1)
+    params.update(render_config_param_templates(params))
+    for name in ('config_template_P.xml', 'config_template.xml'):
+        with open(os.path.join(StaLta.main_dir, 'bindings', name)) as f:
+            expected = f.read().format(**params)
+        assert xml_config_template(name).render(params) == expected
+        assert xml_config_template(name) is xml_config_template(name)
+
+
 def test_csvdata_values_golden(tmp_path):
     best_params = {
         'p_sta': 0.5,
@@ -0,0 +1,88 @@
+import sys
+import types
+
+import numpy as np
+import obspy
+import pytest
+
+if 'colorama' not in sys.modules:
+    colorama = types.ModuleType('colorama')
+    colorama.Style = types.SimpleNamespace(BRIGHT='', RESET_ALL='')
+    colorama.Fore = types.SimpleNamespace(LIGHTCYAN_EX='')
+    colorama.init = lambda *args, **kwargs: None
+    colorama.deinit = lambda *args, **kwargs: None
+    sys.modules['colorama'] = colorama
+
+import config_params
+from execution_context import ExecutionContext
+from grid_search import GridSearch, coarse_spaces, fine_spaces, grid_values, space_key
+from stalta import EvaluationPool, StaLta
+
+START = obspy.UTCDateTime(2020, 1, 1)
+
+SMALL_P_SPACE = {
+    'p_sta': {'min': 1, 'max': 2, 'step': 1, 'type': 'int'},
+    'p_lta': {'min': 2, 'max': 10, 'step': 4, 'type': 'int', 'above': 'p_sta'},
+    'p_fmin': {'min': 1, 'max': 3, 'step': 2, 'type': 'int'},
+    'p_fmax': {'min': 4, 'max': 10, 'step': 6, 'type': 'int', 'above': 'p_fmin'},
+    'p_snr': {'min': 1, 'max': 4, 'step': 3, 'type': 'int'},
+    'trig_on': {'min': 2, 'max': 6, 'step': 2.0, 'type': 'float'},
+}
+
+
+def _write_station(tmp_path, onsets):
+    """Times file with a 200 s window at 50 Hz per onset (None: noise)."""
+    rng = np.random.default_rng(0)
+    lines = []
+    for k, onset in enumerate(onsets):
+        data = rng.normal(0, 1, 10000)
+        if onset is not None:
+            t = np.arange(10000) / 50.0
+            i = int(onset * 50)
+            data[i:] += 40 * np.sin(2 * np.pi * 5 * t[i:]) * np.exp(-(t[i:] - onset) / 5)
+        wf_path = tmp_path / f'evt{k}.BAR2.00.HH.mseed'
+        trace = obspy.Trace(data.astype(np.float32),
+                            header={'network': 'CM', 'station': 'BAR2', 'location': '00',
+                                    'channel': 'HHZ', 'sampling_rate': 50.0,
+                                    'starttime': START})
+        obspy.Stream([trace]).write(str(wf_path), format='MSEED')
+        pick = START + onset if onset is not None else 'NO_PICK'
+        lines.append(f'{wf_path},{pick},{START},50.0,10000\n')
+    times_file = tmp_path / 'BAR2_P_HH.txt'
+    times_file.write_text(''.join(lines))
+    return ExecutionContext(str(times_file), str(tmp_path / 'picks'), 'inv.xml', False,
+                            'CM', 'HH', '00', 'BAR2', engine='numpy')
+
+
+def test_grid_values_and_refinement():
+    trig_on = config_params.OPTIMIZATION_PARAMS['P']['trig_on']
+    assert grid_values(trig_on, 2) == [2.0, 3.0, 4.0, 5.0, 6.0]
+    assert grid_values(config_params.OPTIMIZATION_PARAMS['P']['p_sta'], 3) == [1, 4]
+
+    spaces = coarse_spaces('S', 4)
+    assert all(space['s_fmax'] > space['s_fmin'] for space in spaces)
+    center = {'s_snr': 2, 's_fmin': 5, 's_fmax': 6}
+    fine = fine_spaces('S', center, 2)
+    assert center in fine
+    assert all(abs(space['s_fmin'] - 5) <= 1 and space['s_fmax'] > space['s_fmin']
+               for space in fine)
+
+
+@pytest.mark.parametrize('metric', ['f1', 'pick_f1'])
+def test_grid_scores_match_trial_evaluation(tmp_path, monkeypatch, metric):
+    from optimizer import score_space
+
+    monkeypatch.setitem(config_params.OPTIMIZATION_PARAMS, 'P', SMALL_P_SPACE)
+    context = _write_station(tmp_path, [100.0, 120.0, None])
+
+    with EvaluationPool(max_workers=2) as pool:
+        search = GridSearch('P', metric, pool, context, stride=1)
+        study = search.run()
+
+    spaces = coarse_spaces('P', 1)
+    assert len(study.trials) == len(spaces) == len(search.scores)
+    for space in spaces:
+        expected = score_space(StaLta(context=context), metric,
+                               dict(space, p_timecorr=0.0))
+        assert search.scores[space_key(space)] == pytest.approx(expected)
+    assert study.best_value == max(search.scores.values())
@@ -0,0 +1,77 @@
+import sys
+
+import numpy as np
+import pytest
+from obspy import UTCDateTime
+
+from stalta import BinaryTransform, interval_counts
+
+
+START = UTCDateTime(2021, 1, 1)
+
+
+def _random_transforms(seed, npts=3000, sample_rate=100.0):
+    rng = np.random.default_rng(seed)
+    duration = npts / sample_rate
+    # times near and outside both ends exercise the clipping of the intervals
+    obs = [START + t for t in rng.uniform(-1, duration + 1, rng.integers(0, 3))]
+    pred = [START + t for t in rng.uniform(-1, duration + 1, rng.integers(0, 8))]
+    return (BinaryTransform(START, sample_rate, npts, obs),
+            BinaryTransform(START, sample_rate, npts, pred))
+
+
+def _dense_counts(y_obs, y_pred):
+    return {
+        'tp': int(np.sum((y_obs == 1) & (y_pred == 1))),
+        'fp': int(np.sum((y_obs == 0) & (y_pred == 1))),
+        'fn': int(np.sum((y_obs == 1) & (y_pred == 0))),
+        'tn': int(np.sum((y_obs == 0) & (y_pred == 0))),
+    }
+
+
+def test_interval_counts_match_dense_binary_series():
+    for seed in range(200):
+        obs, pred = _random_transforms(seed)
+        counts = interval_counts(obs.intervals(), pred.intervals(), obs.npts)
+        assert counts == _dense_counts(obs.transform(), pred.transform())
+
+
+def test_overlapping_picks_are_merged():
+    pred = BinaryTransform(START, 100.0, 1000, [START + 2.0, START + 2.1, START + 5.0])
+    assert pred.intervals() == [(175, 235), (475, 525)]
+
+
+def test_score_counts_matches_sklearn_metrics():
+    pytest.importorskip('sklearn.metrics')
+    if not hasattr(sys.modules['sklearn'], '__version__'):
+        pytest.skip('sklearn is stubbed')
+    from optimizer import score_counts, score_metric
+
+    for seed in range(50):
+        obs, pred = _random_transforms(seed)
+        y_obs, y_pred = obs.transform(), pred.transform()
+        counts = interval_counts(obs.intervals(), pred.intervals(), obs.npts)
+        for metric in ('f1', 'f0.5', 'f2', 'pr', 're', 'roc'):
+            if metric == 'roc' and len(np.unique(y_obs)) < 2:
+                assert np.isnan(score_counts(metric, counts))
+                continue
+            assert score_counts(metric, counts) == pytest.approx(
+                score_metric(metric, y_obs, y_pred))
+
+
+def test_pick_f1_matches_comparison_report():
+    from optimizer import check_metric, score_pick_counts
+    from reference_picker import compute_pick_metrics
+
+    for tp, fp, fn in [(0, 0, 0), (3, 1, 2), (0, 4, 1), (5, 0, 0)]:
+        counts = {'tp': tp, 'fp': fp, 'fn': fn}
+        assert score_pick_counts('pick_f1', counts) == pytest.approx(
+            compute_pick_metrics(tp, fp, fn)['f1'])
+    # beta > 1 weighs the missed picks more than the false ones
+    assert (score_pick_counts('pick_f2', {'tp': 2, 'fp': 0, 'fn': 2})
+            < score_pick_counts('pick_f2', {'tp': 2, 'fp': 2, 'fn': 0}))
+
+    for metric in ('f1', 'f0.5', 'pr', 're', 'roc', 'pick_f1', 'pick_f2'):
+        assert check_metric(metric)
+    for metric in ('pick_roc', 'pick_pr', 'fx', 'auc', 'pick_'):
+        assert not check_metric(metric)
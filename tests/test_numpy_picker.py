@@ -0,0 +1,177 @@
+import numpy as np
+import pytest
+
+from numpy_picker import (
+    NumpyPicker,
+    WaveformArrays,
+    aic,
+    band_p_pick_times,
+    band_s_pick_times,
+    compare_pick_times,
+    match_pick_times,
+    parse_filter_chain,
+    running_mean,
+    summarize_validation,
+    trigger_onsets,
+)
+
+
+def _burst(npts, sampling_rate, onset, amplitude, freq, rng):
+    data = rng.normal(0, 1, npts)
+    if onset is not None:
+        t = np.arange(npts) / sampling_rate
+        start = int(onset * sampling_rate)
+        data[start:] += (amplitude * np.sin(2 * np.pi * freq * t[start:])
+                         * np.exp(-(t[start:] - onset) / 5))
+    return data
+
+
+def _synthetic_waveform(onset=100.0, s_onset=None, sampling_rate=100.0,
+                        duration=200.0, seed=0):
+    rng = np.random.default_rng(seed)
+    npts = int(duration * sampling_rate)
+    components = {'Z': _burst(npts, sampling_rate, onset, 40, 5, rng)}
+    if s_onset is not None:
+        components['N'] = _burst(npts, sampling_rate, s_onset, 60, 3, rng)
+        components['E'] = _burst(npts, sampling_rate, s_onset, 60, 3, rng)
+    return WaveformArrays(0.0, sampling_rate, components)
+
+
+P_PARAMS = {
+    'p_sta': 1, 'p_lta': 10, 'p_fmin': 2, 'p_fmax': 10, 'p_snr': 2,
+    'trig_on': 3.0, 'p_timecorr': 0.0, 'aic_fmin': 1, 'aic_fwidth': 0,
+    'picker_aic_filter': 'ITAPER(1)>>BW(4,3,20)',
+}
+
+S_PARAMS = dict(P_PARAMS, s_snr=2, s_fmin=1, s_fmax=10)
+
+
+def test_parse_filter_chain_matches_detec_filter_template():
+    chain = parse_filter_chain('RMHP(10)>>ITAPER(30)>>BW(4,2,8)>>STALTA(0.50,3.00)')
+    assert chain == [('RMHP', [10.0]), ('ITAPER', [30.0]),
+                     ('BW', [4.0, 2.0, 8.0]), ('STALTA', [0.5, 3.0])]
+    with pytest.raises(ValueError):
+        parse_filter_chain('ITAPER(1)>>UNKNOWN(3)')
+
+
+def test_running_mean_matches_recursive_definition():
+    x = np.random.default_rng(1).normal(size=50)
+    n = 7
+    expected = []
+    avg = 0.0
+    for i, value in enumerate(x):
+        count = min(i + 1, n)
+        avg += (value - avg) / count
+        expected.append(avg)
+    assert np.allclose(running_mean(x, n), expected)
+
+
+def test_trigger_onsets_respects_trig_off_and_dead_time():
+    ratio = np.ones(1000)
+    ratio[100:110] = 5    # first trigger
+    ratio[115:120] = 5    # ratio never fell below trig_off: ignored
+    ratio[400:410] = 5    # second trigger
+    onsets = trigger_onsets(ratio, trig_on=3, trig_off=0.5, sampling_rate=10,
+                            init_time=0, dead_time=1)
+    assert onsets.tolist() == [100]
+
+    ratio[300] = 0.1
+    onsets = trigger_onsets(ratio, trig_on=3, trig_off=0.5, sampling_rate=10,
+                            init_time=0, dead_time=1)
+    assert onsets.tolist() == [100, 400]
+
+
+def test_numpy_picker_picks_onset_and_ignores_noise():
+    picker = NumpyPicker(P_PARAMS)
+
+    picks = picker.pick_times(_synthetic_waveform(onset=100.0), 'P')
+    assert len(picks) == 1
+    assert abs(float(picks[0]) - 100.0) < 1.0
+
+    assert picker.pick_times(_synthetic_waveform(onset=None), 'P') == []
+
+
+def test_aic_minimum_at_variance_change():
+    rng = np.random.default_rng(2)
+    x = np.concatenate([rng.normal(0, 1, 300), rng.normal(0, 10, 200)])
+    assert abs(int(np.argmin(aic(x))) - 300) <= 3
+
+
+def test_numpy_picker_s_picks_reuse_cached_p_onsets():
+    wf = _synthetic_waveform(onset=100.0, s_onset=106.0)
+
+    s_picks = NumpyPicker(S_PARAMS).pick_times(wf, 'S')
+    assert len(s_picks) == 1
+    assert abs(float(s_picks[0]) - 106.0) < 1.0
+
+    NumpyPicker(dict(S_PARAMS, s_fmin=2, s_fmax=8)).pick_times(wf, 'S')
+    assert len(wf.p_onsets) == 1
+
+    # an SNR threshold no pick can reach rejects the S pick
+    assert NumpyPicker(dict(S_PARAMS, s_snr=1e6)).pick_times(wf, 'S') == []
+
+
+def test_compare_pick_times_and_summary():
+    row = compare_pick_times([10.0, 50.0], [10.2, 70.0], tolerance_seconds=1.0)
+    assert row['residuals'] == pytest.approx([0.2])
+    assert row['only_reference'] == 1
+    assert row['only_engine'] == 1
+
+    # each reference pick is matched once, to the earliest pick within tolerance
+    assert match_pick_times([10.0], [9.5, 10.1], 1.0) == pytest.approx([-0.5])
+
+    summary = summarize_validation([row, compare_pick_times([5.0], [4.9])])
+    assert summary['matched'] == 2
+    assert summary['max_abs'] == pytest.approx(0.2)
+
+
+def test_band_pick_times_match_one_picker_per_space():
+    wf = _synthetic_waveform(onset=100.0, s_onset=106.0)
+    spaces = [dict(P_PARAMS, p_sta=sta, p_lta=lta, trig_on=trig_on, p_snr=snr)
+              for sta, lta in [(1, 10), (2, 10), (1, 4)]
+              for trig_on in (2.0, 3.0, 6.0) for snr in (1, 4)]
+    expected = [NumpyPicker(space).pick_times(wf, 'P') for space in spaces]
+    assert band_p_pick_times(wf, spaces) == expected
+
+    s_spaces = [dict(S_PARAMS, s_snr=snr) for snr in (1, 2, 1e6)]
+    expected = [NumpyPicker(space).pick_times(wf, 'S') for space in s_spaces]
+    assert band_s_pick_times(wf, s_spaces) == expected
+
+
+def test_loaded_waveforms_stay_within_the_memory_budget(tmp_path, monkeypatch):
+    import obspy
+    import numpy_picker
+
+    monkeypatch.setattr(numpy_picker, '_WAVEFORMS', numpy_picker.OrderedDict())
+    # 3 components of 1000 float64 samples per waveform
+    monkeypatch.setattr(numpy_picker, 'MAX_WAVEFORM_BYTES', 3 * 24000 + 1)
+    paths = []
+    for i in range(5):
+        traces = [obspy.Trace(np.zeros(1000, dtype=np.float32),
+                              {'station': 'STA', 'channel': f'HH{comp}', 'sampling_rate': 100.0})
+                  for comp in 'ZNE']
+        path = str(tmp_path / f'wf{i}.mseed')
+        obspy.Stream(traces).write(path, format='MSEED')
+        paths.append(path)
+        numpy_picker.load_waveform(path, 'HH')
+
+    assert list(numpy_picker._WAVEFORMS) == paths[-3:]
+    assert numpy_picker.loaded_bytes() <= numpy_picker.MAX_WAVEFORM_BYTES
+    # a hit makes the waveform the most recently used
+    numpy_picker.load_waveform(paths[2], 'HH')
+    numpy_picker.load_waveform(paths[0], 'HH')
+    assert list(numpy_picker._WAVEFORMS) == [paths[4], paths[2], paths[0]]
+
+    numpy_picker.release_waveforms(paths)
+    assert numpy_picker.loaded_bytes() == 0
+
+
+def test_onset_caches_are_bounded(monkeypatch):
+    import numpy_picker
+
+    monkeypatch.setattr(numpy_picker, 'MAX_PICK_ENTRIES', 3)
+    wf = _synthetic_waveform()
+    for trig_on in (2, 3, 4, 5, 6):
+        NumpyPicker(dict(P_PARAMS, trig_on=trig_on)).p_onsets(wf)
+    assert len(wf.p_onsets) == 3
+    assert len(wf.repicks) <= 3
@@ -0,0 +1,130 @@
+import csv
+import json
+import os
+import sys
+import types
+
+import numpy as np
+import obspy
+import optuna
+
+if 'colorama' not in sys.modules:
+    colorama = types.ModuleType('colorama')
+    colorama.Style = types.SimpleNamespace(BRIGHT='', RESET_ALL='')
+    colorama.Fore = types.SimpleNamespace(LIGHTCYAN_EX='')
+    colorama.init = lambda *args, **kwargs: None
+    colorama.deinit = lambda *args, **kwargs: None
+    sys.modules['colorama'] = colorama
+
+import profiling
+from execution_context import ExecutionContext
+from optimizer import score_space, write_study_profile
+from stalta import EvaluationPool, StaLta
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_DIR, 'benchmarks'))
+
+from synthetic_data import generate_station
+
+P_SPACE = {'p_sta': 1, 'p_lta': 10, 'p_fmin': 2, 'p_fmax': 10, 'p_snr': 2,
+           'trig_on': 3.0, 'p_timecorr': 0.0}
+
+
+def test_stages_are_only_recorded_while_collecting():
+    assert not profiling.active()
+    with profiling.stage('config'):
+        profiling.count('waveforms')
+
+    with profiling.collect() as outer:
+        with profiling.stage('config'):
+            profiling.count('waveforms', 2)
+        with profiling.collect() as inner:
+            profiling.count('waveforms')
+        profiling.merge({'pid': 123, 'stages': {'scautopick': {'seconds': 0.5, 'calls': 3}},
+                         'counters': {'scautopick_runs': 3}})
+    with profiling.collect(False) as disabled:
+        assert disabled is None and not profiling.active()
+
+    data = outer.as_dict()
+    assert not profiling.active()
+    assert data['stages']['config']['calls'] == 1
+    assert data['stages']['scautopick'] == {'seconds': 0.5, 'calls': 3}
+    assert data['counters'] == {'waveforms': 2, 'scautopick_runs': 3}
+    assert data['workers'] == {'123': {'scautopick': 0.5}}
+    assert inner.as_dict()['counters'] == {'waveforms': 1}
+    assert data['wall_seconds'] >= inner.as_dict()['wall_seconds'] > 0
+
+
+def _numpy_context(tmp_path, profile=True):
+    rng = np.random.default_rng(0)
+    start = obspy.UTCDateTime(2020, 1, 1)
+    lines = []
+    for k, onset in enumerate([100.0, 100.0, None]):
+        data = rng.normal(0, 1, 10000)
+        if onset is not None:
+            t = np.arange(10000) / 50.0
+            i = int(onset * 50)
+            data[i:] += 40 * np.sin(2 * np.pi * 5 * t[i:]) * np.exp(-(t[i:] - onset) / 5)
+        wf_path = tmp_path / f'evt{k}.BAR2.00.HH.mseed'
+        obspy.Stream([obspy.Trace(data.astype(np.float32), header={
+            'network': 'CM', 'station': 'BAR2', 'location': '00', 'channel': 'HHZ',
+            'sampling_rate': 50.0, 'starttime': start})]).write(str(wf_path), format='MSEED')
+        pick = start + onset if onset is not None else 'NO_PICK'
+        lines.append(f'{wf_path},{pick},{start},50.0,10000\n')
+    times_file = tmp_path / 'BAR2_P_HH.txt'
+    times_file.write_text(''.join(lines))
+    return ExecutionContext(str(times_file), str(tmp_path / 'picks'), 'inv.xml', False,
+                            'CM', 'HH', '00', 'BAR2', engine='numpy', profile=profile)
+
+
+def test_trial_profile_is_saved_and_written(tmp_path):
+    context = _numpy_context(tmp_path)
+    study = optuna.create_study(direction='maximize')
+    trial = study.ask()
+    study.tell(trial, score_space(StaLta(context=context), 'f1', P_SPACE, trial))
+
+    profile = study.trials[0].user_attrs['profile']
+    assert {'numpy_pick', 'binary_transform', 'metric'} <= set(profile['stages'])
+    assert profile['stages']['numpy_pick']['calls'] == 3
+    assert profile['counters']['waveforms'] == 3
+    assert not profiling.active()
+
+    write_study_profile(study, 'CM', 'BAR2', '00', 'P', profiles_dir=str(tmp_path / 'profiles'))
+    prefix = tmp_path / 'profiles' / 'CM.BAR2.00_P_profile'
+    with open(f'{prefix}.json') as f:
+        written = json.load(f)
+    assert written['trials'][0]['profile'] == profile
+    assert written['summary'][0]['stage'] in profile['stages']
+    with open(f'{prefix}.csv', newline='') as f:
+        rows = list(csv.DictReader(f))
+    assert {row['stage'] for row in rows} == {'wall'} | set(profile['stages'])
+
+
+def test_no_profile_without_the_option(tmp_path):
+    context = _numpy_context(tmp_path, profile=False)
+    study = optuna.create_study(direction='maximize')
+    trial = study.ask()
+    score_space(StaLta(context=context), 'f1', P_SPACE, trial)
+    assert 'profile' not in trial.user_attrs
+
+
+def test_pool_workers_send_back_their_stages(tmp_path, monkeypatch):
+    paths = generate_station(str(tmp_path / 'SYN'), n_events=3, n_noise=1)
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    os.symlink(os.path.join(REPO_DIR, 'benchmarks', 'fake_scautopick'), bin_dir / 'scautopick')
+    monkeypatch.setenv('PATH', f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setenv('FAKE_SCAUTOPICK_ONSETS', paths['manifest'])
+    monkeypatch.chdir(tmp_path)
+    context = ExecutionContext(paths['P'], str(tmp_path / 'picks'), paths['inventory'],
+                               False, 'XX', 'HH', '00', 'SYN', profile=True)
+
+    with EvaluationPool(2) as pool, profiling.collect() as profile:
+        StaLta(pool=pool, context=context).mega_sta_lta(**P_SPACE)
+
+    data = profile.as_dict()
+    assert data['stages']['scautopick']['calls'] == 4
+    assert data['counters']['scautopick_runs'] == 4
+    assert 'config' in data['stages'] and 'pick' in data['stages']
+    assert str(os.getpid()) not in data['workers']
+    assert sum(stages['scautopick'] for stages in data['workers'].values()) > 0
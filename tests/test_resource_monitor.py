@@ -0,0 +1,69 @@
+import csv
+import os
+import subprocess
+import sys
+
+import pytest
+
+from resource_monitor import (CAMPAIGN_SCOPE, ResourceMonitor, monitor_available,
+                              station_scope, summarize)
+
+needs_proc = pytest.mark.skipif(not monitor_available(), reason='needs /proc')
+
+BURN = ('import time\n'
+        'data = b"x" * (64 * 1024 * 1024)\n'
+        'start = time.time()\n'
+        'while time.time() - start < 0.6:\n'
+        '    pass\n')
+
+
+@needs_proc
+def test_station_scope_gets_the_usage_of_its_process_tree(tmp_path):
+    monitor = ResourceMonitor(str(tmp_path / 'resources'), interval=0.1).start()
+    with station_scope(monitor.scopes_dir, 'CM.BAR2'):
+        assert os.listdir(monitor.scopes_dir) == [str(os.getpid())]
+        child = subprocess.Popen([sys.executable, '-c', BURN])
+        child.wait()
+    assert os.listdir(monitor.scopes_dir) == []
+    summary = {row['scope']: row for row in monitor.stop()}
+
+    assert set(summary) == {CAMPAIGN_SCOPE, 'CM.BAR2'}
+    station = summary['CM.BAR2']
+    assert station['cpu_percent_peak'] > 10
+    # the child RSS is added to the one of this process
+    assert station['rss_mb_peak'] >= 64
+    with open(monitor.samples_path, newline='') as f:
+        rows = list(csv.DictReader(f))
+    assert {row['scope'] for row in rows} == {CAMPAIGN_SCOPE, 'CM.BAR2'}
+    with open(monitor.summary_path, newline='') as f:
+        assert [row['scope'] for row in csv.DictReader(f)] == [CAMPAIGN_SCOPE, 'CM.BAR2']
+
+
+@needs_proc
+def test_marks_of_dead_processes_are_ignored(tmp_path):
+    monitor = ResourceMonitor(str(tmp_path / 'resources'), interval=0.1)
+    os.makedirs(monitor.scopes_dir)
+    child = subprocess.Popen([sys.executable, '-c', 'pass'])
+    child.wait()
+    with open(os.path.join(monitor.scopes_dir, str(child.pid)), 'w') as f:
+        f.write('CM.DEAD')
+    monitor._start = 0
+    rows = monitor.sample()
+    assert [row['scope'] for row in rows] == [CAMPAIGN_SCOPE]
+
+
+def test_summary_peaks_and_totals():
+    def row(elapsed, cpu, rss, n, read):
+        return {'scope': 'CM.BAR2', 'elapsed_s': elapsed, 'cpu_percent': cpu, 'rss_mb': rss,
+                'scautopick': n, 'read_mb_s': read, 'write_mb_s': 0.0,
+                'host_iowait_percent': 5.0, 'host_mem_available_mb': 1000.0 - rss}
+
+    summary = summarize([row(0, 0.0, 100, 0, 0.0), row(1, 150.0, 300, 4, 2.0),
+                         row(3, 50.0, 200, 2, 1.0)])
+    assert summary == [{
+        'scope': 'CM.BAR2', 'samples': 3, 'seconds': 3, 'cpu_percent_avg': 100.0,
+        'cpu_percent_peak': 150.0, 'rss_mb_avg': 200.0, 'rss_mb_peak': 300,
+        'scautopick_avg': 2.0, 'scautopick_peak': 4, 'read_mb': 4.0, 'write_mb': 0.0,
+        'read_mb_s_peak': 2.0, 'write_mb_s_peak': 0.0, 'host_iowait_percent_avg': 5.0,
+        'host_mem_available_mb_min': 700.0,
+    }]
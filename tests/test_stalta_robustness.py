@@ -1,7 +1,11 @@
+import io
+import os
+import subprocess
+import pytest
 import sys
 import types
 
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 
 # Provide a tiny colorama stub so icecream can import without the optional dependency.
 if 'colorama' not in sys.modules:
@@ -32,10 +36,7 @@ def test_current_exc_parsing_supports_equal_sign_in_value(tmp_path, monkeypatch)
     assert sta_lta.times_file == '/tmp/a=b_times.csv'
 
 
-def test_xmlpicks_accepts_non_013_namespace(tmp_path):
-    xml_path = tmp_path / 'picks.xml'
-    xml_path.write_text(
-        """<?xml version="1.0"?>
+PICK_XML = """<?xml version="1.0"?>
 <seiscomp xmlns="http://geofon.gfz-potsdam.de/ns/seiscomp3-schema/0.10" version="0.10">
   <EventParameters>
     <pick>
@@ -45,7 +46,11 @@ def test_xmlpicks_accepts_non_013_namespace(tmp_path):
   </EventParameters>
 </seiscomp>
 """
-    )
+
+
+def test_xmlpicks_accepts_non_013_namespace(tmp_path):
+    xml_path = tmp_path / 'picks.xml'
+    xml_path.write_text(PICK_XML)
     picks = XMLPicks(str(xml_path), 'P').get_pick_times()
     assert len(picks) == 1
 
@@ -56,18 +61,42 @@ def test_run_scautopick_uses_subprocess_without_shell(tmp_path):
     sta_lta.xml_exc_path = str(tmp_path / 'exc.xml')
     sta_lta.inv_xml = str(tmp_path / 'inv.xml')
     sta_lta.picks_dir = str(tmp_path / 'picks')
+    sta_lta.times_file = str(tmp_path / 'BAR2_P_HH.txt')
 
-    class _Result:
-        returncode = 0
+    process = MagicMock()
+    process.__enter__.return_value = process
+    process.stdout = io.BytesIO(PICK_XML.encode())
+    process.wait.return_value = 0
 
-    with patch('stalta.subprocess.run', return_value=_Result()) as run_mock:
+    with patch('stalta.subprocess.Popen', return_value=process) as popen_mock:
         sta_lta.run_scautopick()
 
-    args, kwargs = run_mock.call_args
+    args, kwargs = popen_mock.call_args
     command = args[0]
     assert isinstance(command, list)
     assert command[0] == 'scautopick'
-    assert kwargs['check'] is False
+    assert not kwargs.get('shell', False)
+    assert kwargs['stdout'] == subprocess.PIPE
+    # picks are parsed from the pipe, nothing is written outside debug mode
+    assert len(sta_lta.scautopick_picks) == 1
+    assert not os.path.exists(sta_lta.picks_dir)
+
+
+def test_pick_stream_parser_keeps_event_parameters_picks_of_phase():
+    from stalta import read_pick_stream
+
+    xml = PICK_XML.replace(
+        '</EventParameters>',
+        '<pick><phaseHint>S</phaseHint><time><value>2020-01-01T00:00:05Z</value></time></pick>'
+        '<pick><time><value>2020-01-01T00:00:09Z</value></time></pick>'
+        '</EventParameters>')
+    picks = read_pick_stream(io.BytesIO(xml.encode()), 'P')
+    assert [str(t) for t in picks] == ['2020-01-01T00:00:00.000000Z']
+
+    with pytest.raises(ValueError):
+        read_pick_stream(io.BytesIO(b'<seiscomp><EventParameters>'), 'P')
+    with pytest.raises(ValueError):
+        read_pick_stream(io.BytesIO(b''), 'P')
 
 
 def test_match_pick_times_counts_false_picks():
@@ -76,3 +105,291 @@ def test_match_pick_times_counts_false_picks():
     predicted = [0.1, 9.9, 30.0]
     counts = StaLta._match_pick_times(observed, predicted, tolerance_seconds=0.25)
     assert counts == {'tp': 2, 'fp': 1, 'fn': 0}
+
+
+def _write_fake_scautopick(bin_dir, pick_time):
+    script = bin_dir / 'scautopick'
+    script.write_text(
+        "#!/bin/sh\n"
+        f"echo run >> {bin_dir / 'calls.log'}\n"
+        "cat <<'XML'\n"
+        '<?xml version="1.0"?>\n'
+        '<seiscomp xmlns="http://geofon.gfz-potsdam.de/ns/seiscomp3-schema/0.10" version="0.10">\n'
+        '  <EventParameters><pick><phaseHint>P</phaseHint>'
+        f'<time><value>{pick_time}</value></time></pick></EventParameters>\n'
+        '</seiscomp>\n'
+        "XML\n"
+    )
+    script.chmod(0o755)
+
+
+def _fake_station(tmp_path, monkeypatch, extra_exc=''):
+    """Times file with an event and a noise window, scautopick stand-in on PATH."""
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    _write_fake_scautopick(bin_dir, '2020-01-01T00:01:40.000Z')
+    monkeypatch.setenv('PATH', f"{bin_dir}:{os.environ['PATH']}")
+    monkeypatch.chdir(tmp_path)
+
+    lines = []
+    for name, pick in [('evt1', '2020-01-01T00:01:40.000000'), ('evt1_NOISE', 'NO_PICK')]:
+        wf_path = tmp_path / f'{name}.BAR2.00.HH_20200101T000140.mseed'
+        wf_path.write_bytes(name.encode())
+        lines.append(f"{wf_path},{pick},2020-01-01T00:00:00.000000,10.0,2000\n")
+    times_file = tmp_path / 'BAR2_P_HH.txt'
+    times_file.write_text(''.join(lines))
+    inv_xml = tmp_path / 'inv.xml'
+    inv_xml.write_text('<xml/>')
+    (tmp_path / 'current_exc.txt').write_text(
+        f"times_file = {times_file}\n"
+        f"picks_dir = {tmp_path / 'picks'}\n"
+        f"inv_xml = {inv_xml}\n"
+        "_debug = False\n"
+        "net = CM\n"
+        "ch = HH\n"
+        "loc = 00\n"
+        "sta = BAR2\n"
+        + extra_exc
+    )
+    return bin_dir / 'calls.log'
+
+
+P_PARAMS = {'p_sta': 1, 'p_lta': 10, 'p_fmin': 2, 'p_fmax': 10, 'p_snr': 2,
+            'trig_on': 3.0}
+
+
+def test_evaluation_pool_is_reused_across_trials(tmp_path, monkeypatch):
+    from stalta import EvaluationPool
+
+    _fake_station(tmp_path, monkeypatch)
+
+    with EvaluationPool(max_workers=2) as pool:
+        _, first = StaLta(pool=pool).mega_sta_lta(collect_pick_level=True, **P_PARAMS)
+        executor = pool.executor
+        _, second = StaLta(pool=pool).mega_sta_lta(collect_pick_level=True, **P_PARAMS)
+        assert pool.executor is executor
+
+    assert pool.executor is None
+    # both waveforms return the fake pick, which only matches the event window
+    assert first == second == {'tp': 1, 'fp': 1, 'fn': 0}
+
+
+def _worker_state(_):
+    import stalta
+    return sorted(stalta._WORKER_STALTAS), sorted(stalta._DATASETS)
+
+
+def test_evaluation_pool_workers_start_with_the_dataset_loaded(tmp_path, monkeypatch):
+    import stalta
+    from stalta import EvaluationPool
+
+    _fake_station(tmp_path, monkeypatch)
+    times_file = StaLta().times_file
+    # nothing loaded in this process for the workers to inherit
+    monkeypatch.setattr(stalta, '_WORKER_STALTAS', {})
+    monkeypatch.setattr(stalta, '_DATASETS', stalta.OrderedDict())
+
+    with EvaluationPool(max_workers=2) as pool:
+        states = list(pool.start(times_file).map(_worker_state, range(4)))
+
+    assert states == [([times_file], [os.path.abspath(times_file)])] * 4
+    assert not stalta._DATASETS
+
+
+def test_trial_cache_skips_scautopick_for_repeated_configs(tmp_path, monkeypatch):
+    calls = _fake_station(tmp_path, monkeypatch,
+                          f"trial_cache = {tmp_path / 'cache.sqlite'}\n")
+
+    _, first = StaLta().mega_sta_lta(collect_pick_level=True, **P_PARAMS)
+    assert len(calls.read_text().splitlines()) == 2
+
+    _, second = StaLta().mega_sta_lta(collect_pick_level=True, **P_PARAMS)
+    assert len(calls.read_text().splitlines()) == 2
+    assert first == second
+
+    StaLta().mega_sta_lta(collect_pick_level=True, **dict(P_PARAMS, trig_on=4.0))
+    assert len(calls.read_text().splitlines()) == 4
+    assert StaLta().cache.hits == 2
+
+
+def test_station_dataset_is_parsed_once_per_times_file_version(tmp_path, monkeypatch):
+    _fake_station(tmp_path, monkeypatch)
+    sta_lta = StaLta()
+    dataset = sta_lta.dataset
+    assert StaLta().dataset is dataset
+    assert len(dataset) == sta_lta.N == 2
+
+    event, noise = dataset.records
+    # 100 s after the start at 10 Hz, +/- 0.25 s
+    assert event.obs_intervals == [(997, 1002)]
+    assert noise.ph_time == [] and noise.obs_intervals == []
+
+    times_file = tmp_path / 'BAR2_P_HH.txt'
+    times_file.write_text(times_file.read_text().splitlines(keepends=True)[0])
+    assert len(StaLta().dataset) == 1
+
+
+def test_pick_level_trials_skip_sample_counts(tmp_path, monkeypatch):
+    from optimizer import score_space
+
+    _fake_station(tmp_path, monkeypatch)
+
+    sample_counts, pick_counts = StaLta().mega_sta_lta(
+        collect_pick_level=True, sample_level=False, **P_PARAMS)
+    assert sample_counts is None
+    assert pick_counts == {'tp': 1, 'fp': 1, 'fn': 0}
+    assert score_space(StaLta(), 'pick_f1', dict(P_PARAMS)) == pytest.approx(2 / 3)
+
+
+def test_execution_context_replaces_current_exc_file(tmp_path, monkeypatch):
+    from execution_context import ExecutionContext
+    from stalta import EvaluationPool
+
+    _fake_station(tmp_path, monkeypatch)
+    context = ExecutionContext.from_file()
+    assert context.debug is False and context.sta == 'BAR2'
+    os.remove(tmp_path / 'current_exc.txt')
+
+    with EvaluationPool(max_workers=2) as pool:
+        _, counts = StaLta(pool=pool, context=context).mega_sta_lta(
+            collect_pick_level=True, **P_PARAMS)
+    assert counts == {'tp': 1, 'fp': 1, 'fn': 0}
+    assert not (tmp_path / 'current_exc.txt').exists()
+
+    # the shim file round-trips the context
+    context.write(str(tmp_path / 'exc.txt'))
+    assert ExecutionContext.from_file(str(tmp_path / 'exc.txt')) == context
+
+
+def test_chunked_evaluation_reports_running_score_and_prunes(tmp_path, monkeypatch):
+    import optuna
+    from optimizer import PruningSettings, score_space
+
+    _fake_station(tmp_path, monkeypatch)
+
+    class _Trial:
+        def __init__(self, prune):
+            self.prune = prune
+            self.reports = []
+
+        def report(self, value, step):
+            self.reports.append((step, value))
+
+        def should_prune(self):
+            return self.prune
+
+    pruning = PruningSettings('median', warmup_chunks=1, chunk_size=1)
+    trial = _Trial(prune=False)
+    score = score_space(StaLta(), 'pick_f1', dict(P_PARAMS), trial, pruning)
+    # the event window gives a perfect score, the noise window a false pick
+    assert trial.reports == [(1, 1.0), (2, pytest.approx(2 / 3))]
+    assert score == pytest.approx(2 / 3)
+    assert score_space(StaLta(), 'pick_f1', dict(P_PARAMS)) == score
+
+    trial = _Trial(prune=True)
+    with pytest.raises(optuna.TrialPruned):
+        score_space(StaLta(), 'pick_f1', dict(P_PARAMS), trial, pruning)
+    # no pruning during the warm-up chunk
+    assert len(trial.reports) == 2
+
+
+def test_stratified_order_interleaves_events_and_noise(tmp_path):
+    import optuna
+    from optimizer import PruningSettings
+    from stalta import StationDataset
+
+    picks = ['2020-01-01T00:01:40'] * 4 + ['NO_PICK'] * 2
+    times_file = tmp_path / 'BAR2_P_HH.txt'
+    times_file.write_text(''.join(
+        f'wf{k}.mseed,{pick},2020-01-01T00:00:00,10.0,2000\n'
+        for k, pick in enumerate(picks)))
+
+    order = StationDataset(str(times_file)).stratified_order
+    assert sorted(order) == list(range(6))
+    # each half of the order holds two events and one noise window
+    assert sorted(order[:3]) == [0, 1, 4]
+
+    assert isinstance(PruningSettings('hyperband', 0, 5).make_pruner(),
+                      optuna.pruners.HyperbandPruner)
+    assert isinstance(PruningSettings('successive_halving', 0, 5).make_pruner(),
+                      optuna.pruners.SuccessiveHalvingPruner)
+
+
+def test_sampled_spaces_hold_the_constraints():
+    import optuna
+    from optimizer import build_param_space, invalid_space
+
+    optuna.logging.set_verbosity(optuna.logging.WARNING)
+    for phase in ('P', 'S'):
+        spaces = []
+
+        def objective(trial):
+            spaces.append(build_param_space(trial, phase))
+            return float(sum(spaces[-1].values()))
+
+        study = optuna.create_study(direction='maximize',
+                                    sampler=optuna.samplers.TPESampler(seed=1))
+        study.optimize(objective, n_trials=60)
+        assert not any(invalid_space(phase, space) for space in spaces)
+    assert invalid_space('P', {'p_sta': 3, 'p_lta': 3, 'p_fmin': 2, 'p_fmax': 9})
+    assert invalid_space('S', {'s_fmin': 9, 's_fmax': 4})
+
+
+def test_best_p_params_are_read_once_per_results_version(tmp_path, monkeypatch):
+    import pandas as pd
+    import stalta
+
+    _fake_station(tmp_path, monkeypatch)
+    results = tmp_path / 'results_P.csv'
+    results.write_text('net.sta,p_sta,p_lta,p_fmin,p_fmax,p_snr,trig_on,best_f1\n'
+                       'CM.BAR2,1,10,2,9,1,3.0,0.4\n'
+                       'CM.BAR2,2,12,3,12,2,3.5,0.6\n')
+    reads = []
+    read_csv = pd.read_csv
+    monkeypatch.setattr(stalta.pd, 'read_csv', lambda *a, **k: reads.append(a) or read_csv(*a, **k))
+
+    for _ in range(3):
+        assert StaLta().best_p_params['p_lta'] == 12
+    assert len(reads) == 1
+
+    results.write_text(results.read_text() + 'CM.BAR2,3,14,4,15,2,4.0,0.9\n')
+    assert StaLta().best_p_params['p_lta'] == 14
+    assert len(reads) == 2
+
+
+def test_station_datasets_and_waveforms_do_not_accumulate(tmp_path, monkeypatch):
+    import numpy as np
+    import obspy
+    import numpy_picker
+    import stalta
+
+    monkeypatch.setattr(stalta, '_DATASETS', stalta.OrderedDict())
+    monkeypatch.setattr(numpy_picker, '_WAVEFORMS', numpy_picker.OrderedDict())
+    station_dirs = []
+    for n in range(6):
+        station_dir = tmp_path / f'STA{n}'
+        station_dir.mkdir()
+        station_dirs.append(station_dir)
+        lines = []
+        for i in range(2):
+            wf_path = str(station_dir / f'wf{i}.mseed')
+            trace = obspy.Trace(np.zeros(500, dtype=np.float32),
+                                {'station': f'STA{n}', 'channel': 'HHZ', 'sampling_rate': 100.0})
+            trace.write(wf_path, format='MSEED')
+            lines.append(f'{wf_path},NO_PICK,1970-01-01T00:00:00.000000,100.0,500\n')
+        for phase in ('P', 'S'):
+            times_file = station_dir / f'STA{n}_{phase}_HH.txt'
+            times_file.write_text(''.join(lines))
+            # a trial of the numpy engine over the station dataset
+            for record in stalta.StationDataset.load(str(times_file)).records:
+                numpy_picker.load_waveform(record.wf_path, 'HH')
+
+        assert len(stalta._DATASETS) <= stalta.MAX_DATASETS
+        in_use = {record.wf_path for _, dataset in stalta._DATASETS.values()
+                  for record in dataset.records}
+        assert set(numpy_picker._WAVEFORMS) <= in_use
+
+    for station_dir in station_dirs:
+        stalta.release_datasets(str(station_dir))
+    assert not stalta._DATASETS
+    assert not numpy_picker._WAVEFORMS
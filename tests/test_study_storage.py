@@ -0,0 +1,57 @@
+import optuna
+import pytest
+
+from study_storage import (StudyStorage, max_trials_callback, study_name,
+                           trials_target)
+
+
+def _objective(trial):
+    return trial.suggest_float('x', 0, 1)
+
+
+def _run(storage, n_trials, name='CM.BAR2.00.HH.P-abc'):
+    study = optuna.create_study(study_name=name, storage=storage.make(),
+                                load_if_exists=True, direction='maximize')
+    target = trials_target(study, n_trials)
+    study.optimize(_objective, n_trials=target, callbacks=[max_trials_callback(target)])
+    return study
+
+
+@pytest.mark.parametrize('kind', ['sqlite', 'journal'])
+def test_studies_resume_and_extend(tmp_path, kind):
+    optuna.logging.set_verbosity(optuna.logging.WARNING)
+    storage = StudyStorage(kind, str(tmp_path / f'studies.{kind}'))
+
+    # an interrupted run left 3 of 5 trials
+    study = optuna.create_study(study_name='CM.BAR2.00.HH.P-abc',
+                                storage=storage.make(), direction='maximize')
+    study.optimize(_objective, n_trials=3)
+
+    assert len(_run(storage, 5).trials) == 5
+    # a finished study gets n_trials more
+    assert len(_run(storage, 5).trials) == 10
+
+
+def test_study_name_depends_on_data_and_metric(tmp_path):
+    times_file = tmp_path / 'BAR2_P_HH.txt'
+    times_file.write_text('evt0.mseed,2020-01-01T00:01:40,2020-01-01T00:00:00,10.0,2000\n')
+    name = study_name('CM', 'BAR2', '00', 'HH', 'P', str(times_file), 'f1')
+    assert name.startswith('CM.BAR2.00.HH.P-')
+    assert name == study_name('CM', 'BAR2', '00', 'HH', 'P', str(times_file), 'f1')
+    assert name != study_name('CM', 'BAR2', '00', 'HH', 'P', str(times_file), 'pick_f1')
+    # trials scored by another engine or playback mode are not mixed
+    assert name != study_name('CM', 'BAR2', '00', 'HH', 'P', str(times_file), 'f1', 'numpy')
+    assert name != study_name('CM', 'BAR2', '00', 'HH', 'P', str(times_file), 'f1',
+                              batched=True)
+
+
+def test_study_name_depends_on_search_space(tmp_path, monkeypatch):
+    import config_params
+
+    times_file = tmp_path / 'BAR2_P_HH.txt'
+    times_file.write_text('evt0.mseed,2020-01-01T00:01:40,2020-01-01T00:00:00,10.0,2000\n')
+    name = study_name('CM', 'BAR2', '00', 'HH', 'P', str(times_file), 'f1')
+    p_space = dict(config_params.OPTIMIZATION_PARAMS['P'],
+                   trig_on={'min': 2, 'max': 8, 'step': 0.5, 'type': 'float'})
+    monkeypatch.setitem(config_params.OPTIMIZATION_PARAMS, 'P', p_space)
+    assert name != study_name('CM', 'BAR2', '00', 'HH', 'P', str(times_file), 'f1')
@@ -0,0 +1,39 @@
+import obspy
+
+from trial_cache import TrialCache, entry_key, file_digest
+
+
+def test_entry_key_depends_on_every_part(tmp_path):
+    wf = tmp_path / 'wf.mseed'
+    wf.write_bytes(b'abc')
+    digest = file_digest(str(wf))
+    key = entry_key(b'<config/>', 'inv', digest, 'P')
+
+    assert key == entry_key(b'<config/>', 'inv', digest, 'P')
+    assert key != entry_key(b'<config2/>', 'inv', digest, 'P')
+    assert key != entry_key(b'<config/>', 'inv', digest, 'S')
+    assert key != entry_key(b'<config/>', 'inv2', digest, 'P')
+    # batch playback picks are not shared with per-waveform playbacks
+    assert key == entry_key(b'<config/>', 'inv', digest, 'P', batched=False)
+    assert key != entry_key(b'<config/>', 'inv', digest, 'P', batched=True)
+
+
+def test_trial_cache_round_trip_and_hit_rate(tmp_path):
+    cache = TrialCache(str(tmp_path / 'cache.sqlite'))
+    times = [obspy.UTCDateTime('2020-01-01T00:01:40.120000Z')]
+    cache.put_many({'a': times, 'b': []})
+
+    found = cache.get_many(['a', 'b', 'c'])
+    assert found == {'a': times, 'b': []}
+    assert cache.stats() == {'hits': 2, 'misses': 1}
+    assert cache.hit_rate == 2 / 3
+
+
+def test_trial_cache_evicts_least_recently_used(tmp_path):
+    cache = TrialCache(str(tmp_path / 'cache.sqlite'), max_entries=2)
+    cache.put_many({'old': []})
+    cache.put_many({'recent': []})
+    cache.get_many(['old'])
+    cache.put_many({'new': []})
+
+    assert set(cache.get_many(['old', 'recent', 'new'])) == {'old', 'new'}
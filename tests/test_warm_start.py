@@ -0,0 +1,38 @@
+from warm_start import WarmStart, load_station_coords, save_station_coords, snap_to_space
+
+RESULTS_P = """net.sta,p_sta,p_lta,p_fmin,p_fmax,p_snr,trig_on,best_f1
+CM.BAR2,2,10,3,12,2,3.5,0.60
+CM.BAR2,1,8,2,9,1,3.0,0.40
+CM.PDSC,0.2,13.3,7,15,4,11.1,0.20
+CM.PAM,3,12,4,20,2,4.0,0.50
+TX.MB07,5,15,10,30,3,5.0,0.90
+"""
+
+
+def test_snap_to_space_clips_and_rounds():
+    params = {'p_sta': 0.2, 'p_lta': 13.3, 'p_fmin': 7, 'p_fmax': 15,
+              'p_snr': 4, 'trig_on': 11.1}
+    assert snap_to_space('P', params) == {'p_sta': 1, 'p_lta': 13, 'p_fmin': 7,
+                                          'p_fmax': 15, 'p_snr': 4, 'trig_on': 6.0}
+    assert snap_to_space('S', params) is None
+
+
+def test_candidates_own_best_nearest_and_network_median(tmp_path):
+    results = tmp_path / 'results_P.csv'
+    results.write_text(RESULTS_P)
+    coords = str(tmp_path / 'station_coords.csv')
+    save_station_coords('CM', 'BAR2', 4.0, -74.0, coords)
+    save_station_coords('CM', 'PAM', 4.1, -74.0, coords)
+    save_station_coords('CM', 'PDSC', 6.0, -75.0, coords)
+    save_station_coords('CM', 'BAR2', 4.0, -74.1, coords)
+    assert load_station_coords(coords)['CM.BAR2'] == (4.0, -74.1)
+
+    warm_start = WarmStart(True, 1, coords)
+    candidates = warm_start.candidates('CM', 'BAR2', 'P', str(results))
+    # own best row, nearest station (PAM) and CM median (BAR2, PAM, PDSC)
+    assert candidates == [
+        {'p_sta': 2, 'p_lta': 10, 'p_fmin': 3, 'p_fmax': 12, 'p_snr': 2, 'trig_on': 3.5},
+        {'p_sta': 3, 'p_lta': 12, 'p_fmin': 4, 'p_fmax': 20, 'p_snr': 2, 'trig_on': 4.0},
+        {'p_sta': 2, 'p_lta': 12, 'p_fmin': 4, 'p_fmax': 15, 'p_snr': 2, 'trig_on': 4.0},
+    ]
+    assert WarmStart(False).candidates('CM', 'BAR2', 'P', str(results)) == []
@@ -0,0 +1,140 @@
+import json
+import os
+import sys
+import types
+
+if 'colorama' not in sys.modules:
+    colorama = types.ModuleType('colorama')
+    colorama.Style = types.SimpleNamespace(BRIGHT='', RESET_ALL='')
+    colorama.Fore = types.SimpleNamespace(LIGHTCYAN_EX='')
+    colorama.init = lambda *args, **kwargs: None
+    colorama.deinit = lambda *args, **kwargs: None
+    sys.modules['colorama'] = colorama
+
+import worker_autotune
+from execution_context import ExecutionContext
+from stalta import EvaluationPool, StaLta
+from worker_autotune import (WorkerAutotuner, available_cpus, candidate_counts,
+                             cgroup_cpu_quota)
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_DIR, 'benchmarks'))
+
+from synthetic_data import generate_station
+
+
+def test_cgroup_quota_and_available_cpus(tmp_path, monkeypatch):
+    v2 = tmp_path / 'v2'
+    v2.mkdir()
+    (v2 / 'cpu.max').write_text('150000 100000\n')
+    assert cgroup_cpu_quota(str(v2)) == 1.5
+    monkeypatch.setattr(os, 'sched_getaffinity', lambda pid: set(range(8)), raising=False)
+    assert available_cpus(str(v2)) == 2
+
+    (v2 / 'cpu.max').write_text('max 100000\n')
+    assert cgroup_cpu_quota(str(v2)) is None
+    assert available_cpus(str(v2)) == 8
+
+    v1 = tmp_path / 'v1'
+    (v1 / 'cpu').mkdir(parents=True)
+    (v1 / 'cpu' / 'cpu.cfs_quota_us').write_text('300000\n')
+    (v1 / 'cpu' / 'cpu.cfs_period_us').write_text('100000\n')
+    assert available_cpus(str(v1)) == 3
+    (v1 / 'cpu' / 'cpu.cfs_quota_us').write_text('-1\n')
+    assert cgroup_cpu_quota(str(v1)) is None
+
+
+def test_cgroup_quota_of_the_process_cgroup_and_its_ancestors(tmp_path):
+    root = tmp_path / 'cgroup'
+    slice_dir = root / 'tuner.slice'
+    service = slice_dir / 'tuner.service'
+    service.mkdir(parents=True)
+    (root / 'cpu.max').write_text('max 100000\n')
+    (slice_dir / 'cpu.max').write_text('400000 100000\n')
+    (service / 'cpu.max').write_text('max 100000\n')
+    proc_cgroup = tmp_path / 'cgroup_of_self'
+    proc_cgroup.write_text('0::/tuner.slice/tuner.service\n')
+    assert cgroup_cpu_quota(str(root), str(proc_cgroup)) == 4.0
+
+    # the tightest quota of the path wins
+    (service / 'cpu.max').write_text('250000 100000\n')
+    assert cgroup_cpu_quota(str(root), str(proc_cgroup)) == 2.5
+
+    # cgroup v1 cpu controller
+    v1_service = root / 'cpu' / 'docker' / 'abc'
+    v1_service.mkdir(parents=True)
+    (v1_service / 'cpu.cfs_quota_us').write_text('100000\n')
+    (v1_service / 'cpu.cfs_period_us').write_text('100000\n')
+    proc_cgroup.write_text('4:cpu,cpuacct:/docker/abc\n1:name=systemd:/docker/abc\n')
+    assert cgroup_cpu_quota(str(root), str(proc_cgroup)) == 1.0
+    # unreadable /proc/self/cgroup: only the root cgroup
+    assert cgroup_cpu_quota(str(root), str(tmp_path / 'missing')) is None
+
+
+def test_search_keeps_the_smallest_count_near_the_best_throughput(tmp_path, monkeypatch):
+    monkeypatch.setattr(worker_autotune, 'available_cpus', lambda: 16)
+    path = str(tmp_path / 'worker_autotune.json')
+    throughput = {2: 10.0, 4: 19.5, 8: 20.0, 16: 21.0}
+    assert candidate_counts(16) == [2, 4, 8, 16]
+
+    tuner = WorkerAutotuner(16, path)
+    workers = tuner.initial_workers()
+    tried = []
+    while tuner.chosen is None:
+        tried.append(workers)
+        n_waveforms = 4 * workers
+        workers = tuner.record(workers, n_waveforms, n_waveforms / throughput[workers])
+
+    # 8 workers gain less than 5% over 4: 16 are not tried and 4 are kept
+    assert tuner.chosen == workers == 4
+    assert tried == [2, 2, 4, 4, 8, 8]
+    saved = json.loads(open(path).read())[tuner.key]
+    assert saved['workers'] == 4 and saved['cpus'] == 16
+    assert saved['throughput'] == {'2': 10.0, '4': 19.5, '8': 20.0}
+
+    # later runs on this host start with the saved count
+    again = WorkerAutotuner(16, path)
+    assert again.initial_workers() == 4
+    assert again.record(4, 100, 1.0) == 4
+
+
+def test_ceiling_is_capped_by_the_available_cpus(monkeypatch):
+    monkeypatch.setattr(worker_autotune, 'available_cpus', lambda: 3)
+    assert WorkerAutotuner(64).ceiling == 3
+    assert candidate_counts(3) == [1, 3]
+
+
+class _StepAutotuner:
+    def __init__(self):
+        self.calls = []
+
+    def initial_workers(self):
+        return 1
+
+    def record(self, workers, n_waveforms, seconds):
+        self.calls.append((workers, n_waveforms))
+        return 2
+
+
+def test_pool_resizes_after_each_evaluation(tmp_path, monkeypatch):
+    paths = generate_station(str(tmp_path / 'SYN'), n_events=2, n_noise=1)
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    os.symlink(os.path.join(REPO_DIR, 'benchmarks', 'fake_scautopick'), bin_dir / 'scautopick')
+    monkeypatch.setenv('PATH', f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setenv('FAKE_SCAUTOPICK_ONSETS', paths['manifest'])
+    monkeypatch.chdir(tmp_path)
+    context = ExecutionContext(paths['P'], str(tmp_path / 'picks'), paths['inventory'],
+                               False, 'XX', 'HH', '00', 'SYN')
+    params = {'p_sta': 1, 'p_lta': 10, 'p_fmin': 2, 'p_fmax': 10, 'p_snr': 2,
+              'trig_on': 3.0, 'p_timecorr': 0.0}
+    tuner = _StepAutotuner()
+
+    with EvaluationPool(autotuner=tuner) as pool:
+        assert pool.max_workers == 1
+        first = StaLta(pool=pool, context=context).mega_sta_lta(**params)
+        assert pool.max_workers == 2 and pool.executor is None
+        second = StaLta(pool=pool, context=context).mega_sta_lta(**params)
+
+    assert tuner.calls == [(1, 3), (2, 3)]
+    assert first == second
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk cache of scautopick pick times
+
+Entries are keyed by a hash of the rendered scautopick configuration, the
+inventory and the waveform file contents, so repeated parameter sets (TPE
+proposals already evaluated, re-runs of a station) skip scautopick.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import obspy
+
+DEFAULT_CACHE_PATH = 'trial_cache.sqlite'
+DEFAULT_MAX_ENTRIES = 200000
+
+# File digests already computed in this process, keyed by (path, size, mtime)
+_DIGESTS = {}
+
+# Caches opened in this process, keyed by path
+_CACHES = {}
+
+
+def file_digest(path: str) -> str:
+    """
+    sha256 of a file content, computed once per file version
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _DIGESTS:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        _DIGESTS[key] = digest.hexdigest()
+    return _DIGESTS[key]
+
+
+def entry_key(config: bytes, inventory_digest: str, wf_digest: str, phase: str,
+              batched: bool = False) -> str:
+    """
+    Key of the picks of one waveform for one rendered configuration. Picks
+    of a batch playback get their own keys, since the detector does not see
+    the same waveform start and end as in a playback of the waveform alone
+    """
+    digest = hashlib.sha256(config)
+    parts = (inventory_digest, wf_digest, phase) + (('batch',) if batched else ())
+    for part in parts:
+        digest.update(b'\0' + part.encode())
+    return digest.hexdigest()
+
+
+def get_cache(path=DEFAULT_CACHE_PATH, max_entries=DEFAULT_MAX_ENTRIES):
+    """
+    Return the TrialCache of path, opened once per process
+    """
+    path = os.path.abspath(path)
+    if path not in _CACHES:
+        _CACHES[path] = TrialCache(path, max_entries)
+    cache = _CACHES[path]
+    cache.max_entries = int(max_entries)
+    return cache
+
+
+class TrialCache:
+    """
+    SQLite store of per-waveform pick times with size-bounded LRU eviction
+    """
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = int(max_entries)
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS picks ('
+            'key TEXT PRIMARY KEY, times TEXT NOT NULL, last_used REAL NOT NULL)'
+        )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS picks_last_used ON picks(last_used)')
+        self.conn.commit()
+
+    def get_many(self, keys: list) -> dict:
+        """
+        Return {key: [UTCDateTime, ...]} for the keys found in the cache
+        """
+        found = {}
+        unique = list(dict.fromkeys(keys))
+        for i in range(0, len(unique), 500):
+            chunk = unique[i:i + 500]
+            marks = ','.join('?' * len(chunk))
+            rows = self.conn.execute(
+                f'SELECT key, times FROM picks WHERE key IN ({marks})', chunk
+            ).fetchall()
+            for key, times in rows:
+                found[key] = [obspy.UTCDateTime(t) for t in json.loads(times)]
+        if found:
+            now = time.time()
+            self.conn.executemany('UPDATE picks SET last_used = ? WHERE key = ?',
+                                  [(now, key) for key in found])
+            self.conn.commit()
+        self.hits += sum(1 for key in keys if key in found)
+        self.misses += sum(1 for key in keys if key not in found)
+        return found
+
+    def put_many(self, items: dict):
+        """
+        Store {key: [UTCDateTime, ...]} and evict the least recently used
+        entries above max_entries
+        """
+        if not items:
+            return
+        now = time.time()
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO picks (key, times, last_used) VALUES (?, ?, ?)',
+            [(key, json.dumps([str(t) for t in times]), now) for key, times in items.items()]
+        )
+        count = self.conn.execute('SELECT COUNT(*) FROM picks').fetchone()[0]
+        if count > self.max_entries:
+            self.conn.execute(
+                'DELETE FROM picks WHERE key IN '
+                '(SELECT key FROM picks ORDER BY last_used LIMIT ?)',
+                (count - self.max_entries,)
+            )
+        self.conn.commit()
+
+    @property
+    def lookups(self):
+        return self.hits + self.misses
+
+    @property
+    def hit_rate(self):
+        return self.hits / self.lookups if self.lookups else 0.0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def close(self):
+        self.conn.close()
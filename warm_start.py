@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Warm start of new studies from previous results
+
+The first trials of a new study evaluate the best parameters already found
+for the station (results_<phase>.csv), those of its nearest tuned stations
+(coordinates saved from the coords query in station_coords.csv) and the
+median parameters of its network. TPE then starts from these points instead
+of random ones.
+"""
+import csv
+import os
+from dataclasses import dataclass
+
+import pandas as pd
+from obspy.geodetics import gps2dist_azimuth
+
+from campaign import file_lock
+from config_params import OPTIMIZATION_PARAMS
+
+STATION_COORDS_PATH = 'station_coords.csv'
+
+
+def save_station_coords(net, sta, lat, lon, path=STATION_COORDS_PATH):
+    """
+    Add or update the coordinates of a station in path
+    """
+    with file_lock(path):
+        coords = load_station_coords(path)
+        coords[f'{net}.{sta}'] = (float(lat), float(lon))
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['net.sta', 'lat', 'lon'])
+            for name, (st_lat, st_lon) in sorted(coords.items()):
+                writer.writerow([name, st_lat, st_lon])
+
+
+def load_station_coords(path=STATION_COORDS_PATH) -> dict:
+    """
+    Coordinates (lat, lon) by net.sta saved by save_station_coords
+    """
+    if not os.path.isfile(path):
+        return {}
+    with open(path, newline='') as f:
+        return {row['net.sta']: (float(row['lat']), float(row['lon']))
+                for row in csv.DictReader(f)}
+
+
+def snap_to_space(phase: str, params: dict):
+    """
+    Parameters of a results row clipped to the search space of the phase and
+    rounded to its steps, None if any of them is missing
+    """
+    snapped = {}
+    for name, config in OPTIMIZATION_PARAMS[phase].items():
+        value = params.get(name)
+        if value is None or pd.isna(value):
+            return None
+        value = min(max(float(value), config['min']), config['max'])
+        value = config['min'] + round((value - config['min']) / config['step']) * config['step']
+        value = min(value, config['max'])
+        snapped[name] = int(round(value)) if config['type'] == 'int' else round(float(value), 6)
+    return snapped
+
+
+def best_rows(results_path: str) -> pd.DataFrame:
+    """
+    Best row of each station of a results_<phase>.csv file, indexed by net.sta
+    """
+    if not os.path.isfile(results_path):
+        return pd.DataFrame()
+    try:
+        with file_lock(results_path):
+            df = pd.read_csv(results_path)
+    except (pd.errors.EmptyDataError, pd.errors.ParserError):
+        return pd.DataFrame()
+    if df.empty or 'net.sta' not in df or 'best_f1' not in df:
+        return pd.DataFrame()
+    df = df.sort_values(by='best_f1', ascending=False)
+    return df.drop_duplicates(subset='net.sta').set_index('net.sta')
+
+
+@dataclass
+class WarmStart:
+    enabled: bool = False
+    neighbors: int = 3
+    coords_path: str = STATION_COORDS_PATH
+
+    def candidates(self, net: str, sta: str, phase: str, results_path=None) -> list:
+        """
+        Parameters to enqueue in a new study of the station: its own best,
+        the best of its nearest stations and the median of its network
+        """
+        if not self.enabled:
+            return []
+        rows = best_rows(results_path or f'results_{phase}.csv')
+        if rows.empty:
+            return []
+        name = f'{net}.{sta}'
+        candidates = []
+        if name in rows.index:
+            candidates.append(rows.loc[name])
+
+        coords = load_station_coords(self.coords_path)
+        if name in coords and self.neighbors > 0:
+            lat, lon = coords[name]
+            distances = []
+            for other in rows.index:
+                if other != name and other in coords:
+                    distance = gps2dist_azimuth(lat, lon, *coords[other])[0]
+                    distances.append((distance, other))
+            for _, other in sorted(distances)[:self.neighbors]:
+                candidates.append(rows.loc[other])
+
+        network = rows[[index.split('.')[0] == net for index in rows.index]]
+        if len(network):
+            candidates.append(network.median(numeric_only=True))
+
+        params = []
+        for row in candidates:
+            snapped = snap_to_space(phase, row.to_dict())
+            if snapped is not None and snapped not in params:
+                params.append(snapped)
+        return params
+
+
+def print_warm_start(net, sta, phase, n_candidates):
+    """Print the number of warm start trials of a study"""
+    if n_candidates:
+        print(f'\n\t{net}.{sta} - {phase}: starting with {n_candidates} '
+              f'trials from previous results\n')
+
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+Adaptive number of evaluation workers
+
+With max_workers = auto the EvaluationPool measures the waveform throughput
+(waveforms per second of the scautopick evaluations) of the first trials with
+an increasing number of workers, up to a ceiling that never exceeds the CPUs
+available to the process (affinity and cgroup CPU quota). It keeps the
+smallest worker count within tolerance of the best throughput and saves it
+per host in worker_autotune.json, so later runs on the same host start with
+it instead of searching again.
+"""
+import json
+import math
+import os
+import socket
+import time
+from dataclasses import dataclass, field
+
+from campaign import file_lock
+
+AUTOTUNE_PATH = 'worker_autotune.json'
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+PROC_CGROUP = '/proc/self/cgroup'
+
+
+def _read_first_line(path):
+    try:
+        with open(path) as f:
+            return f.readline().strip()
+    except OSError:
+        return None
+
+
+def cgroup_paths(proc_cgroup=PROC_CGROUP):
+    """
+    cgroup v2 path and cgroup v1 cpu controller path of this process ('/'
+    when unknown)
+    """
+    v2_path = v1_path = '/'
+    try:
+        with open(proc_cgroup) as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return v2_path, v1_path
+    for line in lines:
+        hierarchy, controllers, path = (line.split(':', 2) + ['', ''])[:3]
+        if hierarchy == '0' and not controllers:
+            v2_path = path or '/'
+        elif 'cpu' in controllers.split(','):
+            v1_path = path or '/'
+    return v2_path, v1_path
+
+
+def _ancestors(base, path):
+    """
+    Directories from base/path up to base
+    """
+    parts = [part for part in path.split('/') if part]
+    return [os.path.join(base, *parts[:k]) for k in range(len(parts), -1, -1)]
+
+
+def _v2_quota(directory):
+    cpu_max = _read_first_line(os.path.join(directory, 'cpu.max'))
+    if cpu_max:
+        quota, _, period = cpu_max.partition(' ')
+        if quota != 'max' and period:
+            return int(quota) / int(period)
+    return None
+
+
+def _v1_quota(directory):
+    quota = _read_first_line(os.path.join(directory, 'cpu.cfs_quota_us'))
+    period = _read_first_line(os.path.join(directory, 'cpu.cfs_period_us'))
+    if quota and period and int(quota) > 0:
+        return int(quota) / int(period)
+    return None
+
+
+def cgroup_cpu_quota(root=CGROUP_ROOT, proc_cgroup=PROC_CGROUP):
+    """
+    CPUs allowed by the tightest CPU quota (cgroup v2 cpu.max or v1
+    cpu.cfs_quota_us) of the cgroup of this process and its ancestors up to
+    root, None without quota. Containers and systemd slices set the quota
+    on the cgroup of the process rather than on the root one
+    """
+    v2_path, v1_path = cgroup_paths(proc_cgroup)
+    quotas = [_v2_quota(directory) for directory in _ancestors(root, v2_path)]
+    quotas += [_v1_quota(directory)
+               for directory in _ancestors(os.path.join(root, 'cpu'), v1_path)]
+    quotas = [quota for quota in quotas if quota is not None]
+    return min(quotas) if quotas else None
+
+
+def available_cpus(root=CGROUP_ROOT, proc_cgroup=PROC_CGROUP) -> int:
+    """
+    CPUs this process can use: the CPUs of its affinity mask, limited by the
+    cgroup CPU quota
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    quota = cgroup_cpu_quota(root, proc_cgroup)
+    if quota is not None:
+        cpus = min(cpus, max(1, math.ceil(quota)))
+    return max(1, cpus)
+
+
+def candidate_counts(ceiling: int) -> list:
+    """
+    Worker counts tried in order: ceiling / 8, ceiling / 4, ceiling / 2 and
+    ceiling
+    """
+    ceiling = max(1, int(ceiling))
+    return sorted({max(1, ceiling >> k) for k in range(4)})
+
+
+def load_choices(path=AUTOTUNE_PATH) -> dict:
+    if not os.path.isfile(path):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+@dataclass
+class WorkerAutotuner:
+    """
+    Search of the worker count maximizing the waveforms per second of an
+    EvaluationPool. record is called by the pool after each evaluation and
+    returns the worker count to use for the next one
+    """
+    ceiling: int
+    path: str = AUTOTUNE_PATH
+    # evaluations and waveforms per worker (at least) measured per candidate
+    min_calls: int = 2
+    min_waveforms_per_worker: int = 2
+    # fewer workers are kept when within tolerance of the best throughput
+    tolerance: float = 0.05
+    chosen: int = None
+    throughput: dict = field(default_factory=dict)
+    _measures: dict = field(default_factory=dict)
+
+    def __post_init__(self):
+        self.ceiling = max(1, min(int(self.ceiling), available_cpus()))
+
+    @property
+    def key(self):
+        """
+        Host and ceiling the saved choice applies to
+        """
+        return f'{socket.gethostname()}:{self.ceiling}'
+
+    def initial_workers(self) -> int:
+        """
+        Worker count saved for this host, or the first candidate
+        """
+        saved = load_choices(self.path).get(self.key)
+        if saved and saved.get('cpus') == available_cpus():
+            self.chosen = int(saved['workers'])
+            print(f'\n\tUsing {self.chosen} evaluation workers tuned on this host '
+                  f'({self.path})\n')
+            return self.chosen
+        return candidate_counts(self.ceiling)[0]
+
+    def record(self, workers: int, n_waveforms: int, seconds: float) -> int:
+        if self.chosen is not None:
+            return self.chosen
+        calls, total, elapsed = self._measures.get(workers, (0, 0, 0.0))
+        calls, total, elapsed = calls + 1, total + n_waveforms, elapsed + seconds
+        self._measures[workers] = (calls, total, elapsed)
+        if calls < self.min_calls or total < self.min_waveforms_per_worker * workers:
+            return workers
+
+        self.throughput[workers] = total / elapsed if elapsed > 0 else 0.0
+        print(f'\n\t{workers} evaluation workers: '
+              f'{self.throughput[workers]:.2f} waveforms/s\n')
+        candidates = candidate_counts(self.ceiling)
+        larger = [n for n in candidates if n > workers]
+        previous_best = max((value for n, value in self.throughput.items() if n < workers),
+                            default=0.0)
+        # more workers only while they keep paying off
+        if larger and self.throughput[workers] > (1 + self.tolerance) * previous_best:
+            return larger[0]
+        self.choose()
+        return self.chosen
+
+    def choose(self):
+        """
+        Keep the smallest worker count within tolerance of the best
+        throughput and save it for this host
+        """
+        best = max(self.throughput.values())
+        self.chosen = min(n for n, value in self.throughput.items()
+                          if value >= best / (1 + self.tolerance))
+        print(f'\n\t\033[92mUsing {self.chosen} evaluation workers '
+              f'({self.throughput[self.chosen]:.2f} waveforms/s)\033[0m\n')
+        self.save()
+
+    def save(self):
+        with file_lock(self.path):
+            choices = load_choices(self.path)
+            choices[self.key] = {
+                'workers': self.chosen,
+                'cpus': available_cpus(),
+                'throughput': {str(n): round(value, 4)
+                               for n, value in sorted(self.throughput.items())},
+                'updated': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            }
+            with open(self.path, 'w') as f:
+                json.dump(choices, f, indent=1)